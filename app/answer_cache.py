@@ -0,0 +1,151 @@
+import asyncio
+import time
+from typing import Dict, List, Optional
+
+import numpy as np
+from langchain_core.documents import Document
+from sqlalchemy import text
+
+from app.config import (
+    ANSWER_CACHE_MAX_ENTRIES,
+    ANSWER_CACHE_THRESHOLD,
+    ANSWER_CACHE_TTL_SECONDS,
+    ANSWER_CACHE_VERSION_CHECK_SECONDS,
+    COLLECTION_NAME,
+    DATABASE_URL,
+)
+from app.db import PooledDatabase
+from app.pgvector_admin import CREATE_INGEST_VERSION_SQL, INGEST_VERSION_TABLE
+
+VERSION_SQL = text(f"SELECT version FROM {INGEST_VERSION_TABLE} WHERE collection_name = :name")
+
+
+class IngestVersionTracker:
+    """Versión de ingesta de la colección, consultada como mucho cada `interval` segundos"""
+
+    def __init__(self, url: str = DATABASE_URL, collection_name: str = COLLECTION_NAME,
+                 interval: float = ANSWER_CACHE_VERSION_CHECK_SECONDS):
+        self.db = PooledDatabase(url, pool_size=1, max_overflow=1, pool_timeout=5.0)
+        self.collection_name = collection_name
+        self.interval = interval
+        self._version: Optional[int] = None
+        self._checked_at = 0.0
+        self._lock = asyncio.Lock()
+
+    async def current(self) -> int:
+        if self._version is not None and time.monotonic() - self._checked_at < self.interval:
+            return self._version
+        async with self._lock:
+            if self._version is None or time.monotonic() - self._checked_at >= self.interval:
+                async with self.db.begin() as conn:
+                    if self._version is None:
+                        await conn.execute(text(CREATE_INGEST_VERSION_SQL))
+                    version = (await conn.execute(VERSION_SQL, {"name": self.collection_name})).scalar()
+                self._version = version or 0
+                self._checked_at = time.monotonic()
+        return self._version
+
+    async def close(self):
+        await self.db.dispose()
+
+
+class SemanticAnswerCache:
+    """Caché de respuestas buscada por similitud coseno de la pregunta.
+
+    Cada entrada guarda la versión de ingesta con la que se generó: cuando la
+    colección se re-ingesta, las entradas viejas dejan de ser válidas. También
+    guarda el hash del historial que entró en el prompt: una respuesta que
+    depende de una conversación solo se reutiliza con esa misma conversación.
+    """
+
+    def __init__(self, version_tracker: IngestVersionTracker, threshold: float = ANSWER_CACHE_THRESHOLD,
+                 ttl_seconds: int = ANSWER_CACHE_TTL_SECONDS, max_entries: int = ANSWER_CACHE_MAX_ENTRIES):
+        self.version_tracker = version_tracker
+        self.threshold = threshold
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._entries: List[Dict] = []
+        self._matrix: Optional[np.ndarray] = None
+        self._histories: Optional[np.ndarray] = None
+        self.stats = {"hits": 0, "misses": 0, "stores": 0, "expired": 0, "invalidated": 0}
+
+    @staticmethod
+    def _normalize(vector: List[float]) -> np.ndarray:
+        array = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(array)
+        return array / norm if norm else array
+
+    def _rebuild(self):
+        self._matrix = np.stack([entry["vector"] for entry in self._entries]) if self._entries else None
+        self._histories = np.asarray([entry["history"] for entry in self._entries], dtype=object)
+
+    def _prune(self, version: int):
+        now = time.time()
+        kept = []
+        for entry in self._entries:
+            if entry["version"] != version:
+                self.stats["invalidated"] += 1
+            elif now - entry["created_at"] > self.ttl_seconds:
+                self.stats["expired"] += 1
+            else:
+                kept.append(entry)
+        if len(kept) != len(self._entries):
+            self._entries = kept
+            self._rebuild()
+
+    async def lookup(self, vector: List[float], history: str = "") -> Optional[Dict]:
+        """Devolver {"question", "answer", "docs", "similarity"} si hay una entrada equivalente.
+
+        `history` es el hash del historial de la conversación ("" sin historial).
+        """
+        version = await self.version_tracker.current()
+        self._prune(version)
+        if self._matrix is None:
+            self.stats["misses"] += 1
+            return None
+
+        similarities = np.where(self._histories == history, self._matrix @ self._normalize(vector), -np.inf)
+        best = int(np.argmax(similarities))
+        if similarities[best] < self.threshold:
+            self.stats["misses"] += 1
+            return None
+
+        self.stats["hits"] += 1
+        entry = self._entries[best]
+        return {
+            "question": entry["question"],
+            "answer": entry["answer"],
+            # Copias: quien consume la respuesta puede modificar la metadata
+            "docs": [Document(page_content=doc.page_content, metadata=dict(doc.metadata)) for doc in entry["docs"]],
+            "similarity": float(similarities[best]),
+        }
+
+    async def store(self, vector: List[float], question: str, answer: str, docs: List[Document], history: str = ""):
+        if not answer:
+            return
+        version = await self.version_tracker.current()
+        self._entries.append({
+            "vector": self._normalize(vector),
+            "history": history,
+            "question": question,
+            "answer": answer,
+            "docs": list(docs),
+            "version": version,
+            "created_at": time.time(),
+        })
+        # Expulsar las entradas más viejas si se supera el máximo
+        if len(self._entries) > self.max_entries:
+            self._entries = self._entries[-self.max_entries:]
+        self._rebuild()
+        self.stats["stores"] += 1
+
+    def snapshot(self) -> Dict:
+        lookups = self.stats["hits"] + self.stats["misses"]
+        return {
+            **self.stats,
+            "entries": len(self._entries),
+            "hit_rate": round(self.stats["hits"] / lookups, 4) if lookups else 0.0,
+        }
+
+    async def close(self):
+        await self.version_tracker.close()
@@ -0,0 +1,124 @@
+import asyncio
+from collections import defaultdict
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+from langchain_core.embeddings import Embeddings
+
+from app.config import BATCH_EMBED_MAX_SIZE, BATCH_MAX_WAIT_MS, BATCH_SEARCH_MAX_SIZE, RETRIEVAL_K
+from app.filters import MetadataFilter
+from app.retrieval import SearchResults, VectorSearcher
+
+
+class MicroBatcher:
+    """Juntar pedidos concurrentes en lotes: se despacha al llegar a `max_size`
+    elementos o cuando pasan `max_wait_ms` desde el primero pendiente.
+
+    `handler` recibe la lista de elementos y devuelve un resultado por elemento.
+    """
+
+    def __init__(self, handler: Callable[[List[Any]], Awaitable[List[Any]]], max_size: int,
+                 max_wait_ms: float = BATCH_MAX_WAIT_MS):
+        self.handler = handler
+        self.max_size = max(1, max_size)
+        self.max_wait = max_wait_ms / 1000
+        self._pending: List[Tuple[Any, asyncio.Future]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._running: Set[asyncio.Task] = set()
+        self.stats = {"batches": 0, "items": 0}
+
+    async def submit(self, item: Any) -> Any:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((item, future))
+        if len(self._pending) >= self.max_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.max_wait, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if not batch:
+            return
+        task = asyncio.get_running_loop().create_task(self._run(batch))
+        # Guardar la referencia: el event loop solo mantiene referencias débiles a las tareas
+        self._running.add(task)
+        task.add_done_callback(self._running.discard)
+
+    async def _run(self, batch: List[Tuple[Any, asyncio.Future]]):
+        # Quien pidió un elemento pudo haberse cancelado mientras esperaba
+        batch = [(item, future) for item, future in batch if not future.done()]
+        if not batch:
+            return
+        self.stats["batches"] += 1
+        self.stats["items"] += len(batch)
+        try:
+            results = await self.handler([item for item, _ in batch])
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+    def snapshot(self) -> Dict:
+        return {
+            **self.stats,
+            "avg_batch_size": round(self.stats["items"] / self.stats["batches"], 2) if self.stats["batches"] else 0.0,
+        }
+
+
+class BatchingEmbeddings(Embeddings):
+    """Embeddings cuyas llamadas async concurrentes se combinan en una sola llamada al modelo"""
+
+    def __init__(self, embeddings: Embeddings, max_size: int = BATCH_EMBED_MAX_SIZE):
+        self.embeddings = embeddings
+        self.batcher = MicroBatcher(self.embeddings.aembed_documents, max_size)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.embeddings.embed_documents(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embeddings.embed_query(text)
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        return list(await asyncio.gather(*(self.batcher.submit(text) for text in texts)))
+
+    async def aembed_query(self, text: str) -> List[float]:
+        return await self.batcher.submit(text)
+
+
+class BatchingSearcher(VectorSearcher):
+    """Búsquedas concurrentes combinadas en un solo round-trip de asearch_many"""
+
+    def __init__(self, searcher: VectorSearcher, max_size: int = BATCH_SEARCH_MAX_SIZE):
+        self.searcher = searcher
+        self.batcher = MicroBatcher(self._search, max_size)
+
+    async def _search(self, items: List[Tuple[List[float], int, Optional[MetadataFilter]]]) -> SearchResults:
+        # Un asearch_many por cada (k, filtro) distinto dentro del lote
+        groups: Dict[Tuple[int, Optional[MetadataFilter]], List[int]] = defaultdict(list)
+        for position, (_, k, filters) in enumerate(items):
+            groups[(k, filters)].append(position)
+        results: SearchResults = [[] for _ in items]
+        for (k, filters), positions in groups.items():
+            found = await self.searcher.asearch_many([items[position][0] for position in positions], k, filters)
+            for position, ranked in zip(positions, found):
+                results[position] = ranked
+        return results
+
+    async def asearch_many(self, vectors: List[List[float]], k: int = RETRIEVAL_K,
+                           filters: Optional[MetadataFilter] = None) -> SearchResults:
+        return list(await asyncio.gather(*(self.batcher.submit((vector, k, filters)) for vector in vectors)))
+
+    def search_many(self, vectors: List[List[float]], k: int = RETRIEVAL_K,
+                    filters: Optional[MetadataFilter] = None) -> SearchResults:
+        return self.searcher.search_many(vectors, k, filters)
+
+    async def avectors(self, ids: List[str]) -> Dict[str, List[float]]:
+        return await self.searcher.avectors(ids)
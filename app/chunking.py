@@ -0,0 +1,165 @@
+import re
+from typing import List, Optional, Tuple
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+
+from app.config import (
+    CHUNK_BREAKPOINT_PERCENTILE,
+    CHUNK_BUFFER_SIZE,
+    CHUNK_OVERLAP_TOKENS,
+    CHUNK_TOKENS,
+    CHUNK_VECTORS,
+    INGEST_CHUNKER,
+    INGEST_EMBED_BATCH_SIZE,
+)
+from app.tokens import get_encoding
+
+# Mismo corte de oraciones que SemanticChunker
+SENTENCE_SPLIT_RE = re.compile(r"(?<=[.?!])\s+")
+
+# Sin tokenizer: ~4 caracteres por token (igual que count_tokens)
+CHARS_PER_TOKEN = 4
+
+ChunkVectors = Optional[List[List[float]]]
+
+
+def split_sentences(text: str) -> List[str]:
+    return [sentence for sentence in SENTENCE_SPLIT_RE.split(text) if sentence.strip()]
+
+
+def sentence_windows(sentences: List[str], buffer_size: int) -> List[str]:
+    """Cada oración con `buffer_size` vecinas a cada lado (lo que se embebe)"""
+    return [
+        " ".join(sentences[max(0, i - buffer_size):i + buffer_size + 1])
+        for i in range(len(sentences))
+    ]
+
+
+def normalize_rows(vectors: np.ndarray) -> np.ndarray:
+    return vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+
+def breakpoints(vectors: np.ndarray, percentile: float) -> np.ndarray:
+    """Posiciones i con un corte entre la oración i y la i+1.
+
+    `vectors` normalizados: la distancia coseno de todos los pares
+    consecutivos sale de un solo producto fila a fila.
+    """
+    if len(vectors) < 2:
+        return np.zeros(0, dtype=np.int64)
+    distances = 1.0 - np.einsum("ij,ij->i", vectors[:-1], vectors[1:])
+    return np.flatnonzero(distances > np.percentile(distances, percentile))
+
+
+class SemanticSplitter:
+    """Chunking semántico con los mismos cortes que SemanticChunker, pero con
+    los embeddings de oraciones de todo el archivo en lotes de `batch_size`
+    (no una llamada por página) y las distancias calculadas con NumPy.
+
+    Con `reuse_vectors` el vector de cada chunk es el promedio normalizado de
+    los embeddings de sus oraciones, así la etapa de embeddings no vuelve a
+    llamar a la API por el mismo texto.
+    """
+
+    def __init__(self, embeddings: Embeddings, buffer_size: int = CHUNK_BUFFER_SIZE,
+                 percentile: float = CHUNK_BREAKPOINT_PERCENTILE, reuse_vectors: bool = CHUNK_VECTORS == "reuse",
+                 batch_size: int = INGEST_EMBED_BATCH_SIZE):
+        self.embeddings = embeddings
+        self.buffer_size = buffer_size
+        self.percentile = percentile
+        self.reuse_vectors = reuse_vectors
+        self.batch_size = batch_size
+
+    def _embed(self, texts: List[str]) -> np.ndarray:
+        vectors = []
+        for start in range(0, len(texts), self.batch_size):
+            vectors.extend(self.embeddings.embed_documents(texts[start:start + self.batch_size]))
+        return normalize_rows(np.asarray(vectors, dtype=np.float32))
+
+    def split_with_vectors(self, pages: List[Document]) -> Tuple[List[Document], ChunkVectors]:
+        """Chunks de las páginas y, con `reuse_vectors`, sus vectores (si no, None)"""
+        page_sentences = [split_sentences(page.page_content) for page in pages]
+        windows = [window for sentences in page_sentences for window in sentence_windows(sentences, self.buffer_size)]
+        if not windows:
+            return [], [] if self.reuse_vectors else None
+        vectors = self._embed(windows)
+
+        chunks: List[Document] = []
+        chunk_vectors = []
+        offset = 0
+        for page, sentences in zip(pages, page_sentences):
+            rows = vectors[offset:offset + len(sentences)]
+            offset += len(sentences)
+            for group in np.split(np.arange(len(sentences)), breakpoints(rows, self.percentile) + 1):
+                if not len(group):
+                    continue
+                chunks.append(Document(
+                    page_content=" ".join(sentences[i] for i in group),
+                    metadata=dict(page.metadata),
+                ))
+                if self.reuse_vectors:
+                    chunk_vectors.append(rows[group].mean(axis=0))
+
+        if not self.reuse_vectors:
+            return chunks, None
+        return chunks, normalize_rows(np.asarray(chunk_vectors)).tolist()
+
+    def split_documents(self, pages: List[Document]) -> List[Document]:
+        return self.split_with_vectors(pages)[0]
+
+
+class TokenWindowSplitter:
+    """Ventanas fijas de `chunk_tokens` tokens con `overlap` de solapamiento.
+
+    No llama a la API: para corpus muy grandes donde el costo de los
+    embeddings de oraciones no se justifica.
+    """
+
+    def __init__(self, chunk_tokens: int = CHUNK_TOKENS, overlap: int = CHUNK_OVERLAP_TOKENS):
+        self.chunk_tokens = max(1, chunk_tokens)
+        self.overlap = min(max(0, overlap), self.chunk_tokens - 1)
+
+    def split_text(self, text: str) -> List[str]:
+        step = self.chunk_tokens - self.overlap
+        encoding = get_encoding()
+        if encoding is None:
+            size, step = self.chunk_tokens * CHARS_PER_TOKEN, step * CHARS_PER_TOKEN
+            return [text[start:start + size] for start in range(0, max(len(text) - self.overlap * CHARS_PER_TOKEN, 1), step)]
+        tokens = encoding.encode(text, disallowed_special=())
+        return [
+            encoding.decode(tokens[start:start + self.chunk_tokens])
+            for start in range(0, max(len(tokens) - self.overlap, 1), step)
+        ]
+
+    def split_documents(self, pages: List[Document]) -> List[Document]:
+        return [
+            Document(page_content=window, metadata=dict(page.metadata))
+            for page in pages if page.page_content.strip()
+            for window in self.split_text(page.page_content) if window.strip()
+        ]
+
+
+def chunker_profile(mode: str = INGEST_CHUNKER) -> str:
+    """Modo y parámetros que cambian los chunks o sus vectores.
+
+    Va en el manifiesto y en los ids de los chunks: cambiar de modo reprocesa
+    los archivos en vez de mezclar vectores de dos modos en la colección.
+    """
+    if mode == "token":
+        return f"token:{CHUNK_TOKENS}:{CHUNK_OVERLAP_TOKENS}"
+    if mode == "langchain":
+        return "langchain"
+    return f"semantic:{CHUNK_BUFFER_SIZE}:{CHUNK_BREAKPOINT_PERCENTILE:g}:{CHUNK_VECTORS}"
+
+
+def build_text_splitter(embeddings: Embeddings, mode: str = INGEST_CHUNKER):
+    """Splitter de la ingesta según INGEST_CHUNKER"""
+    if mode == "token":
+        return TokenWindowSplitter()
+    if mode == "langchain":
+        from langchain_experimental.text_splitter import SemanticChunker
+
+        return SemanticChunker(embeddings=embeddings)
+    return SemanticSplitter(embeddings)
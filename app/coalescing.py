@@ -0,0 +1,119 @@
+import asyncio
+from typing import AsyncIterator, Callable, Dict, Hashable, List, Optional, Set, Tuple
+
+from app.metrics import COALESCED_REQUESTS_TOTAL
+
+
+class Flight:
+    """Un pipeline en curso y los chunks que lleva producidos.
+
+    Cada suscriptor recorre la lista desde el principio: quien llega tarde
+    recibe primero lo que se perdió y después sigue en vivo.
+    """
+
+    def __init__(self, on_abandoned: Optional[Callable[[], None]] = None):
+        self.chunks: List[dict] = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        # Callers que se unieron y todavía no terminaron de leer (se cuentan
+        # desde join, antes de empezar a iterar, para no cancelar de más)
+        self.subscribers = 0
+        self._on_abandoned = on_abandoned
+        self._changed = asyncio.Event()
+
+    def publish(self, chunk: dict):
+        self.chunks.append(chunk)
+        self._notify()
+
+    def finish(self, error: Optional[BaseException] = None):
+        self.done = True
+        self.error = error
+        self._notify()
+
+    def _notify(self):
+        # Despertar a los que esperan y dejar un evento nuevo para la próxima espera
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def subscribe(self) -> AsyncIterator[dict]:
+        position = 0
+        try:
+            while True:
+                changed = self._changed
+                while position < len(self.chunks):
+                    yield self.chunks[position]
+                    position += 1
+                if self.done:
+                    if self.error is not None:
+                        raise self.error
+                    return
+                await changed.wait()
+        finally:
+            self.subscribers -= 1
+            # Se fue el último antes del final: nadie más va a leer la respuesta
+            if self.subscribers <= 0 and not self.done and self._on_abandoned is not None:
+                self._on_abandoned()
+
+
+class SingleFlight:
+    """Una sola ejecución por clave para requests idénticos concurrentes.
+
+    El productor corre en su propia tarea: si el cliente que lo inició se
+    desconecta, el resto de los suscriptores igual recibe la respuesta.
+    Si se desconectan todos, se cancela (deja de gastar tokens del modelo).
+    La clave se libera al terminar; las repeticiones posteriores quedan
+    para la caché de respuestas.
+    """
+
+    def __init__(self):
+        self._flights: Dict[Hashable, Flight] = {}
+        self._running: Set[asyncio.Task] = set()
+        self.stats = {"leaders": 0, "joined": 0, "abandoned": 0}
+
+    def join(self, key: Hashable, producer: Callable[[], AsyncIterator[dict]]) -> Tuple[Flight, bool]:
+        """Devuelve (vuelo, True si este caller lo inició)"""
+        flight = self._flights.get(key)
+        if flight is not None:
+            flight.subscribers += 1
+            self.stats["joined"] += 1
+            COALESCED_REQUESTS_TOTAL.inc(role="joined")
+            return flight, False
+
+        flight = Flight(on_abandoned=lambda: self._abandon(key, flight, task))
+        flight.subscribers = 1
+        self._flights[key] = flight
+        self.stats["leaders"] += 1
+        COALESCED_REQUESTS_TOTAL.inc(role="leader")
+        task = asyncio.get_running_loop().create_task(self._run(key, flight, producer()))
+        self._running.add(task)
+        task.add_done_callback(self._running.discard)
+        return flight, True
+
+    def _abandon(self, key: Hashable, flight: Flight, task: asyncio.Task):
+        # La clave se libera ya: un request nuevo no debe unirse a un vuelo cancelado
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+        self.stats["abandoned"] += 1
+        task.cancel()
+
+    async def _run(self, key: Hashable, flight: Flight, chunks: AsyncIterator[dict]):
+        try:
+            async for chunk in chunks:
+                flight.publish(chunk)
+            flight.finish()
+        except asyncio.CancelledError as e:
+            flight.finish(e)
+            raise
+        except Exception as e:
+            flight.finish(e)
+        finally:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+
+    def snapshot(self) -> Dict:
+        total = self.stats["leaders"] + self.stats["joined"]
+        return {
+            **self.stats,
+            "in_flight": len(self._flights),
+            "coalesced_rate": round(self.stats["joined"] / total, 4) if total else 0.0,
+        }
@@ -0,0 +1,225 @@
+import os
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+
+def env_bool(name: str, default: bool) -> bool:
+    value = os.getenv(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+
+def env_int(name: str, default: int) -> int:
+    value = os.getenv(name)
+    return int(value) if value else default
+
+
+def env_float(name: str, default: float) -> float:
+    value = os.getenv(name)
+    return float(value) if value else default
+
+
+# Configuración compartida entre el servidor y el cargador de PDFs.
+# Todos los valores se pueden sobreescribir con variables de entorno (.env).
+
+DATABASE_URL = os.getenv("DATABASE_URL")
+
+COLLECTION_NAME = os.getenv("COLLECTION_NAME", "collection164")
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "text-embedding-3-small")
+
+PDF_DIRECTORY = os.path.abspath(os.getenv("PDF_DIRECTORY", "./pdf-documents"))
+
+# Backend de vectores: pgvector | mmap (matriz float32 memory-mapped en disco,
+# compartida entre procesos sin copias y sin round-trip a la base de datos)
+VECTOR_BACKEND = os.getenv("VECTOR_BACKEND", "pgvector").lower()
+MMAP_INDEX_DIR = os.path.abspath(os.getenv("MMAP_INDEX_DIR", "./.index"))
+# Particiones k-means (IVF) para colecciones grandes; 0 = búsqueda exacta
+MMAP_INDEX_PARTITIONS = env_int("MMAP_INDEX_PARTITIONS", 0)
+# Particiones que se recorren por consulta
+MMAP_INDEX_PROBES = env_int("MMAP_INDEX_PROBES", 8)
+
+# Manifiesto de la ingesta incremental (hash, chunk ids y modelo por archivo).
+# Con el backend mmap vive junto al índice: cada backend lleva su propio estado.
+INGEST_MANIFEST_PATH = os.path.abspath(
+    os.getenv(
+        "INGEST_MANIFEST_PATH",
+        os.path.join(MMAP_INDEX_DIR, COLLECTION_NAME, "manifest.json")
+        if VECTOR_BACKEND == "mmap"
+        else "./rag-data-loader/manifest.json",
+    )
+)
+
+# Caché persistente de embeddings (compartida por el cargador y las consultas)
+EMBEDDING_CACHE_ENABLED = env_bool("EMBEDDING_CACHE_ENABLED", True)
+EMBEDDING_CACHE_PATH = os.path.abspath(
+    os.getenv("EMBEDDING_CACHE_PATH", "./.cache/embeddings.sqlite3")
+)
+EMBEDDING_CACHE_MAX_MB = env_int("EMBEDDING_CACHE_MAX_MB", 512)
+EMBEDDING_CACHE_MEMORY_ITEMS = env_int("EMBEDDING_CACHE_MEMORY_ITEMS", 10000)
+
+# Pipeline de ingesta: parseo en procesos, chunking, embeddings y escritura concurrentes
+INGEST_PARSE_WORKERS = env_int("INGEST_PARSE_WORKERS", os.cpu_count() or 2)
+INGEST_CHUNK_WORKERS = env_int("INGEST_CHUNK_WORKERS", 2)
+INGEST_EMBED_CONCURRENCY = env_int("INGEST_EMBED_CONCURRENCY", 4)
+INGEST_EMBED_BATCH_SIZE = env_int("INGEST_EMBED_BATCH_SIZE", 256)
+INGEST_WRITE_BATCH_ROWS = env_int("INGEST_WRITE_BATCH_ROWS", 1000)
+# Máximo de archivos en vuelo entre dos etapas (acota la memoria)
+INGEST_QUEUE_SIZE = env_int("INGEST_QUEUE_SIZE", 8)
+# Al apagar el servidor: segundos que se espera a que el job en curso se
+# detenga entre archivos antes de terminar su proceso
+INGEST_SHUTDOWN_TIMEOUT = env_float("INGEST_SHUTDOWN_TIMEOUT", 10.0)
+
+# Chunking de la ingesta: semantic (cortes por distancia entre oraciones,
+# vectorizado) | token (ventanas fijas de tokens, sin embeddings) | langchain
+# (SemanticChunker original). El modo va en el manifiesto: cambiarlo
+# reprocesa todos los archivos en la siguiente ingesta.
+INGEST_CHUNKER = os.getenv("INGEST_CHUNKER", "semantic").lower()
+# Oraciones vecinas que acompañan a cada oración al embeberla
+CHUNK_BUFFER_SIZE = env_int("CHUNK_BUFFER_SIZE", 1)
+# Percentil de las distancias entre oraciones consecutivas que marca un corte
+CHUNK_BREAKPOINT_PERCENTILE = env_float("CHUNK_BREAKPOINT_PERCENTILE", 95.0)
+# Vector de cada chunk: embed (embeber el texto del chunk; la caché de
+# embeddings absorbe las repeticiones) | reuse (promedio de los embeddings de
+# sus oraciones, sin segunda llamada, pero no es el vector del texto del chunk)
+CHUNK_VECTORS = os.getenv("CHUNK_VECTORS", "embed").lower()
+# Modo token: tamaño de la ventana y solapamiento
+CHUNK_TOKENS = env_int("CHUNK_TOKENS", 512)
+CHUNK_OVERLAP_TOKENS = env_int("CHUNK_OVERLAP_TOKENS", 64)
+
+# Subidas: copia por bloques fuera del event loop; con UPLOAD_AUTO_INDEX cada
+# subida encola un job que indexa solo esos archivos
+UPLOAD_CHUNK_BYTES = env_int("UPLOAD_CHUNK_BYTES", 1024 * 1024)
+UPLOAD_AUTO_INDEX = env_bool("UPLOAD_AUTO_INDEX", True)
+
+# Escritura masiva con COPY e índice ANN de pgvector
+VECTOR_BULK_COPY = env_bool("VECTOR_BULK_COPY", True)
+EMBEDDING_DIMENSIONS = env_int("EMBEDDING_DIMENSIONS", 1536)
+# hnsw | ivfflat | none
+VECTOR_INDEX_TYPE = os.getenv("VECTOR_INDEX_TYPE", "hnsw").lower()
+HNSW_M = env_int("HNSW_M", 16)
+HNSW_EF_CONSTRUCTION = env_int("HNSW_EF_CONSTRUCTION", 64)
+HNSW_EF_SEARCH = env_int("HNSW_EF_SEARCH", 40)
+# 0 = automático (filas / 1000, mínimo 10)
+IVFFLAT_LISTS = env_int("IVFFLAT_LISTS", 0)
+IVFFLAT_PROBES = env_int("IVFFLAT_PROBES", 10)
+INDEX_MAINTENANCE_WORK_MEM = os.getenv("INDEX_MAINTENANCE_WORK_MEM", "512MB")
+
+# Filtros por metadata en /query y /stream: solo estas claves (cada una con su
+# índice de expresión sobre cmetadata, así el filtro se aplica antes del k-NN)
+METADATA_FILTER_KEYS = [
+    key.strip() for key in os.getenv("METADATA_FILTER_KEYS", "source,page").split(",")
+    if key.strip().isidentifier()
+]
+# Colecciones en que se reparte el corpus (cada archivo va a una según su ruta);
+# las búsquedas sin filtro de fuente las recorren todas en paralelo. 1 = sin shards
+COLLECTION_SHARDS = max(1, env_int("COLLECTION_SHARDS", 1))
+
+# Historial de chat: pool async de conexiones y cuántos mensajes se cargan
+HISTORY_DATABASE_URL = os.getenv("DATABASE_URL_UNO")
+HISTORY_MAX_MESSAGES = env_int("HISTORY_MAX_MESSAGES", 20)
+# window (default): los últimos HISTORY_MAX_MESSAGES mensajes tal cual
+# budget (opt-in): los turnos recientes que entran en HISTORY_TOKEN_BUDGET tokens + un
+# resumen de los anteriores, generado en segundo plano después de cada respuesta
+HISTORY_MODE = os.getenv("HISTORY_MODE", "window").lower()
+HISTORY_TOKEN_BUDGET = env_int("HISTORY_TOKEN_BUDGET", 1500)
+HISTORY_SUMMARY_MAX_TOKENS = env_int("HISTORY_SUMMARY_MAX_TOKENS", 300)
+# Mensajes que se agregan al resumen por llamada al modelo
+HISTORY_SUMMARY_BATCH = env_int("HISTORY_SUMMARY_BATCH", 40)
+HISTORY_POOL_SIZE = env_int("HISTORY_POOL_SIZE", 10)
+HISTORY_MAX_OVERFLOW = env_int("HISTORY_MAX_OVERFLOW", 10)
+HISTORY_POOL_TIMEOUT = env_float("HISTORY_POOL_TIMEOUT", 10.0)
+
+# Recuperación especulativa en paralelo con la reescritura de la pregunta
+SPECULATIVE_RETRIEVAL = env_bool("SPECULATIVE_RETRIEVAL", True)
+# Similitud mínima (0-1) entre pregunta original y reescrita para usar la especulación
+SPECULATION_MIN_SIMILARITY = env_float("SPECULATION_MIN_SIMILARITY", 0.9)
+
+# Recuperación: multiquery (MultiQueryRetriever de LangChain) | batched
+# (todas las variantes en un solo embedding y una sola consulta SQL, fusión RRF)
+RETRIEVER_MODE = os.getenv("RETRIEVER_MODE", "multiquery").lower()
+RETRIEVAL_K = env_int("RETRIEVAL_K", 4)
+RRF_K = env_int("RRF_K", 60)
+VECTOR_POOL_SIZE = env_int("VECTOR_POOL_SIZE", 10)
+VECTOR_MAX_OVERFLOW = env_int("VECTOR_MAX_OVERFLOW", 10)
+VECTOR_POOL_TIMEOUT = env_float("VECTOR_POOL_TIMEOUT", 10.0)
+
+# Routing adaptativo: primero una búsqueda barata (un embedding + BM25) y
+# expansión MultiQuery solo si los resultados son poco confiables
+QUERY_ROUTING = env_bool("QUERY_ROUTING", True)
+# Similitud coseno mínima del mejor resultado para no expandir
+ROUTING_MIN_SIMILARITY = env_float("ROUTING_MIN_SIMILARITY", 0.5)
+# Fracción mínima de resultados compartidos entre la búsqueda vectorial y BM25
+ROUTING_MIN_AGREEMENT = env_float("ROUTING_MIN_AGREEMENT", 0.25)
+# Índice léxico BM25 construido al final de cada ingesta
+LEXICAL_INDEX_ENABLED = env_bool("LEXICAL_INDEX_ENABLED", True)
+LEXICAL_INDEX_PATH = os.path.abspath(
+    os.getenv("LEXICAL_INDEX_PATH", os.path.join(os.path.dirname(INGEST_MANIFEST_PATH), "bm25.json"))
+)
+
+# Empaquetado del contexto: fuera casi-duplicados (coseno >= umbral) y hasta
+# CONTEXT_TOKEN_BUDGET tokens de chunks, en orden de score de fusión
+CONTEXT_PACKING = env_bool("CONTEXT_PACKING", True)
+CONTEXT_TOKEN_BUDGET = env_int("CONTEXT_TOKEN_BUDGET", 3000)
+CONTEXT_DEDUP_THRESHOLD = env_float("CONTEXT_DEDUP_THRESHOLD", 0.95)
+
+# Arranque: construcción perezosa de los recursos y precalentamiento antes de
+# declarar el worker listo (/health/ready)
+WARMUP_ON_STARTUP = env_bool("WARMUP_ON_STARTUP", True)
+# Conexiones que se abren en los pools de historial y de búsqueda durante el precalentamiento
+WARMUP_POOL_CONNECTIONS = env_int("WARMUP_POOL_CONNECTIONS", 4)
+# Pausa entre reintentos de los pasos del precalentamiento que fallaron
+WARMUP_RETRY_SECONDS = env_float("WARMUP_RETRY_SECONDS", 5.0)
+
+# Clientes HTTP compartidos (pool keep-alive) para las APIs de modelos
+HTTP_MAX_CONNECTIONS = env_int("HTTP_MAX_CONNECTIONS", 100)
+HTTP_MAX_KEEPALIVE_CONNECTIONS = env_int("HTTP_MAX_KEEPALIVE_CONNECTIONS", 20)
+HTTP_KEEPALIVE_EXPIRY = env_float("HTTP_KEEPALIVE_EXPIRY", 30.0)
+HTTP_TIMEOUT = env_float("HTTP_TIMEOUT", 60.0)
+
+# Scheduler de llamadas a modelos: concurrencia por modelo, ritmo según el
+# presupuesto de tokens por minuto (0 = sin límite), prioridad interactive >
+# batch > ingest y rechazo rápido (429) de los requests interactivos
+MODEL_SCHEDULER = env_bool("MODEL_SCHEDULER", True)
+LLM_MAX_CONCURRENCY = env_int("LLM_MAX_CONCURRENCY", 16)
+LLM_TOKENS_PER_MINUTE = env_int("LLM_TOKENS_PER_MINUTE", 200000)
+# Tokens de salida que se reservan por llamada al chat (el prompt se cuenta)
+LLM_OUTPUT_TOKENS_ESTIMATE = env_int("LLM_OUTPUT_TOKENS_ESTIMATE", 300)
+EMBEDDING_MAX_CONCURRENCY = env_int("EMBEDDING_MAX_CONCURRENCY", 8)
+EMBEDDING_TOKENS_PER_MINUTE = env_int("EMBEDDING_TOKENS_PER_MINUTE", 1000000)
+# Requests interactivos en espera por modelo antes de responder 429
+SCHEDULER_MAX_QUEUE = env_int("SCHEDULER_MAX_QUEUE", 64)
+# Espera máxima (cola + ritmo) de un request interactivo antes de responder 429
+SCHEDULER_MAX_WAIT_S = env_float("SCHEDULER_MAX_WAIT_S", 5.0)
+# Fracción del presupuesto de embeddings para el proceso de ingesta (comparte la cuota del proveedor)
+INGEST_TPM_SHARE = env_float("INGEST_TPM_SHARE", 0.5)
+
+# Single-flight: requests idénticos concurrentes comparten un solo pipeline
+COALESCE_REQUESTS = env_bool("COALESCE_REQUESTS", True)
+
+# /batch_query: preguntas en paralelo y micro-lotes compartidos de embeddings y búsquedas
+BATCH_QUERY_CONCURRENCY = env_int("BATCH_QUERY_CONCURRENCY", 16)
+BATCH_QUERY_MAX_QUESTIONS = env_int("BATCH_QUERY_MAX_QUESTIONS", 5000)
+BATCH_EMBED_MAX_SIZE = env_int("BATCH_EMBED_MAX_SIZE", 256)
+BATCH_SEARCH_MAX_SIZE = env_int("BATCH_SEARCH_MAX_SIZE", 64)
+# Espera máxima para completar un micro-lote
+BATCH_MAX_WAIT_MS = env_float("BATCH_MAX_WAIT_MS", 10.0)
+
+# Caché semántica de respuestas (clave: embedding de la pregunta standalone)
+ANSWER_CACHE_ENABLED = env_bool("ANSWER_CACHE_ENABLED", True)
+# Similitud coseno mínima para considerar dos preguntas equivalentes
+ANSWER_CACHE_THRESHOLD = env_float("ANSWER_CACHE_THRESHOLD", 0.95)
+ANSWER_CACHE_TTL_SECONDS = env_int("ANSWER_CACHE_TTL_SECONDS", 3600)
+ANSWER_CACHE_MAX_ENTRIES = env_int("ANSWER_CACHE_MAX_ENTRIES", 2000)
+# Cada cuánto se consulta la versión de ingesta de la colección
+ANSWER_CACHE_VERSION_CHECK_SECONDS = env_float("ANSWER_CACHE_VERSION_CHECK_SECONDS", 5.0)
+
+# Streaming SSE: agrupar tokens en frames por tamaño o por tiempo
+STREAM_COALESCE = env_bool("STREAM_COALESCE", True)
+STREAM_FLUSH_INTERVAL_MS = env_int("STREAM_FLUSH_INTERVAL_MS", 40)
+STREAM_FLUSH_CHARS = env_int("STREAM_FLUSH_CHARS", 512)
+
+# Métricas: fracción de requests (0-1) que dejan un log estructurado con sus tiempos
+METRICS_LOG_SAMPLE_RATE = env_float("METRICS_LOG_SAMPLE_RATE", 0.1)
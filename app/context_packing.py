@@ -0,0 +1,90 @@
+from typing import Dict, List, Optional
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+
+from app.config import CONTEXT_DEDUP_THRESHOLD, CONTEXT_TOKEN_BUDGET
+from app.metrics import stage
+from app.retrieval import VectorSearcher
+from app.tokens import count_tokens
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    return vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+
+def _tokens(doc: Document) -> int:
+    # Precalculado en la ingesta; los chunks indexados antes se cuentan aquí
+    tokens = doc.metadata.get("tokens")
+    return int(tokens) if tokens is not None else count_tokens(doc.page_content)
+
+
+class ContextPacker:
+    """Etapa entre la recuperación y ANSWER_PROMPT.
+
+    Ordena los documentos por score de fusión (o por el orden del retriever),
+    descarta los casi-duplicados de uno ya elegido (similitud coseno de sus
+    embeddings >= `dedup_threshold`) y llena hasta `token_budget` tokens.
+    Los embeddings salen del vector store (por id) y, para los que no, de la
+    caché de embeddings.
+    """
+
+    def __init__(self, searcher: Optional[VectorSearcher], embeddings: Embeddings,
+                 token_budget: int = CONTEXT_TOKEN_BUDGET, dedup_threshold: float = CONTEXT_DEDUP_THRESHOLD):
+        self.searcher = searcher
+        self.embeddings = embeddings
+        self.token_budget = token_budget
+        self.dedup_threshold = dedup_threshold
+        self.stats = {"packed": 0, "docs_in": 0, "docs_out": 0, "duplicates": 0, "over_budget": 0, "tokens_out": 0}
+
+    async def _vectors(self, docs: List[Document]) -> np.ndarray:
+        ids = [doc.metadata.get("id") for doc in docs]
+        found: Dict[str, List[float]] = {}
+        known_ids = [chunk_id for chunk_id in ids if chunk_id]
+        if self.searcher is not None and known_ids:
+            found = await self.searcher.avectors(known_ids)
+        missing = [i for i, chunk_id in enumerate(ids) if chunk_id not in found]
+        embedded = await self.embeddings.aembed_documents([docs[i].page_content for i in missing]) if missing else []
+        by_position = dict(zip(missing, embedded))
+        rows = [found[chunk_id] if chunk_id in found else by_position[i] for i, chunk_id in enumerate(ids)]
+        return _normalize(np.asarray(rows, dtype=np.float32))
+
+    async def apack(self, docs: List[Document]) -> List[Document]:
+        if len(docs) <= 1:
+            return docs
+        with stage("context_packing"):
+            # sorted es estable: sin score de fusión se conserva el orden del retriever
+            ranked = sorted(docs, key=lambda doc: doc.metadata.get("rrf_score", 0.0), reverse=True)
+            vectors = await self._vectors(ranked)
+
+            kept: List[int] = []
+            used = 0
+            duplicates = over_budget = 0
+            for i, doc in enumerate(ranked):
+                if kept and float(np.max(vectors[kept] @ vectors[i])) >= self.dedup_threshold:
+                    duplicates += 1
+                    continue
+                tokens = _tokens(doc)
+                # El mejor documento entra siempre; el resto solo si cabe
+                if kept and used + tokens > self.token_budget:
+                    over_budget += 1
+                    continue
+                kept.append(i)
+                used += tokens
+
+        self.stats["packed"] += 1
+        self.stats["docs_in"] += len(docs)
+        self.stats["docs_out"] += len(kept)
+        self.stats["duplicates"] += duplicates
+        self.stats["over_budget"] += over_budget
+        self.stats["tokens_out"] += used
+        return [ranked[i] for i in kept]
+
+    def snapshot(self) -> Dict:
+        packed = self.stats["packed"]
+        return {
+            **self.stats,
+            "avg_docs_out": round(self.stats["docs_out"] / packed, 2) if packed else 0.0,
+            "avg_tokens_out": round(self.stats["tokens_out"] / packed, 1) if packed else 0.0,
+        }
@@ -0,0 +1,73 @@
+import asyncio
+import re
+import time
+from contextlib import asynccontextmanager
+from typing import Dict
+
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
+
+
+def async_url(url: str) -> str:
+    """Forzar el driver async de psycopg 3 en una URL de PostgreSQL"""
+    return re.sub(r"^postgresql(\+\w+)?://", "postgresql+psycopg://", url)
+
+
+class PooledDatabase:
+    """Engine async con pool de conexiones y métricas de espera del pool"""
+
+    def __init__(self, url: str, pool_size: int, max_overflow: int, pool_timeout: float, **engine_kwargs):
+        self.engine: AsyncEngine = create_async_engine(
+            async_url(url),
+            pool_size=pool_size,
+            max_overflow=max_overflow,
+            pool_timeout=pool_timeout,
+            pool_pre_ping=True,
+            **engine_kwargs,
+        )
+        self.acquisitions = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+
+    def _record_wait(self, seconds: float):
+        self.acquisitions += 1
+        self.wait_seconds_total += seconds
+        self.wait_seconds_max = max(self.wait_seconds_max, seconds)
+
+    @asynccontextmanager
+    async def connect(self):
+        started = time.perf_counter()
+        async with self.engine.connect() as conn:
+            self._record_wait(time.perf_counter() - started)
+            yield conn
+
+    @asynccontextmanager
+    async def begin(self):
+        started = time.perf_counter()
+        async with self.engine.begin() as conn:
+            self._record_wait(time.perf_counter() - started)
+            yield conn
+
+    async def prefill(self, connections: int):
+        """Abrir `connections` conexiones a la vez y devolverlas al pool:
+        los primeros requests no pagan el handshake"""
+        opened = [self.engine.connect() for _ in range(connections)]
+        try:
+            await asyncio.gather(*(conn.start() for conn in opened))
+        finally:
+            await asyncio.gather(*(conn.close() for conn in opened), return_exceptions=True)
+
+    def pool_stats(self) -> Dict:
+        pool = self.engine.sync_engine.pool
+        return {
+            "size": pool.size(),
+            "checked_out": pool.checkedout(),
+            "checked_in": pool.checkedin(),
+            "overflow": pool.overflow(),
+            "acquisitions": self.acquisitions,
+            "wait_seconds_total": round(self.wait_seconds_total, 4),
+            "wait_seconds_avg": round(self.wait_seconds_total / self.acquisitions, 6) if self.acquisitions else 0.0,
+            "wait_seconds_max": round(self.wait_seconds_max, 4),
+        }
+
+    async def dispose(self):
+        await self.engine.dispose()
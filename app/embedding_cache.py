@@ -0,0 +1,209 @@
+import asyncio
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from array import array
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+from langchain_core.embeddings import Embeddings
+from langchain_openai import OpenAIEmbeddings
+
+from app.config import (
+    EMBEDDING_CACHE_ENABLED,
+    EMBEDDING_CACHE_MAX_MB,
+    EMBEDDING_CACHE_MEMORY_ITEMS,
+    EMBEDDING_CACHE_PATH,
+    EMBEDDING_MODEL,
+    MODEL_SCHEDULER,
+)
+from app.scheduling import ScheduledEmbeddings, scheduler_for
+
+# Cada cuántas inserciones se revisa el tamaño total del archivo
+EVICTION_CHECK_INTERVAL = 500
+
+
+def cache_key(model: str, text: str) -> bytes:
+    return hashlib.sha256(f"{model}\0{text}".encode("utf-8")).digest()
+
+
+class EmbeddingCache:
+    """Caché de embeddings en disco (SQLite) con un LRU en memoria delante.
+
+    Los vectores se guardan como float32 empaquetados. Cuando el archivo
+    supera `max_bytes` se expulsan las entradas usadas hace más tiempo.
+    Varios procesos (servidor y cargador) pueden compartir el mismo archivo.
+    """
+
+    def __init__(self, path: str, max_bytes: int, memory_items: int):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.memory_items = memory_items
+        self._memory: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self._inserts_since_check = 0
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            " key BLOB PRIMARY KEY,"
+            " vector BLOB NOT NULL,"
+            " last_used REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS ix_embeddings_last_used ON embeddings (last_used)")
+
+    def _remember(self, key: bytes, vector: List[float]):
+        self._memory[key] = vector
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_items:
+            self._memory.popitem(last=False)
+
+    def get_many(self, keys: List[bytes]) -> List[Optional[List[float]]]:
+        results: List[Optional[List[float]]] = [None] * len(keys)
+        missing: Dict[bytes, List[int]] = {}
+
+        with self._lock:
+            for i, key in enumerate(keys):
+                vector = self._memory.get(key)
+                if vector is not None:
+                    self._memory.move_to_end(key)
+                    results[i] = vector
+                else:
+                    missing.setdefault(key, []).append(i)
+
+            if not missing:
+                return results
+
+            found = []
+            missing_keys = list(missing)
+            # SQLite limita el número de parámetros por consulta
+            for start in range(0, len(missing_keys), 500):
+                batch = missing_keys[start:start + 500]
+                placeholders = ",".join("?" * len(batch))
+                rows = self._conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", batch
+                ).fetchall()
+                for key, blob in rows:
+                    vector = array("f")
+                    vector.frombytes(blob)
+                    vector = vector.tolist()
+                    self._remember(key, vector)
+                    for i in missing[key]:
+                        results[i] = vector
+                    found.append(key)
+
+            if found:
+                now = time.time()
+                self._conn.executemany(
+                    "UPDATE embeddings SET last_used = ? WHERE key = ?",
+                    [(now, key) for key in found],
+                )
+
+        return results
+
+    def put_many(self, keys: List[bytes], vectors: List[List[float]]):
+        now = time.time()
+        rows = [(key, array("f", vector).tobytes(), now) for key, vector in zip(keys, vectors)]
+        with self._lock:
+            self._conn.execute("BEGIN")
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector, last_used) VALUES (?, ?, ?)", rows
+            )
+            self._conn.execute("COMMIT")
+            for key, vector in zip(keys, vectors):
+                self._remember(key, vector)
+
+            self._inserts_since_check += len(rows)
+            if self._inserts_since_check >= EVICTION_CHECK_INTERVAL:
+                self._inserts_since_check = 0
+                self._evict()
+
+    def _evict(self):
+        """Borrar las entradas menos usadas hasta quedar bajo el límite"""
+        total, count = self._conn.execute(
+            "SELECT COALESCE(SUM(LENGTH(vector)), 0), COUNT(*) FROM embeddings"
+        ).fetchone()
+        if total <= self.max_bytes or count == 0:
+            return
+        # Dejar margen (90%) para no expulsar en cada inserción
+        target = int(self.max_bytes * 0.9)
+        to_delete = int(count * (total - target) / total) + 1
+        self._conn.execute(
+            "DELETE FROM embeddings WHERE key IN "
+            "(SELECT key FROM embeddings ORDER BY last_used ASC LIMIT ?)",
+            (to_delete,),
+        )
+
+
+class CachedEmbeddings(Embeddings):
+    """Envoltorio de un modelo de embeddings que consulta la caché primero"""
+
+    def __init__(self, underlying: Embeddings, model: str, cache: EmbeddingCache):
+        self.underlying = underlying
+        self.model = model
+        self.cache = cache
+        self.stats = {"hits": 0, "misses": 0, "calls": 0}
+
+    def _split(self, texts: List[str]):
+        keys = [cache_key(self.model, text) for text in texts]
+        vectors = self.cache.get_many(keys)
+        # Textos repetidos dentro del mismo lote se embeben una sola vez
+        pending: Dict[bytes, str] = {}
+        for key, text, vector in zip(keys, texts, vectors):
+            if vector is None:
+                pending.setdefault(key, text)
+        self.stats["hits"] += len(texts) - sum(1 for v in vectors if v is None)
+        self.stats["misses"] += len(pending)
+        return keys, vectors, pending
+
+    def _merge(self, keys, vectors, pending, new_vectors):
+        computed = dict(zip(pending, new_vectors))
+        self.cache.put_many(list(computed), list(computed.values()))
+        return [vector if vector is not None else computed[key] for key, vector in zip(keys, vectors)]
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        keys, vectors, pending = self._split(texts)
+        new_vectors = []
+        if pending:
+            self.stats["calls"] += 1
+            new_vectors = self.underlying.embed_documents(list(pending.values()))
+        return self._merge(keys, vectors, pending, new_vectors)
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        keys, vectors, pending = await asyncio.to_thread(self._split, texts)
+        new_vectors = []
+        if pending:
+            self.stats["calls"] += 1
+            new_vectors = await self.underlying.aembed_documents(list(pending.values()))
+        return await asyncio.to_thread(self._merge, keys, vectors, pending, new_vectors)
+
+    async def aembed_query(self, text: str) -> List[float]:
+        return (await self.aembed_documents([text]))[0]
+
+
+def build_embeddings(model: str = EMBEDDING_MODEL, tpm_share: float = 1.0, **client_kwargs) -> Embeddings:
+    """Crear el modelo de embeddings, con caché en disco si está habilitada.
+
+    Las llamadas a la API pasan por el scheduler del modelo con `tpm_share`
+    de su presupuesto de tokens por minuto. `client_kwargs` (p. ej.
+    http_client / http_async_client) van a OpenAIEmbeddings.
+    """
+    embeddings = OpenAIEmbeddings(model=model, **client_kwargs)
+    if MODEL_SCHEDULER:
+        embeddings = ScheduledEmbeddings(embeddings, scheduler_for("embedding", model, tpm_share))
+    if not EMBEDDING_CACHE_ENABLED:
+        return embeddings
+    cache = EmbeddingCache(
+        EMBEDDING_CACHE_PATH,
+        max_bytes=EMBEDDING_CACHE_MAX_MB * 1024 * 1024,
+        memory_items=EMBEDDING_CACHE_MEMORY_ITEMS,
+    )
+    return CachedEmbeddings(embeddings, model, cache)
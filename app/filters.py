@@ -0,0 +1,46 @@
+import os
+from typing import Dict, Optional, Tuple
+
+from app.config import METADATA_FILTER_KEYS, PDF_DIRECTORY
+
+# Filtro de metadata normalizado: ((clave, (valor, ...)), ...) ordenado, así
+# sirve de clave para single-flight y para agrupar los micro-lotes
+MetadataFilter = Tuple[Tuple[str, Tuple[str, ...]], ...]
+
+
+def normalize_filters(filters: Optional[Dict]) -> Optional[MetadataFilter]:
+    """Validar los filtros de un request: {clave: valor | [valores]} con claves de METADATA_FILTER_KEYS.
+
+    Los valores se comparan como texto. Un `source` relativo (el nombre que
+    muestra /stream) se resuelve contra PDF_DIRECTORY, igual que la ruta que
+    guarda la ingesta. ValueError si una clave no es filtrable o no trae valores.
+    """
+    if not filters:
+        return None
+    normalized = []
+    for key, value in filters.items():
+        if key not in METADATA_FILTER_KEYS:
+            raise ValueError(f"Unsupported filter key: {key} (allowed: {', '.join(METADATA_FILTER_KEYS)})")
+        values = {str(item) for item in (value if isinstance(value, (list, tuple)) else [value]) if item is not None}
+        if key == "source":
+            values = {os.path.join(PDF_DIRECTORY, item) for item in values}
+        if not values:
+            raise ValueError(f"Filter {key} has no values")
+        normalized.append((key, tuple(sorted(values))))
+    return tuple(sorted(normalized))
+
+
+def matches_filters(metadata: Dict, filters: Optional[MetadataFilter]) -> bool:
+    return not filters or all(key in metadata and str(metadata[key]) in values for key, values in filters)
+
+
+def store_filter(filters: MetadataFilter) -> Dict:
+    """El filtro en la sintaxis de los VectorStore de LangChain ({"clave": {"in": [...]}})"""
+    return {key: {"in": list(values)} for key, values in filters}
+
+
+def from_store_filter(filter: Optional[Dict]) -> Optional[MetadataFilter]:
+    """Inversa de store_filter (para MmapVectorStore)"""
+    if not filter:
+        return None
+    return tuple(sorted((key, tuple(sorted(condition["in"]))) for key, condition in filter.items()))
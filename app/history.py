@@ -0,0 +1,204 @@
+import asyncio
+import json
+from typing import Dict, List, Optional, Tuple
+
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage
+from sqlalchemy import text
+
+from app.config import (
+    HISTORY_DATABASE_URL,
+    HISTORY_MAX_MESSAGES,
+    HISTORY_MAX_OVERFLOW,
+    HISTORY_POOL_SIZE,
+    HISTORY_POOL_TIMEOUT,
+)
+from app.db import PooledDatabase
+from app.tokens import count_tokens
+
+# Misma tabla que usa PostgresChatMessageHistory de LangChain
+SCHEMA_STATEMENTS = [
+    "CREATE TABLE IF NOT EXISTS message_store ("
+    " id SERIAL PRIMARY KEY,"
+    " session_id TEXT NOT NULL,"
+    " message JSONB NOT NULL)",
+    "CREATE INDEX IF NOT EXISTS ix_message_store_session_id_id ON message_store (session_id, id)",
+    # Resumen acumulado de los turnos que ya no entran en el presupuesto de tokens
+    "CREATE TABLE IF NOT EXISTS message_summary ("
+    " session_id TEXT PRIMARY KEY,"
+    " summary TEXT NOT NULL,"
+    " last_message_id INTEGER NOT NULL,"
+    " updated_at TIMESTAMPTZ NOT NULL DEFAULT now())",
+]
+
+# Los últimos N mensajes, devueltos en orden cronológico
+LOAD_RECENT_SQL = text(
+    "SELECT message FROM ("
+    " SELECT id, message FROM message_store"
+    " WHERE session_id = :session_id ORDER BY id DESC LIMIT :limit"
+    ") recent ORDER BY id ASC"
+)
+
+LOAD_SUMMARY_SQL = text(
+    "SELECT summary, last_message_id FROM message_summary WHERE session_id = :session_id"
+)
+
+# Los últimos N mensajes posteriores al resumen, en orden cronológico
+LOAD_RECENT_AFTER_SQL = text(
+    "SELECT id, message FROM ("
+    " SELECT id, message FROM message_store"
+    " WHERE session_id = :session_id AND id > :after_id ORDER BY id DESC LIMIT :limit"
+    ") recent ORDER BY id ASC"
+)
+
+# Mensajes aún sin resumir, los más viejos primero
+LOAD_RANGE_SQL = text(
+    "SELECT id, message FROM message_store"
+    " WHERE session_id = :session_id AND id > :after_id AND id < :before_id"
+    " ORDER BY id ASC LIMIT :limit"
+)
+
+# Un resumen solo avanza: una tarea atrasada no pisa uno más nuevo
+SAVE_SUMMARY_SQL = text(
+    "INSERT INTO message_summary (session_id, summary, last_message_id) "
+    "VALUES (:session_id, :summary, :last_message_id) "
+    "ON CONFLICT (session_id) DO UPDATE SET "
+    "summary = EXCLUDED.summary, last_message_id = EXCLUDED.last_message_id, updated_at = now() "
+    "WHERE message_summary.last_message_id < EXCLUDED.last_message_id"
+)
+
+# Pregunta y respuesta en un solo INSERT de dos filas
+SAVE_TURN_SQL = text(
+    "INSERT INTO message_store (session_id, message) VALUES "
+    "(:session_id, CAST(:human AS jsonb)), (:session_id, CAST(:ai AS jsonb))"
+)
+
+
+def _to_message(msg_data: Dict) -> Optional[BaseMessage]:
+    """Convertir el JSONB guardado a un mensaje de LangChain"""
+    content = msg_data.get("data", {}).get("content", "")
+    if msg_data.get("type") == "human":
+        return HumanMessage(content=content)
+    if msg_data.get("type") == "ai":
+        return AIMessage(content=content)
+    return None
+
+
+def _to_json(message_type: str, content: str) -> str:
+    return json.dumps({"type": message_type, "data": {"content": content, "type": message_type}})
+
+
+def split_by_budget(messages: List[Tuple[int, BaseMessage]], token_budget: int) -> int:
+    """Posición desde la que los mensajes (id, mensaje) entran en `token_budget`.
+
+    Se cuentan turnos completos desde el más reciente; el último turno se
+    conserva siempre aunque por sí solo supere el presupuesto.
+    """
+    used = 0
+    start = len(messages)
+    position = len(messages)
+    while position > 0:
+        # Un turno: la respuesta y la pregunta que la precede
+        turn_start = position - 1
+        if isinstance(messages[turn_start][1], AIMessage) and turn_start > 0:
+            turn_start -= 1
+        tokens = sum(
+            count_tokens(f"{message.type}: {message.content}") for _, message in messages[turn_start:position]
+        )
+        if used + tokens > token_budget and start < len(messages):
+            break
+        used += tokens
+        start = turn_start
+        position = turn_start
+    return start
+
+
+class ChatHistoryStore:
+    """Historial de chat sobre un pool async de conexiones (no bloquea el event loop)"""
+
+    def __init__(self, url: str = HISTORY_DATABASE_URL, max_messages: int = HISTORY_MAX_MESSAGES):
+        self.db = PooledDatabase(url, HISTORY_POOL_SIZE, HISTORY_MAX_OVERFLOW, HISTORY_POOL_TIMEOUT)
+        self.max_messages = max_messages
+        self._schema_ready = False
+        self._schema_lock = asyncio.Lock()
+
+    async def ensure_schema(self):
+        if self._schema_ready:
+            return
+        async with self._schema_lock:
+            if self._schema_ready:
+                return
+            async with self.db.begin() as conn:
+                for statement in SCHEMA_STATEMENTS:
+                    await conn.execute(text(statement))
+            self._schema_ready = True
+
+    async def warmup(self, connections: int):
+        """Crear el esquema y dejar `connections` conexiones abiertas en el pool"""
+        await self.ensure_schema()
+        await self.db.prefill(connections)
+
+    async def load(self, session_id: str, limit: Optional[int] = None) -> List[BaseMessage]:
+        """Cargar solo los últimos `limit` mensajes de la sesión"""
+        await self.ensure_schema()
+        async with self.db.connect() as conn:
+            result = await conn.execute(
+                LOAD_RECENT_SQL,
+                {"session_id": session_id, "limit": limit or self.max_messages},
+            )
+            rows = result.fetchall()
+        messages = [_to_message(row[0]) for row in rows]
+        return [message for message in messages if message is not None]
+
+    async def load_context(self, session_id: str, limit: Optional[int] = None) -> Tuple[Optional[str], int, List[Tuple[int, BaseMessage]]]:
+        """Resumen de la sesión, id del último mensaje resumido y los últimos
+        `limit` mensajes posteriores (con su id), en una sola conexión"""
+        await self.ensure_schema()
+        async with self.db.connect() as conn:
+            row = (await conn.execute(LOAD_SUMMARY_SQL, {"session_id": session_id})).first()
+            summary, last_message_id = (row[0], row[1]) if row else (None, 0)
+            result = await conn.execute(
+                LOAD_RECENT_AFTER_SQL,
+                {"session_id": session_id, "after_id": last_message_id, "limit": limit or self.max_messages},
+            )
+            rows = result.fetchall()
+        messages = [(row[0], _to_message(row[1])) for row in rows]
+        return summary, last_message_id, [(message_id, message) for message_id, message in messages if message is not None]
+
+    async def load_range(self, session_id: str, after_id: int, before_id: int, limit: int) -> List[Tuple[int, BaseMessage]]:
+        """Mensajes con after_id < id < before_id, los más viejos primero"""
+        await self.ensure_schema()
+        async with self.db.connect() as conn:
+            result = await conn.execute(
+                LOAD_RANGE_SQL,
+                {"session_id": session_id, "after_id": after_id, "before_id": before_id, "limit": limit},
+            )
+            rows = result.fetchall()
+        messages = [(row[0], _to_message(row[1])) for row in rows]
+        return [(message_id, message) for message_id, message in messages if message is not None]
+
+    async def save_summary(self, session_id: str, summary: str, last_message_id: int):
+        await self.ensure_schema()
+        async with self.db.begin() as conn:
+            await conn.execute(
+                SAVE_SUMMARY_SQL,
+                {"session_id": session_id, "summary": summary, "last_message_id": last_message_id},
+            )
+
+    async def save(self, session_id: str, human_message: str, ai_message: str):
+        """Guardar un turno completo (pregunta + respuesta) en un solo round-trip"""
+        await self.ensure_schema()
+        async with self.db.begin() as conn:
+            await conn.execute(
+                SAVE_TURN_SQL,
+                {
+                    "session_id": session_id,
+                    "human": _to_json("human", human_message),
+                    "ai": _to_json("ai", ai_message),
+                },
+            )
+
+    def stats(self) -> Dict:
+        return self.db.pool_stats()
+
+    async def close(self):
+        await self.db.dispose()
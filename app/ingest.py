@@ -0,0 +1,671 @@
+import fcntl
+import hashlib
+import json
+import os
+import threading
+import time
+import uuid
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+from itertools import chain
+from typing import Callable, Dict, List, Optional, Tuple
+
+import sqlalchemy
+from langchain_community.vectorstores.pgvector import PGVector
+from langchain_core.documents import Document
+
+from app.config import (
+    COLLECTION_NAME,
+    DATABASE_URL,
+    EMBEDDING_DIMENSIONS,
+    EMBEDDING_MODEL,
+    INGEST_MANIFEST_PATH,
+    INGEST_TPM_SHARE,
+    LEXICAL_INDEX_ENABLED,
+    LEXICAL_INDEX_PATH,
+    PDF_DIRECTORY,
+    VECTOR_BACKEND,
+    VECTOR_BULK_COPY,
+    VECTOR_INDEX_TYPE,
+)
+from app.chunking import build_text_splitter, chunker_profile
+from app.embedding_cache import build_embeddings
+from app.ingest_pipeline import CountingEmbeddings, run_pipeline
+from app.lexical import BM25Index
+from app.mmap_index import MmapVectorStore
+from app.pgvector_admin import (
+    BUMP_INGEST_VERSION_SQL,
+    collection_for,
+    copy_swap_chunks,
+    count_collection_rows,
+    delete_collection_rows,
+    ensure_indexes,
+    ensure_ingest_version_table,
+    iter_collection_documents,
+    shard_collections,
+)
+from app.scheduling import INGEST, set_process_priority
+
+MANIFEST_VERSION = 1
+
+# Vector store por colección del corpus (una sola sin COLLECTION_SHARDS)
+Stores = Dict[str, object]
+
+# Namespace fijo para que los ids de los chunks sean deterministas:
+# el mismo archivo con el mismo contenido y modelo siempre produce los mismos ids.
+CHUNK_NAMESPACE = uuid.UUID("6f1c6f0e-5b7a-4c1e-9a43-2d0f6c8f1e64")
+
+
+# ========== MANIFIESTO ==========
+
+def file_sha256(path: str) -> str:
+    """Calcular el hash SHA-256 del contenido de un archivo"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def empty_manifest() -> Dict:
+    return {
+        "version": MANIFEST_VERSION,
+        "collection": COLLECTION_NAME,
+        "shards": len(shard_collections()),
+        "files": {},
+    }
+
+
+def _read_manifest(path: str) -> Optional[Dict]:
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _layout_matches(manifest: Dict) -> bool:
+    """El manifiesto es de esta versión, colección y cantidad de shards"""
+    return (
+        manifest.get("version") == MANIFEST_VERSION
+        and manifest.get("collection") == COLLECTION_NAME
+        # Otra cantidad de shards reparte los archivos distinto
+        and manifest.get("shards", 1) == len(shard_collections())
+    )
+
+
+def load_manifest(path: str = INGEST_MANIFEST_PATH) -> Dict:
+    """Leer el manifiesto de ingesta (o uno vacío si no existe o es de otro formato/colección/shards)"""
+    manifest = _read_manifest(path)
+    if manifest is None or not _layout_matches(manifest):
+        return empty_manifest()
+    return manifest
+
+
+def stale_collections(path: str = INGEST_MANIFEST_PATH) -> Optional[List[str]]:
+    """Colecciones a vaciar con un run completo pendiente, o None si se puede ingerir incremental.
+
+    Con un manifiesto de otro formato o de otra cantidad de shards, un run
+    incremental reinsertaría todo sin borrar las filas del reparto anterior:
+    hace falta un run completo que termine con delete_orphans y vacíe los
+    shards que ya no existen. Hasta que termina, el manifiesto nuevo los
+    guarda en `stale_collections`, así que un run cortado también se retoma
+    completo. Con otra COLLECTION_NAME la colección anterior no se toca.
+    """
+    manifest = _read_manifest(path)
+    if manifest is None:
+        return None
+    if _layout_matches(manifest):
+        return manifest.get("stale_collections")
+    stale = []
+    if manifest.get("collection") == COLLECTION_NAME:
+        stale = list(manifest.get("stale_collections") or []) + shard_collections(manifest.get("shards", 1))
+    return sorted(set(stale) - set(shard_collections()))
+
+
+def save_manifest(manifest: Dict, path: str = INGEST_MANIFEST_PATH):
+    """Escribir el manifiesto de forma atómica (archivo temporal + rename)"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def chunk_ids_for(rel_path: str, content_hash: str, model: str, count: int, chunker: Optional[str] = None) -> List[str]:
+    """Ids deterministas para los chunks de un archivo (ruta, contenido, modelo y modo de chunking).
+
+    La ruta es parte del id: dos copias del mismo PDF en rutas distintas son
+    dueñas de filas distintas, y reemplazar o borrar una no toca la otra.
+    """
+    chunker = chunker or chunker_profile()
+    return [str(uuid.uuid5(CHUNK_NAMESPACE, f"{rel_path}:{content_hash}:{model}:{chunker}:{i}")) for i in range(count)]
+
+
+def entry_is_current(entry: Optional[Dict], model: str = EMBEDDING_MODEL) -> bool:
+    """La entrada del manifiesto se generó con el modelo y el modo de chunking actuales"""
+    return bool(entry) and entry.get("embedding_model") == model and entry.get("chunker") == chunker_profile()
+
+
+def list_pdfs(pdf_dir: str = PDF_DIRECTORY) -> Dict[str, str]:
+    """Mapa ruta relativa -> ruta absoluta de todos los PDFs del directorio"""
+    found = {}
+    for root, _, filenames in os.walk(pdf_dir):
+        for filename in filenames:
+            if filename.lower().endswith(".pdf"):
+                full_path = os.path.join(root, filename)
+                found[os.path.relpath(full_path, pdf_dir)] = full_path
+    return found
+
+
+def plan_file(manifest: Dict, rel_path: str, full_path: str, model: str = EMBEDDING_MODEL,
+              content_hash: Optional[str] = None) -> Optional[Dict]:
+    """Item a procesar si el archivo es nuevo o cambió respecto al manifiesto, si no None"""
+    stat = os.stat(full_path)
+    entry = manifest["files"].get(rel_path)
+
+    # Atajo: mismo tamaño, misma fecha, mismo modelo y mismo chunking -> sin cambios
+    if (
+        entry_is_current(entry, model)
+        and entry.get("size") == stat.st_size
+        and entry.get("mtime") == stat.st_mtime
+    ):
+        return None
+
+    content_hash = content_hash or file_sha256(full_path)
+    if entry_is_current(entry, model) and entry.get("sha256") == content_hash:
+        # Solo cambió la fecha; actualizar el manifiesto sin reprocesar
+        entry["size"] = stat.st_size
+        entry["mtime"] = stat.st_mtime
+        return None
+
+    return {
+        "rel_path": rel_path,
+        "path": full_path,
+        "sha256": content_hash,
+        "size": stat.st_size,
+        "mtime": stat.st_mtime,
+        "old_chunk_ids": entry.get("chunk_ids", []) if entry else [],
+    }
+
+
+def plan_ingest(manifest: Dict, pdf_dir: str = PDF_DIRECTORY, model: str = EMBEDDING_MODEL) -> Tuple[List[Dict], Dict[str, Dict]]:
+    """Comparar el directorio con el manifiesto.
+
+    Devuelve (archivos nuevos o modificados, entradas de archivos eliminados).
+    """
+    known = manifest["files"]
+    current = list_pdfs(pdf_dir)
+    changed = []
+
+    for rel_path, full_path in sorted(current.items()):
+        item = plan_file(manifest, rel_path, full_path, model)
+        if item:
+            changed.append(item)
+
+    removed = {rel_path: entry for rel_path, entry in known.items() if rel_path not in current}
+    return changed, removed
+
+
+def find_indexed(manifest: Dict, content_hash: str, model: str = EMBEDDING_MODEL) -> Optional[str]:
+    """Ruta relativa de un archivo ya indexado con ese contenido, si existe"""
+    for rel_path, entry in manifest["files"].items():
+        if entry.get("sha256") == content_hash and entry_is_current(entry, model):
+            return rel_path
+    return None
+
+
+# ========== PROCESAMIENTO ==========
+
+def build_stores(embeddings) -> Stores:
+    """Vector store de cada colección del backend configurado (VECTOR_BACKEND); prepara su esquema"""
+    if VECTOR_BACKEND == "mmap":
+        return {COLLECTION_NAME: MmapVectorStore(embeddings)}
+    stores = {
+        name: PGVector(
+            collection_name=name,
+            connection_string=DATABASE_URL,
+            embedding_function=embeddings,
+            embedding_length=EMBEDDING_DIMENSIONS,
+        )
+        for name in shard_collections()
+    }
+    ensure_ingest_version_table()
+    return stores
+
+
+def _mmap_store(stores: Stores) -> Optional[MmapVectorStore]:
+    store = next(iter(stores.values()))
+    return store if isinstance(store, MmapVectorStore) else None
+
+
+def finish_index(stores: Stores, rebuild: bool = False) -> Dict:
+    """Crear/actualizar los índices (ANN de cada colección y de metadata) después de escribir"""
+    store = _mmap_store(stores)
+    if store is not None:
+        return store.index.rebuild() if rebuild else store.index.describe()
+    return ensure_indexes(rebuild=rebuild)
+
+
+def build_lexical_index(stores: Stores, path: str = LEXICAL_INDEX_PATH) -> Dict:
+    """Reconstruir el índice BM25 con todos los chunks del corpus (todas las colecciones)"""
+    store = _mmap_store(stores)
+    if store is not None:
+        records = store.index.iter_documents()
+    else:
+        records = chain.from_iterable(iter_collection_documents(name) for name in stores)
+    index = BM25Index.build(records)
+    index.save(path)
+    return {"documents": len(index), "terms": len(index.postings)}
+
+
+def update_lexical_index(stores: Stores, removed_ids: List[str], added_ids: List[str],
+                         path: str = LEXICAL_INDEX_PATH) -> Dict:
+    """Quitar del índice BM25 los chunks reemplazados o borrados y agregar solo los nuevos.
+
+    Sin índice previo, o si no cuadra con el vector store (una ingesta que se
+    cortó antes de actualizarlo), se reconstruye completo.
+    """
+    if not os.path.exists(path):
+        return build_lexical_index(stores, path)
+    store = _mmap_store(stores)
+    if store is not None:
+        records = store.index.iter_documents(added_ids)
+        total = len(store.index)
+    else:
+        records = chain.from_iterable(iter_collection_documents(name, added_ids) for name in stores)
+        total = sum(count_collection_rows(name) for name in stores)
+    index = BM25Index.load(path).update(removed_ids, records)
+    if len(index) != total:
+        print(f"  ⚠️ BM25 index has {len(index)} chunks, vector store {total}: rebuilding it")
+        return build_lexical_index(stores, path)
+    index.save(path)
+    return {"documents": len(index), "terms": len(index.postings), "added": len(added_ids)}
+
+
+def _changed_chunk_ids(manifest: Dict, changed: List[Dict], removed: Optional[Dict[str, Dict]] = None) -> Tuple[List[str], List[str]]:
+    """(ids borrados, ids escritos) por el run: archivos eliminados y archivos confirmados"""
+    removed_ids = [chunk_id for entry in (removed or {}).values() for chunk_id in entry.get("chunk_ids", [])]
+    added_ids = []
+    for item in changed:
+        entry = manifest["files"].get(item["rel_path"])
+        # Un archivo cancelado antes de su commit conserva su entrada anterior
+        if entry and entry["sha256"] == item["sha256"]:
+            removed_ids.extend(item["old_chunk_ids"])
+            added_ids.extend(entry["chunk_ids"])
+    return removed_ids, added_ids
+
+
+def swap_chunks(store, delete_ids: List[str], chunks: List[Document], ids: List[str], vectors: List[List[float]],
+                collection_name: str = COLLECTION_NAME):
+    """Reemplazar chunks viejos por nuevos de una colección en una sola transacción.
+
+    Las consultas ven la versión anterior del archivo o la nueva, nunca
+    una mezcla ni un archivo a medio insertar.
+    """
+    if isinstance(store, MmapVectorStore):
+        # Una generación nueva del índice por lote, publicada de forma atómica
+        store.index.swap(delete_ids, chunks, ids, vectors)
+        return
+
+    if VECTOR_BULK_COPY:
+        # COPY binario: mucho más rápido que un INSERT por fila a través del ORM
+        copy_swap_chunks(delete_ids, chunks, ids, vectors, collection_name)
+        return
+
+    # Borrar también los ids nuevos hace que reintentar sea idempotente
+    stale_ids = list(set(delete_ids) | set(ids))
+    with store._make_session() as session:
+        collection = store.get_collection(session)
+        if collection is None:
+            raise ValueError(f"Collection {collection_name} not found")
+
+        if stale_ids:
+            session.query(store.EmbeddingStore).filter(
+                store.EmbeddingStore.collection_id == collection.uuid,
+                store.EmbeddingStore.custom_id.in_(stale_ids),
+            ).delete(synchronize_session=False)
+
+        for chunk, chunk_id, vector in zip(chunks, ids, vectors):
+            session.add(store.EmbeddingStore(
+                embedding=vector,
+                document=chunk.page_content,
+                cmetadata=chunk.metadata,
+                custom_id=chunk_id,
+                collection_id=collection.uuid,
+            ))
+
+        session.connection().exec_driver_sql(BUMP_INGEST_VERSION_SQL, {"name": COLLECTION_NAME})
+        session.commit()
+
+
+class IngestCancelled(Exception):
+    """La ingesta se canceló entre dos archivos"""
+
+
+@contextmanager
+def ingest_lock(manifest_path: str = INGEST_MANIFEST_PATH):
+    """Garantizar que solo una ingesta (script o job) corra a la vez"""
+    os.makedirs(os.path.dirname(manifest_path), exist_ok=True)
+    with open(f"{manifest_path}.lock", "w") as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            raise RuntimeError("Another ingest is already running")
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def swap_files(stores: Stores, entries: List[Tuple[str, List[str], List[Document], List[str], List[List[float]]]]):
+    """Reemplazar los chunks de varios archivos: (ruta relativa, ids viejos, chunks, ids, vectores).
+
+    Cada archivo va entero a su colección (collection_for); con shards el
+    lote se confirma en una transacción por colección, así que cada archivo
+    sigue siendo atómico.
+    """
+    by_collection = defaultdict(lambda: ([], [], [], []))
+    for rel_path, delete_ids, chunks, ids, vectors in entries:
+        group = by_collection[collection_for(rel_path)]
+        for target, values in zip(group, (delete_ids, chunks, ids, vectors)):
+            target.extend(values)
+    for name, (delete_ids, chunks, ids, vectors) in by_collection.items():
+        swap_chunks(stores[name], delete_ids, chunks, ids, vectors, name)
+
+
+def delete_orphans(stores: Stores, files: Dict[str, Dict]) -> int:
+    """Borrar de cada colección las filas que no pertenecen a ninguno de sus archivos del manifiesto.
+
+    Con shards también borra las copias de un archivo que quedaron en otra
+    colección tras cambiar COLLECTION_SHARDS.
+    """
+    store = _mmap_store(stores)
+    if store is not None:
+        return store.index.retain([chunk_id for entry in files.values() for chunk_id in entry["chunk_ids"]])
+    keep_ids = {name: [] for name in stores}
+    for rel_path, entry in files.items():
+        keep_ids[collection_for(rel_path)].extend(entry["chunk_ids"])
+    return sum(_delete_collection_orphans(store, keep_ids[name]) for name, store in stores.items())
+
+
+def _delete_collection_orphans(store, keep_ids: List[str]) -> int:
+    with store._make_session() as session:
+        collection = store.get_collection(session)
+        result = session.execute(
+            sqlalchemy.text(
+                "DELETE FROM langchain_pg_embedding "
+                "WHERE collection_id = :collection_id "
+                "AND (custom_id IS NULL OR NOT (custom_id = ANY(:keep_ids)))"
+            ),
+            {"collection_id": collection.uuid, "keep_ids": keep_ids},
+        )
+        session.connection().exec_driver_sql(BUMP_INGEST_VERSION_SQL, {"name": COLLECTION_NAME})
+        session.commit()
+        return result.rowcount
+
+
+def _new_stats(files_total: int) -> Dict:
+    return {
+        "files_total": files_total,
+        "files_parsed": 0,
+        "files_removed": 0,
+        "chunks_embedded": 0,
+        "rows_written": 0,
+        "rows_deleted": 0,
+        "elapsed_seconds": 0.0,
+        "chunks_per_second": 0.0,
+        "embedding_calls": {},
+        "stages": {},
+    }
+
+
+def _report(stats: Dict, start: float, on_progress: Optional[Callable[[Dict], None]]):
+    elapsed = time.time() - start
+    stats["elapsed_seconds"] = round(elapsed, 2)
+    stats["chunks_per_second"] = round(stats["chunks_embedded"] / elapsed, 2) if elapsed > 0 else 0.0
+    if on_progress:
+        on_progress(dict(stats))
+
+
+def _ingest_files(
+    changed: List[Dict],
+    manifest: Dict,
+    manifest_path: str,
+    stores: Stores,
+    embeddings,
+    stats: Dict,
+    start: float,
+    on_progress: Optional[Callable[[Dict], None]],
+    should_cancel: Optional[Callable[[], bool]],
+) -> bool:
+    """Pasar los archivos por el pipeline y confirmar cada lote. Devuelve si se canceló."""
+    # Las oraciones del splitter y los chunks comparten las mismas llamadas contadas
+    embeddings = CountingEmbeddings(embeddings)
+    text_splitter = build_text_splitter(embeddings)
+    lock = threading.Lock()
+    # mmap: los lotes se acumulan y el run publica una sola generación (ver
+    # MmapVectorIndex.batch); el manifiesto se guarda recién cuando está publicada
+    store = _mmap_store(stores)
+    buffered = store.index.batch() if store is not None else None
+
+    def commit_batch(batch):
+        files, entries = [], []
+        for item, file_chunks, file_vectors in batch:
+            file_ids = chunk_ids_for(item["rel_path"], item["sha256"], EMBEDDING_MODEL, len(file_chunks))
+            files.append((item["rel_path"], item["old_chunk_ids"], file_chunks, file_ids, file_vectors))
+            entries.append((item, file_ids))
+
+        swap_files(stores, files)
+
+        # El manifiesto se actualiza después de cada commit: si el proceso se
+        # interrumpe, el siguiente run retoma desde el último lote confirmado.
+        # Con mmap solo se guarda al final: si el run falla, los archivos se
+        # reprocesan y los ids deterministas hacen el swap idempotente
+        with lock:
+            for item, file_ids in entries:
+                manifest["files"][item["rel_path"]] = {
+                    "sha256": item["sha256"],
+                    "size": item["size"],
+                    "mtime": item["mtime"],
+                    "embedding_model": EMBEDDING_MODEL,
+                    "chunker": chunker_profile(),
+                    "chunk_ids": file_ids,
+                }
+                print(f"  ✅ {item['rel_path']}: {len(file_ids)} chunks")
+            if buffered is None:
+                save_manifest(manifest, manifest_path)
+            stats["rows_written"] += sum(len(file_ids) for _, file_ids in entries)
+            stats["rows_deleted"] += sum(len(item["old_chunk_ids"]) for item, _ in entries)
+
+    def on_stage_progress(stages: Dict):
+        with lock:
+            stats["stages"] = stages
+            stats["files_parsed"] = stages["parse"]["files"]
+            stats["chunks_embedded"] = stages["embed"]["items"]
+            stats["embedding_calls"] = embeddings.snapshot(stages["parse"]["items"], stages["chunk"]["items"])
+            _report(stats, start, on_progress)
+
+    with buffered or nullcontext():
+        result = run_pipeline(changed, text_splitter, embeddings, commit_batch, on_stage_progress, should_cancel)
+    if buffered is not None:
+        save_manifest(manifest, manifest_path)
+    on_stage_progress(result["stages"])
+    return result["cancelled"]
+
+
+def build_ingest_embeddings():
+    """Embeddings de la ingesta (siempre corre en su propio proceso): prioridad
+    `ingest` y solo INGEST_TPM_SHARE del presupuesto de tokens por minuto, que
+    comparte con el servidor la misma cuota del proveedor"""
+    set_process_priority(INGEST)
+    return build_embeddings(tpm_share=INGEST_TPM_SHARE)
+
+
+def run_incremental(
+    pdf_dir: str = PDF_DIRECTORY,
+    manifest_path: str = INGEST_MANIFEST_PATH,
+    on_progress: Optional[Callable[[Dict], None]] = None,
+    should_cancel: Optional[Callable[[], bool]] = None,
+) -> Dict:
+    """Procesar solo archivos nuevos o modificados y borrar los eliminados"""
+    with ingest_lock(manifest_path):
+        if stale_collections(manifest_path) is not None:
+            print("📂 Manifest from another format or shard layout: running a full ingest")
+            return _run_full(pdf_dir, manifest_path, on_progress, should_cancel)
+        start = time.time()
+        manifest = load_manifest(manifest_path)
+        changed, removed = plan_ingest(manifest, pdf_dir)
+
+        print(f"📂 {len(changed)} new/changed files, {len(removed)} removed, "
+              f"{len(manifest['files']) - len(removed)} tracked")
+
+        embeddings = build_ingest_embeddings()
+        stores = build_stores(embeddings)
+
+        stats = _new_stats(len(changed))
+        _report(stats, start, on_progress)
+
+        # Archivos eliminados: borrar sus chunks en una sola transacción (por colección)
+        if removed:
+            removed_ids = [chunk_id for entry in removed.values() for chunk_id in entry.get("chunk_ids", [])]
+            swap_files(stores, [(rel_path, entry.get("chunk_ids", []), [], [], []) for rel_path, entry in removed.items()])
+            for rel_path in removed:
+                del manifest["files"][rel_path]
+            save_manifest(manifest, manifest_path)
+            stats["files_removed"] = len(removed)
+            stats["rows_deleted"] += len(removed_ids)
+            _report(stats, start, on_progress)
+
+        cancelled = _ingest_files(changed, manifest, manifest_path, stores, embeddings, stats, start, on_progress, should_cancel)
+
+        # Persistir también las actualizaciones de fecha sin reprocesado
+        save_manifest(manifest, manifest_path)
+        stats["index"] = finish_index(stores)
+        if LEXICAL_INDEX_ENABLED and (changed or removed or not os.path.exists(LEXICAL_INDEX_PATH)):
+            stats["lexical_index"] = update_lexical_index(stores, *_changed_chunk_ids(manifest, changed, removed))
+        _report(stats, start, on_progress)
+
+        # Cada archivo se confirma completo o no se toca: lo cancelado queda pendiente para el próximo run
+        if cancelled:
+            raise IngestCancelled(f"Cancelled after {stats['rows_written']} rows written")
+        return stats
+
+
+def run_files(
+    rel_paths: List[str],
+    pdf_dir: str = PDF_DIRECTORY,
+    manifest_path: str = INGEST_MANIFEST_PATH,
+    on_progress: Optional[Callable[[Dict], None]] = None,
+    should_cancel: Optional[Callable[[], bool]] = None,
+) -> Dict:
+    """Indexar solo los archivos indicados (p. ej. recién subidos) sin recorrer el directorio"""
+    with ingest_lock(manifest_path):
+        if stale_collections(manifest_path) is not None:
+            print("📂 Manifest from another format or shard layout: running a full ingest")
+            return _run_full(pdf_dir, manifest_path, on_progress, should_cancel)
+        start = time.time()
+        manifest = load_manifest(manifest_path)
+        changed = []
+        for rel_path in rel_paths:
+            full_path = os.path.join(pdf_dir, rel_path)
+            if not os.path.exists(full_path):
+                print(f"  ⚠️ {rel_path}: not found, skipped")
+                continue
+            item = plan_file(manifest, rel_path, full_path)
+            if item:
+                changed.append(item)
+
+        print(f"📂 {len(changed)} of {len(rel_paths)} files to index")
+
+        embeddings = build_ingest_embeddings()
+        stores = build_stores(embeddings)
+
+        stats = _new_stats(len(changed))
+        _report(stats, start, on_progress)
+
+        cancelled = _ingest_files(changed, manifest, manifest_path, stores, embeddings, stats, start, on_progress, should_cancel)
+        save_manifest(manifest, manifest_path)
+        if changed:
+            stats["index"] = finish_index(stores)
+            if LEXICAL_INDEX_ENABLED:
+                stats["lexical_index"] = update_lexical_index(stores, *_changed_chunk_ids(manifest, changed))
+        _report(stats, start, on_progress)
+
+        if cancelled:
+            raise IngestCancelled(f"Cancelled after {stats['rows_written']} rows written")
+        return stats
+
+
+def run_full(
+    pdf_dir: str = PDF_DIRECTORY,
+    manifest_path: str = INGEST_MANIFEST_PATH,
+    on_progress: Optional[Callable[[Dict], None]] = None,
+    should_cancel: Optional[Callable[[], bool]] = None,
+) -> Dict:
+    """Reprocesar todos los archivos.
+
+    A diferencia del antiguo pre_delete_collection, la colección nunca queda
+    vacía: cada archivo se reemplaza en su transacción y al final se borran
+    las filas que ya no pertenecen a ningún archivo, incluidos los shards
+    que dejaron de existir (stale_collections).
+    """
+    with ingest_lock(manifest_path):
+        return _run_full(pdf_dir, manifest_path, on_progress, should_cancel)
+
+
+def _run_full(
+    pdf_dir: str,
+    manifest_path: str,
+    on_progress: Optional[Callable[[Dict], None]],
+    should_cancel: Optional[Callable[[], bool]],
+) -> Dict:
+    start = time.time()
+    stale = stale_collections(manifest_path)
+    previous = load_manifest(manifest_path)["files"]
+    # Se parte del manifiesto anterior y cada archivo confirmado reemplaza su
+    # entrada: si el run se corta, los archivos que no llegó a procesar siguen
+    # siendo dueños de sus filas y el próximo run no los duplica
+    manifest = empty_manifest()
+    manifest["files"] = {rel_path: dict(entry) for rel_path, entry in previous.items()}
+    if stale is not None:
+        manifest["stale_collections"] = stale
+    current = list_pdfs(pdf_dir)
+
+    changed = []
+    for rel_path, full_path in sorted(current.items()):
+        stat = os.stat(full_path)
+        changed.append({
+            "rel_path": rel_path,
+            "path": full_path,
+            "sha256": file_sha256(full_path),
+            "size": stat.st_size,
+            "mtime": stat.st_mtime,
+            "old_chunk_ids": previous.get(rel_path, {}).get("chunk_ids", []),
+        })
+
+    embeddings = build_ingest_embeddings()
+    stores = build_stores(embeddings)
+
+    stats = _new_stats(len(changed))
+    _report(stats, start, on_progress)
+
+    cancelled = _ingest_files(changed, manifest, manifest_path, stores, embeddings, stats, start, on_progress, should_cancel)
+    if cancelled:
+        raise IngestCancelled(f"Cancelled after {stats['rows_written']} rows written")
+
+    # Archivos que ya no están en el directorio: sus filas son huérfanas
+    for rel_path in [rel_path for rel_path in manifest["files"] if rel_path not in current]:
+        del manifest["files"][rel_path]
+    stats["rows_deleted"] += delete_orphans(stores, manifest["files"])
+    for name in manifest.pop("stale_collections", None) or []:
+        stats["rows_deleted"] += delete_collection_rows(name)
+    save_manifest(manifest, manifest_path)
+    # IVFFlat reentrena sus listas tras una recarga completa; HNSW se mantiene solo.
+    # El índice mmap recalcula sus particiones.
+    stats["index"] = finish_index(stores, rebuild=VECTOR_BACKEND == "mmap" or VECTOR_INDEX_TYPE == "ivfflat")
+    if LEXICAL_INDEX_ENABLED:
+        stats["lexical_index"] = build_lexical_index(stores)
+    _report(stats, start, on_progress)
+    return stats
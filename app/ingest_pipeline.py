@@ -0,0 +1,290 @@
+import multiprocessing
+import queue
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from typing import Callable, Dict, List, Optional
+
+from langchain_community.document_loaders import PyPDFLoader
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+
+from app.config import (
+    INGEST_CHUNK_WORKERS,
+    INGEST_EMBED_BATCH_SIZE,
+    INGEST_EMBED_CONCURRENCY,
+    INGEST_PARSE_WORKERS,
+    INGEST_QUEUE_SIZE,
+    INGEST_WRITE_BATCH_ROWS,
+)
+from app.tokens import count_tokens
+
+# Marca de fin de flujo entre etapas
+_DONE = object()
+
+STAGES = ("parse", "chunk", "embed", "write")
+
+
+def parse_pdf(path: str) -> List[Document]:
+    """Parsear un PDF (se ejecuta en un proceso del pool, fuera del GIL del pipeline)"""
+    return PyPDFLoader(path).load()
+
+
+class CountingEmbeddings(Embeddings):
+    """Cuenta las llamadas y textos que la ingesta pide al modelo de embeddings
+    (antes de la caché), compartido por el splitter y la etapa de embeddings"""
+
+    def __init__(self, underlying: Embeddings):
+        self.underlying = underlying
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.texts = 0
+
+    def _count(self, texts: int):
+        with self._lock:
+            self.calls += 1
+            self.texts += texts
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        self._count(len(texts))
+        return self.underlying.embed_documents(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        self._count(1)
+        return self.underlying.embed_query(text)
+
+    def snapshot(self, pages: int, chunks: int) -> Dict:
+        with self._lock:
+            calls, texts = self.calls, self.texts
+        return {
+            "calls": calls,
+            "texts": texts,
+            "calls_per_page": round(calls / pages, 3) if pages else 0.0,
+            "texts_per_chunk": round(texts / chunks, 3) if chunks else 0.0,
+        }
+
+
+class PipelineStats:
+    """Contadores por etapa: elementos procesados y tiempo ocupado"""
+
+    def __init__(self, listener: Optional[Callable[[Dict], None]] = None, interval: float = 0.5):
+        self._lock = threading.Lock()
+        self.start = time.time()
+        self.stages = {stage: {"files": 0, "items": 0, "busy_seconds": 0.0} for stage in STAGES}
+        self.listener = listener
+        self.interval = interval
+        self._last_emit = 0.0
+
+    def record(self, stage: str, items: int, seconds: float, files: int = 1):
+        with self._lock:
+            entry = self.stages[stage]
+            entry["files"] += files
+            entry["items"] += items
+            entry["busy_seconds"] += seconds
+            now = time.time()
+            emit = self.listener is not None and now - self._last_emit >= self.interval
+            if emit:
+                self._last_emit = now
+        if emit:
+            self.listener(self.snapshot())
+
+    def snapshot(self) -> Dict:
+        elapsed = max(time.time() - self.start, 1e-9)
+        with self._lock:
+            return {
+                stage: {
+                    **entry,
+                    "busy_seconds": round(entry["busy_seconds"], 2),
+                    # Throughput respecto al tiempo total del run
+                    "items_per_second": round(entry["items"] / elapsed, 2),
+                }
+                for stage, entry in self.stages.items()
+            }
+
+
+class _Pipeline:
+    def __init__(self, text_splitter, embeddings, commit_batch, on_stage_progress, should_cancel):
+        self.text_splitter = text_splitter
+        self.embeddings = embeddings
+        self.commit_batch = commit_batch
+        self.should_cancel = should_cancel
+        self.stats = PipelineStats(on_stage_progress)
+
+        # Colas acotadas: una etapa lenta frena a las anteriores en vez de acumular memoria
+        self.chunk_q: queue.Queue = queue.Queue(maxsize=INGEST_QUEUE_SIZE)
+        self.embed_q: queue.Queue = queue.Queue(maxsize=INGEST_QUEUE_SIZE)
+        self.write_q: queue.Queue = queue.Queue(maxsize=INGEST_QUEUE_SIZE)
+
+        self.stop = threading.Event()
+        self.cancelled = False
+        self.errors: List[BaseException] = []
+
+    def _put(self, q: queue.Queue, item):
+        # put con timeout para no quedar bloqueado si otra etapa falló
+        while not self.stop.is_set():
+            try:
+                q.put(item, timeout=0.2)
+                return
+            except queue.Full:
+                continue
+
+    def _get(self, q: queue.Queue):
+        while True:
+            try:
+                return q.get(timeout=0.2)
+            except queue.Empty:
+                if self.stop.is_set():
+                    return _DONE
+
+    def _fail(self, error: BaseException):
+        self.errors.append(error)
+        self.stop.set()
+
+    # ---------- Etapas ----------
+
+    def parse_stage(self, items: List[Dict]):
+        try:
+            ctx = multiprocessing.get_context("spawn")
+            max_in_flight = max(INGEST_PARSE_WORKERS, 1) * 2
+            with ProcessPoolExecutor(max_workers=max(INGEST_PARSE_WORKERS, 1), mp_context=ctx) as pool:
+                pending = {}
+                remaining = iter(items)
+                exhausted = False
+                while not (exhausted and not pending) and not self.stop.is_set():
+                    while not exhausted and len(pending) < max_in_flight:
+                        if self.should_cancel and self.should_cancel():
+                            # Los archivos ya en vuelo terminan y se confirman completos
+                            self.cancelled = True
+                            exhausted = True
+                            break
+                        item = next(remaining, None)
+                        if item is None:
+                            exhausted = True
+                            break
+                        pending[pool.submit(parse_pdf, item["path"])] = (item, time.time())
+                    if not pending:
+                        break
+                    done, _ = wait(pending, timeout=0.5, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        item, submitted = pending.pop(future)
+                        pages = future.result()
+                        self.stats.record("parse", len(pages), time.time() - submitted)
+                        self._put(self.chunk_q, (item, pages))
+        except BaseException as e:
+            self._fail(e)
+        finally:
+            for _ in range(INGEST_CHUNK_WORKERS):
+                self._put(self.chunk_q, _DONE)
+
+    def chunk_stage(self):
+        try:
+            while True:
+                entry = self._get(self.chunk_q)
+                if entry is _DONE or self.stop.is_set():
+                    break
+                item, pages = entry
+                started = time.time()
+                if hasattr(self.text_splitter, "split_with_vectors"):
+                    # El splitter semántico puede devolver ya los vectores de los chunks
+                    chunks, vectors = self.text_splitter.split_with_vectors(pages)
+                else:
+                    chunks, vectors = self.text_splitter.split_documents(pages), None
+                for chunk in chunks:
+                    chunk.metadata["source"] = item["path"]
+                    chunk.metadata["content_hash"] = item["sha256"]
+                    # Tokens del chunk: el empaquetado del contexto no re-tokeniza en cada consulta
+                    chunk.metadata["tokens"] = count_tokens(chunk.page_content)
+                self.stats.record("chunk", len(chunks), time.time() - started)
+                self._put(self.embed_q, (item, chunks, vectors))
+        except BaseException as e:
+            self._fail(e)
+
+    def embed_stage(self):
+        try:
+            while True:
+                entry = self._get(self.embed_q)
+                if entry is _DONE or self.stop.is_set():
+                    break
+                item, chunks, vectors = entry
+                started = time.time()
+                if vectors is None:
+                    texts = [chunk.page_content for chunk in chunks]
+                    vectors = []
+                    for start in range(0, len(texts), INGEST_EMBED_BATCH_SIZE):
+                        vectors.extend(self.embeddings.embed_documents(texts[start:start + INGEST_EMBED_BATCH_SIZE]))
+                self.stats.record("embed", len(vectors), time.time() - started)
+                self._put(self.write_q, (item, chunks, vectors))
+        except BaseException as e:
+            self._fail(e)
+
+    def write_stage(self, embed_workers: int):
+        finished_workers = 0
+        batch, batch_rows = [], 0
+
+        def flush():
+            started = time.time()
+            self.commit_batch(batch)
+            rows = sum(len(chunks) for _, chunks, _ in batch)
+            self.stats.record("write", rows, time.time() - started, files=len(batch))
+
+        try:
+            while finished_workers < embed_workers:
+                entry = self._get(self.write_q)
+                if entry is _DONE:
+                    if self.stop.is_set():
+                        break
+                    finished_workers += 1
+                    continue
+                batch.append(entry)
+                batch_rows += len(entry[1])
+                # Varios archivos pequeños en una transacción; nunca un archivo partido en dos
+                if batch_rows >= INGEST_WRITE_BATCH_ROWS:
+                    flush()
+                    batch, batch_rows = [], 0
+            if batch and not self.stop.is_set():
+                flush()
+        except BaseException as e:
+            self._fail(e)
+
+    def run(self, items: List[Dict]):
+        threads = [threading.Thread(target=self.parse_stage, args=(items,), name="ingest-parse")]
+        chunkers = [threading.Thread(target=self.chunk_stage, name=f"ingest-chunk-{i}") for i in range(INGEST_CHUNK_WORKERS)]
+        embedders = [threading.Thread(target=self.embed_stage, name=f"ingest-embed-{i}") for i in range(INGEST_EMBED_CONCURRENCY)]
+        writer = threading.Thread(target=self.write_stage, args=(INGEST_EMBED_CONCURRENCY,), name="ingest-write")
+
+        for thread in threads + chunkers + embedders + [writer]:
+            thread.start()
+
+        # Propagar el fin de flujo: cuando terminan todos los chunkers se avisa a los embedders, etc.
+        threads[0].join()
+        for thread in chunkers:
+            thread.join()
+        for _ in embedders:
+            self._put(self.embed_q, _DONE)
+        for thread in embedders:
+            thread.join()
+        for _ in embedders:
+            self._put(self.write_q, _DONE)
+        writer.join()
+
+        if self.errors:
+            raise self.errors[0]
+
+
+def run_pipeline(
+    items: List[Dict],
+    text_splitter,
+    embeddings,
+    commit_batch: Callable[[List], None],
+    on_stage_progress: Optional[Callable[[Dict], None]] = None,
+    should_cancel: Optional[Callable[[], bool]] = None,
+) -> Dict:
+    """Procesar archivos en un pipeline parseo -> chunking -> embeddings -> escritura.
+
+    `commit_batch` recibe listas de (item, chunks, vectors) y debe confirmarlas
+    en una sola transacción. `on_stage_progress` recibe periódicamente las
+    estadísticas por etapa. Devuelve esas estadísticas y si se canceló.
+    """
+    pipeline = _Pipeline(text_splitter, embeddings, commit_batch, on_stage_progress, should_cancel)
+    pipeline.run(items)
+    return {"stages": pipeline.stats.snapshot(), "cancelled": pipeline.cancelled}
@@ -0,0 +1,190 @@
+import functools
+import multiprocessing
+import threading
+import time
+import traceback
+import uuid
+from concurrent.futures import CancelledError, ProcessPoolExecutor, wait
+from typing import Dict, List, Optional
+
+from app.config import INGEST_SHUTDOWN_TIMEOUT
+
+# Estados posibles de un job de ingesta
+QUEUED = "queued"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+CANCELLED = "cancelled"
+CANCELLING = "cancelling"
+
+# Cuántos jobs terminados se conservan para consultar su estado
+MAX_FINISHED_JOBS = 50
+
+
+def _run_ingest_job(job_id: str, full: bool, progress, cancel_event, paths: Optional[List[str]] = None) -> Dict:
+    """Se ejecuta en el proceso worker: corre la ingesta y publica el progreso"""
+    # Importar aquí para que el proceso del servidor no cargue el pipeline de ingesta
+    from app.ingest import IngestCancelled, run_files, run_full, run_incremental
+
+    progress[job_id] = {"started_at": time.time()}
+
+    def on_progress(stats: Dict):
+        progress[job_id] = {**progress[job_id], **stats}
+
+    if paths:
+        # Solo los archivos indicados (subidas), sin recorrer todo el directorio
+        run = functools.partial(run_files, paths)
+    else:
+        run = run_full if full else run_incremental
+    try:
+        return {"status": SUCCEEDED, "stats": run(on_progress=on_progress, should_cancel=cancel_event.is_set)}
+    except IngestCancelled as e:
+        return {"status": CANCELLED, "error": str(e)}
+
+
+class IngestJobManager:
+    """Cola de jobs de ingesta ejecutados en un pool de procesos de 1 worker.
+
+    El worker separado evita bloquear el event loop (y el GIL) del servidor;
+    con un solo worker los jobs se ejecutan de uno en uno y en orden.
+    """
+
+    def __init__(self):
+        self._ctx = multiprocessing.get_context("spawn")
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._manager = None
+        self._progress = None
+        self._jobs: Dict[str, Dict] = {}
+        self._lock = threading.RLock()
+
+    def _ensure_started(self):
+        if self._executor is None:
+            self._manager = self._ctx.Manager()
+            self._progress = self._manager.dict()
+            # Un proceso nuevo por job: la memoria de la ingesta se libera al terminar
+            self._executor = ProcessPoolExecutor(max_workers=1, mp_context=self._ctx, max_tasks_per_child=1)
+
+    def submit(self, full: bool = False, paths: Optional[List[str]] = None) -> Dict:
+        with self._lock:
+            self._ensure_started()
+            job_id = uuid.uuid4().hex
+            cancel_event = self._manager.Event()
+            job = {
+                "id": job_id,
+                "full": full,
+                "paths": paths,
+                "status": QUEUED,
+                "created_at": time.time(),
+                "finished_at": None,
+                "error": None,
+                "stats": None,
+                "cancel_requested": False,
+                "_cancel_event": cancel_event,
+            }
+            future = self._executor.submit(_run_ingest_job, job_id, full, self._progress, cancel_event, paths)
+            job["_future"] = future
+            self._jobs[job_id] = job
+            self._prune()
+
+        future.add_done_callback(lambda f: self._on_done(job_id, f))
+        return self.get(job_id)
+
+    def _on_done(self, job_id: str, future):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return
+            job["finished_at"] = time.time()
+            try:
+                result = future.result()
+                job["status"] = result["status"]
+                job["stats"] = result.get("stats")
+                job["error"] = result.get("error")
+            except CancelledError:
+                job["status"] = CANCELLED
+            except Exception as e:
+                job["status"] = FAILED
+                job["error"] = "".join(traceback.format_exception_only(type(e), e)).strip()
+
+    def _prune(self):
+        finished = sorted(
+            (job for job in self._jobs.values() if job["finished_at"] is not None),
+            key=lambda j: j["finished_at"],
+        )
+        for job in finished[:max(len(finished) - MAX_FINISHED_JOBS, 0)]:
+            self._jobs.pop(job["id"], None)
+            self._progress.pop(job["id"], None)
+
+    def get(self, job_id: str) -> Optional[Dict]:
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            status = job["status"]
+            progress = dict(self._progress.get(job_id, {})) if self._progress is not None else {}
+            if status == QUEUED and progress:
+                status = RUNNING
+            if job["finished_at"] is None and job["cancel_requested"]:
+                status = CANCELLING
+            return {
+                "id": job["id"],
+                "full": job["full"],
+                "paths": job["paths"],
+                "status": status,
+                "created_at": job["created_at"],
+                "started_at": progress.pop("started_at", None),
+                "finished_at": job["finished_at"],
+                "progress": progress,
+                "stats": job["stats"],
+                "error": job["error"],
+            }
+
+    def list(self) -> List[Dict]:
+        with self._lock:
+            job_ids = list(self._jobs)
+        return [self.get(job_id) for job_id in job_ids]
+
+    def cancel(self, job_id: str) -> Optional[Dict]:
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            if job["finished_at"] is None:
+                # Si aún está en cola se cancela directamente; si corre, el worker
+                # revisa el evento entre archivos y se detiene limpiamente
+                job["cancel_requested"] = True
+                if not job["_future"].cancel():
+                    job["_cancel_event"].set()
+        return self.get(job_id)
+
+    def shutdown(self, timeout: float = INGEST_SHUTDOWN_TIMEOUT):
+        """Cancelar los jobs y esperar a lo sumo `timeout` segundos a que el que
+        corre se detenga entre archivos; si no, se termina el proceso worker.
+
+        Cada archivo se confirma en su transacción y el manifiesto se guarda de
+        forma atómica: lo que no llegó a confirmarse queda para el próximo run.
+        """
+        with self._lock:
+            executor = self._executor
+            if executor is None:
+                return
+            running = []
+            for job in self._jobs.values():
+                if job["finished_at"] is None:
+                    job["cancel_requested"] = True
+                    job["_cancel_event"].set()
+                    running.append(job["_future"])
+            self._executor = None
+
+        # El proceso worker se toma antes del shutdown, que suelta la referencia
+        processes = list((getattr(executor, "_processes", None) or {}).values())
+        executor.shutdown(wait=False, cancel_futures=True)
+        _, not_done = wait(running, timeout=timeout)
+        if not_done:
+            print(f"⚠️ Ingest job still running after {timeout}s, terminating the worker")
+            for process in processes:
+                process.terminate()
+        self._manager.shutdown()
+
+
+job_manager = IngestJobManager()
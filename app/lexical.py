@@ -0,0 +1,198 @@
+import hashlib
+import heapq
+import json
+import math
+import os
+import re
+import threading
+from collections import Counter, defaultdict
+from typing import BinaryIO, Dict, Iterable, List, Optional, Tuple
+
+from langchain_core.documents import Document
+
+from app.config import LEXICAL_INDEX_PATH
+from app.filters import MetadataFilter, matches_filters
+
+_TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+
+def tokenize(text: str) -> List[str]:
+    return [token for token in _TOKEN_RE.findall(text.lower()) if len(token) > 1]
+
+
+class BM25Index:
+    """Índice léxico BM25 (Okapi) de los chunks de la colección.
+
+    Se construye completo en una ingesta completa; las incrementales y las
+    subidas solo quitan y agregan los chunks de sus archivos (`update`).
+    Se guarda como JSON: documentos (id, metadata, largo, offset) y postings
+    término -> [[doc, tf], ...].
+    Los textos van aparte, una línea JSON por chunk, y solo se leen los de los
+    k resultados: recargar el índice no parsea el corpus entero.
+    """
+
+    def __init__(self, docs: List[Dict], postings: Dict[str, List[List[int]]], texts: Optional[BinaryIO] = None):
+        self.docs = docs
+        self.postings = postings
+        self.texts = texts
+        self._texts_lock = threading.Lock()
+        total = sum(doc["length"] for doc in docs)
+        self.avgdl = total / len(docs) if docs else 0.0
+
+    @classmethod
+    def build(cls, records: Iterable[Tuple[str, str, Dict]]) -> "BM25Index":
+        """records: (id, texto, metadata) de cada chunk"""
+        docs: List[Dict] = []
+        postings: Dict[str, List[List[int]]] = defaultdict(list)
+        _append(docs, postings, records)
+        return cls(docs, dict(postings))
+
+    def update(self, remove_ids: Iterable[str], records: Iterable[Tuple[str, str, Dict]]) -> "BM25Index":
+        """Índice nuevo sin los chunks `remove_ids` y con `records` agregados.
+
+        Solo se tokenizan los chunks nuevos; el resto conserva sus postings
+        (renumerados) y sigue leyendo su texto del archivo de este índice.
+        """
+        records = list(records)
+        remove = set(remove_ids) | {chunk_id for chunk_id, _, _ in records}
+        docs: List[Dict] = []
+        new_position: Dict[int, int] = {}
+        for position, doc in enumerate(self.docs):
+            if doc["id"] not in remove:
+                new_position[position] = len(docs)
+                docs.append(doc)
+        postings: Dict[str, List[List[int]]] = defaultdict(list)
+        for term, entries in self.postings.items():
+            kept = [[new_position[position], tf] for position, tf in entries if position in new_position]
+            if kept:
+                postings[term] = kept
+        _append(docs, postings, records)
+        return BM25Index(docs, dict(postings), self.texts)
+
+    @classmethod
+    def load(cls, path: str) -> "BM25Index":
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+        if "texts" not in data:
+            # Formato anterior, con los textos dentro del índice
+            return cls(data["docs"], data["postings"])
+        # El archivo de textos queda abierto: si una ingesta posterior lo
+        # borra, este índice sigue leyendo su versión hasta que se recargue
+        texts = open(os.path.join(os.path.dirname(path), data["texts"]), "rb")
+        return cls(data["docs"], data["postings"], texts)
+
+    def save(self, path: str):
+        """Escritura atómica: el servidor nunca lee un archivo a medias.
+
+        Cada versión escribe sus textos en un archivo nuevo (`<path>.<digest>.texts`)
+        antes de reemplazar el índice, que lo referencia por nombre.
+        """
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        digest = hashlib.sha1()
+        lines = []
+        docs = []
+        offset = 0
+        for position, doc in enumerate(self.docs):
+            line = (json.dumps(self.text(position), ensure_ascii=False) + "\n").encode("utf-8")
+            digest.update(line)
+            lines.append(line)
+            docs.append({"id": doc["id"], "metadata": doc["metadata"], "length": doc["length"], "offset": offset})
+            offset += len(line)
+
+        texts_name = f"{os.path.basename(path)}.{digest.hexdigest()[:16]}.texts"
+        texts_path = os.path.join(os.path.dirname(path), texts_name)
+        with open(f"{texts_path}.tmp", "wb") as f:
+            f.writelines(lines)
+        os.replace(f"{texts_path}.tmp", texts_path)
+
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"docs": docs, "postings": self.postings, "texts": texts_name}, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+        # Textos de versiones anteriores (los lectores que los tienen abiertos siguen leyendo)
+        prefix = f"{os.path.basename(path)}."
+        for name in os.listdir(os.path.dirname(path)):
+            if name.startswith(prefix) and name.endswith(".texts") and name != texts_name:
+                try:
+                    os.remove(os.path.join(os.path.dirname(path), name))
+                except OSError:
+                    pass
+
+    def text(self, position: int) -> str:
+        doc = self.docs[position]
+        if "text" in doc:
+            return doc["text"]
+        with self._texts_lock:
+            self.texts.seek(doc["offset"])
+            line = self.texts.readline()
+        return json.loads(line)
+
+    def __len__(self) -> int:
+        return len(self.docs)
+
+    def search(self, query: str, k: int, filters: Optional[MetadataFilter] = None) -> List[Tuple[Document, float]]:
+        """Los k chunks con mayor score BM25 (entre los que cumplen `filters`), como (Document, score)"""
+        if not self.docs:
+            return []
+        total = len(self.docs)
+        scores: Dict[int, float] = defaultdict(float)
+        for term in set(tokenize(query)):
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            idf = math.log((total - len(postings) + 0.5) / (len(postings) + 0.5) + 1.0)
+            for position, tf in postings:
+                length = self.docs[position]["length"]
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * length / self.avgdl) if self.avgdl else BM25_K1
+                scores[position] += idf * tf * (BM25_K1 + 1) / (tf + norm)
+
+        candidates = scores.items()
+        if filters:
+            candidates = [item for item in candidates if matches_filters(self.docs[item[0]]["metadata"], filters)]
+        results = []
+        for position, score in heapq.nlargest(k, candidates, key=lambda item: item[1]):
+            doc = self.docs[position]
+            metadata = dict(doc["metadata"])
+            metadata.setdefault("id", doc["id"])
+            results.append((Document(page_content=self.text(position), metadata=metadata), score))
+        return results
+
+
+def _append(docs: List[Dict], postings: Dict[str, List[List[int]]], records: Iterable[Tuple[str, str, Dict]]):
+    for chunk_id, text, metadata in records:
+        position = len(docs)
+        counts = Counter(tokenize(text))
+        docs.append({"id": chunk_id, "text": text, "metadata": metadata or {}, "length": sum(counts.values())})
+        for term, tf in counts.items():
+            postings[term].append([position, tf])
+
+
+class LexicalIndexReader:
+    """Índice BM25 del disco, recargado cuando la ingesta lo reemplaza"""
+
+    def __init__(self, path: str = LEXICAL_INDEX_PATH):
+        self.path = path
+        self._index: Optional[BM25Index] = None
+        self._stamp = None
+        self._lock = threading.Lock()
+
+    def current(self) -> Optional[BM25Index]:
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        stamp = (stat.st_ino, stat.st_mtime_ns)
+        if stamp != self._stamp:
+            with self._lock:
+                if stamp != self._stamp:
+                    self._index = BM25Index.load(self.path)
+                    self._stamp = stamp
+        return self._index
+
+    def search(self, query: str, k: int, filters: Optional[MetadataFilter] = None) -> List[Tuple[Document, float]]:
+        index = self.current()
+        return index.search(query, k, filters) if index else []
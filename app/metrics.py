@@ -0,0 +1,242 @@
+import json
+import logging
+import random
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.outputs import LLMResult
+
+from app.config import METRICS_LOG_SAMPLE_RATE
+
+logger = logging.getLogger("app.metrics")
+if not logger.handlers:
+    # Una línea JSON por request muestreado, independiente de la config de uvicorn
+    _handler = logging.StreamHandler()
+    _handler.setFormatter(logging.Formatter("%(message)s"))
+    logger.addHandler(_handler)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+
+# Buckets en segundos: de 5 ms a 60 s
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+Sample = Tuple[Dict[str, str], float]
+
+
+def _format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ""
+    body = ",".join(f'{key}="{str(value)}"'.replace("\n", " ") for key, value in sorted(labels.items()))
+    return "{" + body + "}"
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> Tuple:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def render(self) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values: Dict[Tuple, float] = {}
+
+    def inc(self, value: float = 1.0, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + value
+
+    def render(self) -> List[str]:
+        with self._lock:
+            items = list(self._values.items())
+        return [f"{self.name}{_format_labels(dict(zip(self.labelnames, key)))} {value}" for key, value in items]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # Por combinación de labels: [conteo por bucket..., suma, conteo total]
+        self._values: Dict[Tuple, List[float]] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            entry = self._values.setdefault(key, [0.0] * (len(self.buckets) + 2))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[i] += 1
+            entry[-2] += value
+            entry[-1] += 1
+
+    def render(self) -> List[str]:
+        with self._lock:
+            items = [(key, list(entry)) for key, entry in self._values.items()]
+        lines = []
+        for key, entry in items:
+            labels = dict(zip(self.labelnames, key))
+            for bound, count in zip(self.buckets, entry):
+                lines.append(f"{self.name}_bucket{_format_labels({**labels, 'le': repr(bound)})} {count}")
+            lines.append(f"{self.name}_bucket{_format_labels({**labels, 'le': '+Inf'})} {entry[-1]}")
+            lines.append(f"{self.name}_sum{_format_labels(labels)} {entry[-2]}")
+            lines.append(f"{self.name}_count{_format_labels(labels)} {entry[-1]}")
+        return lines
+
+
+class Registry:
+    """Registro de métricas con exportación en formato de texto de Prometheus.
+
+    Además de métricas propias admite "collectors": funciones que al exportar
+    devuelven valores leídos de otros componentes (pool, cachés, ...).
+    """
+
+    def __init__(self):
+        self._metrics: List[_Metric] = []
+        self._collectors: List[Callable[[], Iterable[Tuple[str, str, str, List[Sample]]]]] = []
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        metric = Counter(name, documentation, labelnames)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        metric = Histogram(name, documentation, labelnames, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def add_collector(self, collector: Callable[[], Iterable[Tuple[str, str, str, List[Sample]]]]):
+        """collector() -> [(nombre, tipo, ayuda, [(labels, valor), ...]), ...]"""
+        self._collectors.append(collector)
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.render())
+        for collector in self._collectors:
+            try:
+                families = list(collector())
+            except Exception as e:
+                logger.warning("metrics collector failed: %s", e)
+                continue
+            for name, kind, documentation, samples in families:
+                lines.append(f"# HELP {name} {documentation}")
+                lines.append(f"# TYPE {name} {kind}")
+                lines.extend(f"{name}{_format_labels(labels)} {value}" for labels, value in samples)
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.histogram(
+    "rag_stage_duration_seconds",
+    "Duration of each RAG pipeline stage",
+    ["stage"],
+)
+REQUESTS_TOTAL = REGISTRY.counter("rag_requests_total", "Requests handled per endpoint", ["endpoint"])
+LLM_CALLS_TOTAL = REGISTRY.counter("rag_llm_calls_total", "Chat model calls", ["model"])
+LLM_TOKENS_TOTAL = REGISTRY.counter("rag_llm_tokens_total", "Chat model tokens", ["model", "kind"])
+ROUTING_DECISIONS_TOTAL = REGISTRY.counter(
+    "rag_routing_decisions_total", "Retrieval routing decisions (direct or expanded) and why", ["route", "reason"]
+)
+ROUTING_SAVED_SECONDS_TOTAL = REGISTRY.counter(
+    "rag_routing_latency_saved_seconds_total", "Estimated query expansion time avoided by direct routing"
+)
+COALESCED_REQUESTS_TOTAL = REGISTRY.counter(
+    "rag_coalesced_requests_total", "Requests that started a pipeline (leader) or joined one already running", ["role"]
+)
+MODEL_QUEUE_WAIT_SECONDS = REGISTRY.histogram(
+    "rag_model_queue_wait_seconds", "Time a model call waited for a concurrency slot and token budget", ["model", "priority"]
+)
+MODEL_CALLS_SHED_TOTAL = REGISTRY.counter(
+    "rag_model_calls_shed_total", "Model calls rejected by the scheduler (queue_full, timeout, rate_limit)", ["model", "reason"]
+)
+
+
+# ========== TIEMPOS POR REQUEST ==========
+
+# Tiempos de las etapas del request en curso (se comparte con las tareas hijas)
+_current_timings: ContextVar[Optional[Dict[str, float]]] = ContextVar("rag_request_timings", default=None)
+
+
+def start_request() -> Dict[str, float]:
+    timings: Dict[str, float] = {}
+    _current_timings.set(timings)
+    return timings
+
+
+def observe_stage(name: str, seconds: float):
+    STAGE_SECONDS.observe(seconds, stage=name)
+    timings = _current_timings.get()
+    if timings is not None:
+        # Una etapa puede repetirse dentro del mismo request (p. ej. varias búsquedas)
+        timings[name] = timings.get(name, 0.0) + seconds
+
+
+@contextmanager
+def stage(name: str):
+    """Medir una etapa: histograma global + tiempos del request actual"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(name, time.perf_counter() - started)
+
+
+def server_timing_header(timings: Dict[str, float]) -> str:
+    return ", ".join(f"{name};dur={seconds * 1000:.1f}" for name, seconds in timings.items())
+
+
+def log_request(endpoint: str, timings: Dict[str, float], **fields):
+    """Log estructurado (JSON) de una fracción muestreada de los requests"""
+    if METRICS_LOG_SAMPLE_RATE <= 0 or random.random() >= METRICS_LOG_SAMPLE_RATE:
+        return
+    record = {
+        "endpoint": endpoint,
+        "timings_ms": {name: round(seconds * 1000, 1) for name, seconds in timings.items()},
+        **fields,
+    }
+    logger.info(json.dumps(record))
+
+
+class LLMMetricsCallbackHandler(BaseCallbackHandler):
+    """Contar llamadas y tokens de los modelos de chat"""
+
+    def on_llm_end(self, response: LLMResult, **kwargs):
+        model = (response.llm_output or {}).get("model_name")
+        usage = None
+        for generations in response.generations:
+            for generation in generations:
+                message = getattr(generation, "message", None)
+                usage = getattr(message, "usage_metadata", None) or usage
+                # En streaming llm_output viene vacío: el modelo está en response_metadata
+                model = model or getattr(message, "response_metadata", {}).get("model_name")
+        model = model or "unknown"
+        LLM_CALLS_TOTAL.inc(model=model)
+        if not usage:
+            usage = (response.llm_output or {}).get("token_usage") or {}
+            usage = {
+                "input_tokens": usage.get("prompt_tokens", 0),
+                "output_tokens": usage.get("completion_tokens", 0),
+            }
+        LLM_TOKENS_TOTAL.inc(usage.get("input_tokens", 0), model=model, kind="prompt")
+        LLM_TOKENS_TOTAL.inc(usage.get("output_tokens", 0), model=model, kind="completion")
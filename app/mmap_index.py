@@ -0,0 +1,645 @@
+import asyncio
+import json
+import os
+import shutil
+import threading
+import uuid
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.vectorstores import VectorStore
+
+from app.config import (
+    COLLECTION_NAME,
+    EMBEDDING_DIMENSIONS,
+    MMAP_INDEX_DIR,
+    MMAP_INDEX_PARTITIONS,
+    MMAP_INDEX_PROBES,
+    METADATA_FILTER_KEYS,
+    RETRIEVAL_K,
+)
+from app.filters import MetadataFilter, from_store_filter
+from app.retrieval import SearchResults, VectorSearcher
+
+# Puntero a la generación vigente; se reemplaza de forma atómica en cada escritura
+CURRENT_FILE = "CURRENT"
+# Filas por bloque en la búsqueda exacta (acota la memoria de la matriz de similitudes)
+SEARCH_BLOCK_ROWS = 65536
+KMEANS_ITERATIONS = 10
+KMEANS_SAMPLE_PER_PARTITION = 256
+
+
+def _normalize(array: np.ndarray) -> np.ndarray:
+    array = np.asarray(array, dtype=np.float32)
+    if array.ndim == 1:
+        array = array[None, :]
+    norms = np.linalg.norm(array, axis=1, keepdims=True)
+    return array / np.maximum(norms, 1e-12)
+
+
+def _merge_top_k(scores: np.ndarray, rows: np.ndarray, block_scores: np.ndarray, block_rows: np.ndarray, k: int):
+    """Quedarse con los k mejores por consulta entre los acumulados y un bloque nuevo"""
+    scores = np.concatenate([scores, block_scores], axis=1)
+    rows = np.concatenate([rows, block_rows], axis=1)
+    if scores.shape[1] > k:
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        scores = np.take_along_axis(scores, top, axis=1)
+        rows = np.take_along_axis(rows, top, axis=1)
+    return scores, rows
+
+
+class _Generation:
+    """Una versión inmutable del índice abierta con memory-map (solo lectura).
+
+    Archivos de la generación:
+      vectors.f32      matriz float32 (count x dim) normalizada, filas agrupadas por partición
+      records.bin      JSON UTF-8 de cada fila ({"id", "text", "metadata"}), concatenados
+      offsets.npy      int64 (count + 1): inicio de cada registro en records.bin
+      ids.txt          un id por línea, en el mismo orden (para reemplazos y borrados)
+      centroids.npy    (opcional) centroides k-means de las particiones
+      partitions.npy   (opcional) int64 (partitions + 1): rango de filas de cada partición
+      meta.json        count, dim, generation, partitions
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        with open(os.path.join(directory, "meta.json")) as f:
+            meta = json.load(f)
+        self.generation = meta["generation"]
+        self.count = meta["count"]
+        self.dim = meta["dim"]
+        if self.count:
+            self.vectors = np.memmap(os.path.join(directory, "vectors.f32"), dtype=np.float32, mode="r",
+                                     shape=(self.count, self.dim))
+            self.records = np.memmap(os.path.join(directory, "records.bin"), dtype=np.uint8, mode="r")
+        else:
+            self.vectors = np.zeros((0, self.dim), dtype=np.float32)
+            self.records = np.zeros(0, dtype=np.uint8)
+        self.offsets = np.load(os.path.join(directory, "offsets.npy"), mmap_mode="r")
+        centroids_path = os.path.join(directory, "centroids.npy")
+        if os.path.exists(centroids_path):
+            self.centroids = np.load(centroids_path)
+            self.partitions = np.load(os.path.join(directory, "partitions.npy"))
+        else:
+            self.centroids = None
+            self.partitions = None
+        # ids.txt queda abierto igual que los mmaps: si una escritura posterior
+        # borra esta generación, quien todavía la tiene puede seguir leyendo sus ids
+        self._ids_file = open(os.path.join(directory, "ids.txt"), "rb")
+        self._ids_lock = threading.Lock()
+        self._rows: Optional[Dict[str, int]] = None
+        self._metadata_rows: Optional[Dict[str, Dict[str, np.ndarray]]] = None
+
+    def ids(self) -> List[str]:
+        with self._ids_lock:
+            self._ids_file.seek(0)
+            return self._ids_file.read().decode("utf-8").splitlines()
+
+    def row_of(self, chunk_id: str) -> Optional[int]:
+        # La generación es inmutable: el mapa id -> fila se arma una sola vez
+        if self._rows is None:
+            self._rows = {chunk_id: row for row, chunk_id in enumerate(self.ids())}
+        return self._rows.get(chunk_id)
+
+    def metadata_rows(self) -> Dict[str, Dict[str, np.ndarray]]:
+        """clave filtrable -> valor -> filas; se arma una sola vez por generación"""
+        if self._metadata_rows is None:
+            found: Dict[str, Dict[str, List[int]]] = {key: {} for key in METADATA_FILTER_KEYS}
+            for row in range(self.count):
+                metadata = json.loads(self.record_bytes(row)).get("metadata") or {}
+                for key, by_value in found.items():
+                    if key in metadata:
+                        by_value.setdefault(str(metadata[key]), []).append(row)
+            self._metadata_rows = {
+                key: {value: np.asarray(rows, dtype=np.int64) for value, rows in by_value.items()}
+                for key, by_value in found.items()
+            }
+        return self._metadata_rows
+
+    def rows_matching(self, filters: MetadataFilter) -> np.ndarray:
+        """Filas (ordenadas) que cumplen todas las claves del filtro"""
+        index = self.metadata_rows()
+        selected = None
+        for key, values in filters:
+            by_value = index.get(key, {})
+            rows = np.unique(np.concatenate([by_value.get(value, np.zeros(0, dtype=np.int64)) for value in values]))
+            selected = rows if selected is None else np.intersect1d(selected, rows, assume_unique=True)
+        return selected if selected is not None else np.arange(self.count)
+
+    def record_bytes(self, row: int) -> bytes:
+        return self.records[int(self.offsets[row]):int(self.offsets[row + 1])].tobytes()
+
+    def document(self, row: int) -> Document:
+        record = json.loads(self.record_bytes(row))
+        metadata = dict(record.get("metadata") or {})
+        metadata.setdefault("id", record["id"])
+        return Document(page_content=record["text"], metadata=metadata)
+
+
+def _encode_record(chunk_id: str, chunk: Document) -> bytes:
+    return json.dumps(
+        {"id": chunk_id, "text": chunk.page_content, "metadata": chunk.metadata},
+        ensure_ascii=False,
+    ).encode("utf-8")
+
+
+class _Staging:
+    """Escrituras de una ingesta acumuladas en disco hasta publicar una sola generación.
+
+    Las filas nuevas se agregan al final de sus propios archivos (vectores y
+    registros) y los ids borrados o reemplazados solo se marcan: publicar es
+    una sola pasada sobre el índice, no una por lote.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory)
+        self.vectors = open(os.path.join(directory, "vectors.f32"), "wb")
+        self.records = open(os.path.join(directory, "records.bin"), "wb")
+        self.offsets = [0]
+        self.ids: List[str] = []
+        self.dim: Optional[int] = None
+        # id -> fila de staging vigente (un id reemplazado deja su fila vieja muerta)
+        self.rows: Dict[str, int] = {}
+        # ids a quitar de la generación publicada
+        self.deleted: Set[str] = set()
+
+    def swap(self, stale: Set[str], chunks: List[Document], ids: List[str], vectors: List[List[float]]):
+        self.deleted |= stale
+        for chunk_id in stale:
+            self.rows.pop(chunk_id, None)
+        if not chunks:
+            return
+        block = _normalize(vectors)
+        self.dim = block.shape[1]
+        self.vectors.write(block.tobytes())
+        for chunk, chunk_id in zip(chunks, ids):
+            record = _encode_record(chunk_id, chunk)
+            self.records.write(record)
+            self.offsets.append(self.offsets[-1] + len(record))
+            self.rows[chunk_id] = len(self.ids)
+            self.ids.append(chunk_id)
+
+    def close(self):
+        self.vectors.close()
+        self.records.close()
+
+
+class MmapVectorIndex:
+    """Índice de vectores en disco: matriz float32 memory-mapped + registros compactos.
+
+    Cada escritura produce una generación nueva en su propio directorio y
+    luego mueve el puntero CURRENT con os.replace, así que los lectores
+    (varios procesos de uvicorn, por ejemplo) ven la versión anterior o la
+    nueva, nunca una mezcla, y comparten las mismas páginas del page cache.
+    """
+
+    def __init__(self, path: Optional[str] = None, partitions: int = MMAP_INDEX_PARTITIONS,
+                 probes: int = MMAP_INDEX_PROBES, dimensions: int = EMBEDDING_DIMENSIONS):
+        self.path = path or os.path.join(MMAP_INDEX_DIR, COLLECTION_NAME)
+        self.partitions = partitions
+        self.probes = probes
+        self.dimensions = dimensions
+        self._current: Optional[_Generation] = None
+        self._current_stamp = None
+        self._lock = threading.Lock()
+        self._staging: Optional[_Staging] = None
+
+    # ---------- Lectura ----------
+
+    def _pointer(self) -> str:
+        return os.path.join(self.path, CURRENT_FILE)
+
+    def preload(self) -> int:
+        """Leer todos los vectores de la generación vigente; devuelve cuántos"""
+        current = self.snapshot()
+        if current is None or not current.count:
+            return 0
+        float(np.asarray(current.vectors).sum())
+        if METADATA_FILTER_KEYS:
+            current.metadata_rows()
+        return current.count
+
+    def snapshot(self) -> Optional[_Generation]:
+        """Generación vigente; se reabre solo si CURRENT cambió (un stat por llamada)"""
+        try:
+            stat = os.stat(self._pointer())
+        except FileNotFoundError:
+            return None
+        stamp = (stat.st_ino, stat.st_mtime_ns)
+        if stamp == self._current_stamp:
+            return self._current
+        with self._lock:
+            if stamp != self._current_stamp:
+                with open(self._pointer()) as f:
+                    name = f.read().strip()
+                self._current = _Generation(os.path.join(self.path, name))
+                self._current_stamp = stamp
+        return self._current
+
+    def version(self) -> int:
+        current = self.snapshot()
+        return current.generation if current else 0
+
+    def __len__(self) -> int:
+        current = self.snapshot()
+        return current.count if current else 0
+
+    def search(self, vectors: List[List[float]], k: int = RETRIEVAL_K,
+               filters: Optional[MetadataFilter] = None) -> SearchResults:
+        """k vecinos más cercanos de cada vector, todos en una sola pasada vectorizada"""
+        if not vectors:
+            return []
+        current = self.snapshot()
+        if current is None or current.count == 0:
+            return [[] for _ in vectors]
+
+        queries = _normalize(vectors)
+        k = min(k, current.count)
+        scores = np.full((len(queries), 0), -np.inf, dtype=np.float32)
+        rows = np.zeros((len(queries), 0), dtype=np.int64)
+
+        for block_vectors, block_rows, mask in self._blocks(current, queries, filters):
+            block = queries @ np.asarray(block_vectors).T
+            if mask is not None:
+                # Consultas que no eligieron esta partición
+                block[~mask] = -np.inf
+            top = min(k, len(block_rows))
+            block_top = np.argpartition(-block, top - 1, axis=1)[:, :top]
+            scores, rows = _merge_top_k(
+                scores, rows, np.take_along_axis(block, block_top, axis=1), block_rows[block_top], k
+            )
+
+        results: SearchResults = []
+        for query_scores, query_rows in zip(scores, rows):
+            order = np.argsort(-query_scores)
+            results.append([
+                (current.document(int(query_rows[i])), float(1.0 - query_scores[i]))
+                for i in order if np.isfinite(query_scores[i])
+            ])
+        return results
+
+    def _blocks(self, current: _Generation, queries: np.ndarray,
+                filters: Optional[MetadataFilter]) -> Iterable[Tuple[np.ndarray, np.ndarray, Optional[np.ndarray]]]:
+        """(vectores, filas, máscara de consultas) de cada bloque a puntuar"""
+        if filters:
+            # Filtro antes de puntuar: solo las filas que lo cumplen, en búsqueda exacta
+            # (las particiones IVF podrían no contener ninguna)
+            selected = current.rows_matching(filters)
+            for start in range(0, len(selected), SEARCH_BLOCK_ROWS):
+                rows = selected[start:start + SEARCH_BLOCK_ROWS]
+                yield current.vectors[rows], rows, None
+            return
+        for start, end, mask in self._ranges(current, queries):
+            yield current.vectors[start:end], np.arange(start, end), mask
+
+    def _ranges(self, current: _Generation, queries: np.ndarray) -> Iterable[Tuple[int, int, Optional[np.ndarray]]]:
+        if current.centroids is None:
+            for start in range(0, current.count, SEARCH_BLOCK_ROWS):
+                yield start, min(start + SEARCH_BLOCK_ROWS, current.count), None
+            return
+
+        # IVF: cada consulta recorre solo sus `probes` particiones más cercanas;
+        # las particiones son rangos contiguos de filas, así que se leen secuencialmente
+        probes = max(1, min(self.probes, len(current.centroids)))
+        chosen = np.argpartition(-(queries @ current.centroids.T), probes - 1, axis=1)[:, :probes]
+        for partition in np.unique(chosen):
+            start, end = int(current.partitions[partition]), int(current.partitions[partition + 1])
+            if end > start:
+                yield start, end, (chosen == partition).any(axis=1)
+
+    # ---------- Escritura (un solo escritor: el lock de ingesta) ----------
+
+    def vectors(self, ids: List[str]) -> Dict[str, List[float]]:
+        """Vectores (normalizados) de los chunks indicados, por id"""
+        current = self.snapshot()
+        if current is None:
+            return {}
+        found = {}
+        for chunk_id in ids:
+            row = current.row_of(chunk_id)
+            if row is not None:
+                found[chunk_id] = current.vectors[row].tolist()
+        return found
+
+    def swap(self, delete_ids: List[str], chunks: List[Document], ids: List[str], vectors: List[List[float]]):
+        """Reemplazar chunks viejos por nuevos en una generación nueva (o en el staging de `batch`)"""
+        # Borrar también los ids nuevos hace que reintentar sea idempotente
+        stale = set(delete_ids) | set(ids)
+        if self._staging is not None:
+            self._staging.swap(stale, chunks, ids, vectors)
+            return
+        current = self.snapshot()
+        keep = [] if current is None else [row for row, chunk_id in enumerate(current.ids()) if chunk_id not in stale]
+        if current is not None and not chunks and len(keep) == current.count:
+            return
+        self._write_chunks(current, keep, chunks, ids, vectors)
+
+    @contextmanager
+    def batch(self):
+        """Acumular los swap del bloque y publicar una sola generación al salir.
+
+        Cada generación reescribe la matriz completa: con una por lote, una
+        ingesta grande costaría O(N²) de disco; así es una sola pasada. Los
+        lectores ven la versión anterior hasta que termina el bloque. Si el
+        bloque falla se publica igual lo acumulado (cada swap es completo).
+        """
+        if self._staging is not None:
+            yield
+            return
+        os.makedirs(self.path, exist_ok=True)
+        self._staging = _Staging(os.path.join(self.path, f".staging-{uuid.uuid4().hex}"))
+        try:
+            yield
+        finally:
+            staging, self._staging = self._staging, None
+            staging.close()
+            try:
+                self._publish(staging)
+            finally:
+                shutil.rmtree(staging.directory, ignore_errors=True)
+
+    def _publish(self, staging: _Staging):
+        current = self.snapshot()
+        keep = [] if current is None else [
+            row for row, chunk_id in enumerate(current.ids()) if chunk_id not in staging.deleted
+        ]
+        live = np.asarray(sorted(staging.rows.values()), dtype=np.int64)
+        if not len(live) and (current is None or len(keep) == current.count):
+            return
+        if len(live):
+            matrix = np.memmap(os.path.join(staging.directory, "vectors.f32"), dtype=np.float32, mode="r",
+                               shape=(len(staging.ids), staging.dim))
+            records = np.memmap(os.path.join(staging.directory, "records.bin"), dtype=np.uint8, mode="r")
+        offsets = staging.offsets
+        self._write(
+            current, keep, [staging.ids[row] for row in live],
+            lambda positions: matrix[live[positions]],
+            lambda i: records[offsets[live[i]]:offsets[live[i] + 1]].tobytes(),
+            staging.dim,
+        )
+
+    def retain(self, keep_ids: List[str]) -> int:
+        """Dejar solo las filas cuyos ids están en keep_ids. Devuelve cuántas se borraron."""
+        current = self.snapshot()
+        if current is None:
+            return 0
+        wanted = set(keep_ids)
+        keep = [row for row, chunk_id in enumerate(current.ids()) if chunk_id in wanted]
+        if len(keep) == current.count:
+            return 0
+        self._write_chunks(current, keep, [], [], [])
+        return current.count - len(keep)
+
+    def rebuild(self) -> dict:
+        """Reescribir la generación actual (recalcula las particiones con la config vigente)"""
+        current = self.snapshot()
+        count = current.count if current else 0
+        self._write_chunks(current, list(range(count)), [], [], [], retrain=True)
+        return self.describe()
+
+    def iter_documents(self, ids: Optional[List[str]] = None) -> Iterable[Tuple[str, str, dict]]:
+        """(id, texto, metadata) de cada fila de la generación vigente (o de los `ids`)"""
+        current = self.snapshot()
+        if current is None:
+            return
+        rows = range(current.count) if ids is None else [row for row in map(current.row_of, ids) if row is not None]
+        for row in rows:
+            record = json.loads(current.record_bytes(row))
+            yield record["id"], record["text"], record.get("metadata") or {}
+
+    def describe(self) -> dict:
+        current = self.snapshot()
+        return {
+            "backend": "mmap",
+            "path": self.path,
+            "generation": current.generation if current else 0,
+            "rows": current.count if current else 0,
+            "partitions": len(current.centroids) if current is not None and current.centroids is not None else 0,
+        }
+
+    def _kmeans(self, vectors: np.ndarray, partitions: int) -> np.ndarray:
+        """k-means esférico sobre una muestra; devuelve centroides normalizados"""
+        rng = np.random.default_rng(0)
+        sample_size = min(len(vectors), partitions * KMEANS_SAMPLE_PER_PARTITION)
+        sample = np.asarray(vectors[np.sort(rng.choice(len(vectors), sample_size, replace=False))])
+        centroids = sample[rng.choice(len(sample), partitions, replace=False)].copy()
+        for _ in range(KMEANS_ITERATIONS):
+            assignment = np.argmax(sample @ centroids.T, axis=1)
+            for partition in range(partitions):
+                members = sample[assignment == partition]
+                if len(members):
+                    centroids[partition] = members.mean(axis=0)
+            centroids = _normalize(centroids)
+        return centroids
+
+    def _write_chunks(self, current: Optional[_Generation], keep: List[int], chunks: List[Document],
+                      ids: List[str], vectors: List[List[float]], retrain: bool = False):
+        new_vectors = _normalize(vectors) if len(vectors) else np.zeros((0, self.dimensions), dtype=np.float32)
+        records = [_encode_record(chunk_id, chunk) for chunk, chunk_id in zip(chunks, ids)]
+        self._write(current, keep, ids, lambda positions: new_vectors[positions], records.__getitem__,
+                    new_vectors.shape[1], retrain)
+
+    def _write(self, current: Optional[_Generation], keep: List[int], new_ids: List[str],
+               new_vectors: Callable[[np.ndarray], np.ndarray], new_record: Callable[[int], bytes],
+               new_dim: Optional[int], retrain: bool = False):
+        """Escribir una generación con las filas `keep` de la actual más las nuevas.
+
+        `new_vectors(posiciones)` devuelve los vectores normalizados de las filas
+        nuevas y `new_record(i)` el registro de la i-ésima; se leen por bloques.
+        """
+        os.makedirs(self.path, exist_ok=True)
+        generation = (current.generation if current else 0) + 1
+        name = f"gen-{generation:08d}"
+        tmp_dir = os.path.join(self.path, f".{name}.tmp")
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+
+        dim = current.dim if current and current.count else (new_dim or self.dimensions)
+        keep_array = np.asarray(keep, dtype=np.int64)
+        old_ids = current.ids() if current else []
+        count = len(keep_array) + len(new_ids)
+
+        def source_vectors(positions: np.ndarray) -> np.ndarray:
+            """Vectores de la fila lógica (primero las conservadas, luego las nuevas)"""
+            old = positions < len(keep_array)
+            block = np.empty((len(positions), dim), dtype=np.float32)
+            if old.any():
+                block[old] = current.vectors[keep_array[positions[old]]]
+            if (~old).any():
+                block[~old] = new_vectors(positions[~old] - len(keep_array))
+            return block
+
+        # Orden final de las filas: agrupadas por partición si el índice está particionado
+        order = np.arange(count, dtype=np.int64)
+        centroids = boundaries = None
+        partitions = min(self.partitions, count)
+        if partitions > 1:
+            if not retrain and current is not None and current.centroids is not None and len(current.centroids) == partitions:
+                # Escrituras incrementales: las filas nuevas van a la partición más cercana;
+                # rebuild() (--reindex o carga completa) vuelve a entrenar los centroides
+                centroids = current.centroids
+            else:
+                centroids = self._kmeans(source_vectors(np.arange(count)) if count <= SEARCH_BLOCK_ROWS
+                                         else _LazyRows(source_vectors, count), partitions)
+            assignment = np.empty(count, dtype=np.int64)
+            for start in range(0, count, SEARCH_BLOCK_ROWS):
+                block = source_vectors(order[start:start + SEARCH_BLOCK_ROWS])
+                assignment[start:start + len(block)] = np.argmax(block @ centroids.T, axis=1)
+            order = np.argsort(assignment, kind="stable")
+            boundaries = np.searchsorted(assignment[order], np.arange(partitions + 1)).astype(np.int64)
+
+        if count:
+            matrix = np.memmap(os.path.join(tmp_dir, "vectors.f32"), dtype=np.float32, mode="w+", shape=(count, dim))
+            for start in range(0, count, SEARCH_BLOCK_ROWS):
+                matrix[start:start + SEARCH_BLOCK_ROWS] = source_vectors(order[start:start + SEARCH_BLOCK_ROWS])
+            matrix.flush()
+            del matrix
+
+        offsets = np.zeros(count + 1, dtype=np.int64)
+        with open(os.path.join(tmp_dir, "records.bin"), "wb") as records, \
+                open(os.path.join(tmp_dir, "ids.txt"), "w") as id_file:
+            position = 0
+            for row, source in enumerate(order):
+                if source < len(keep_array):
+                    old_row = int(keep_array[source])
+                    record, chunk_id = current.record_bytes(old_row), old_ids[old_row]
+                else:
+                    record = new_record(int(source) - len(keep_array))
+                    chunk_id = new_ids[int(source) - len(keep_array)]
+                records.write(record)
+                id_file.write(f"{chunk_id}\n")
+                position += len(record)
+                offsets[row + 1] = position
+        np.save(os.path.join(tmp_dir, "offsets.npy"), offsets)
+
+        if centroids is not None:
+            np.save(os.path.join(tmp_dir, "centroids.npy"), centroids)
+            np.save(os.path.join(tmp_dir, "partitions.npy"), boundaries)
+        with open(os.path.join(tmp_dir, "meta.json"), "w") as f:
+            json.dump({"generation": generation, "count": count, "dim": dim, "partitions": partitions if centroids is not None else 0}, f)
+
+        os.replace(tmp_dir, os.path.join(self.path, name))
+        pointer_tmp = self._pointer() + ".tmp"
+        with open(pointer_tmp, "w") as f:
+            f.write(name)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(pointer_tmp, self._pointer())
+
+        # Conservar la generación anterior: un lector puede haber leído CURRENT
+        # justo antes del cambio. Los mmaps ya abiertos siguen siendo válidos.
+        previous = current.generation if current else 0
+        for entry in os.listdir(self.path):
+            if entry.startswith("gen-") and int(entry[4:]) < previous:
+                shutil.rmtree(os.path.join(self.path, entry), ignore_errors=True)
+
+
+class _LazyRows:
+    """Acceso por índice a las filas lógicas sin materializar toda la matriz (para k-means)"""
+
+    def __init__(self, source, count: int):
+        self.source = source
+        self.count = count
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __getitem__(self, positions) -> np.ndarray:
+        return self.source(np.asarray(positions, dtype=np.int64))
+
+
+class MmapSearcher(VectorSearcher):
+    """Búsqueda batched sobre el índice mmap (misma interfaz que PGVectorSearcher)"""
+
+    def __init__(self, index: MmapVectorIndex):
+        self.index = index
+
+    async def asearch_many(self, vectors: List[List[float]], k: int = RETRIEVAL_K,
+                           filters: Optional[MetadataFilter] = None) -> SearchResults:
+        # NumPy libera el GIL en el producto de matrices: no bloquea el event loop
+        return await asyncio.to_thread(self.index.search, vectors, k, filters)
+
+    def search_many(self, vectors: List[List[float]], k: int = RETRIEVAL_K,
+                    filters: Optional[MetadataFilter] = None) -> SearchResults:
+        return self.index.search(vectors, k, filters)
+
+    async def avectors(self, ids: List[str]) -> Dict[str, List[float]]:
+        return await asyncio.to_thread(self.index.vectors, ids)
+
+    async def awarmup(self, vector: List[float], connections: int = 1):
+        # Leer la matriz completa trae sus páginas al page cache del proceso
+        await asyncio.to_thread(self.index.preload)
+        await self.asearch_many([vector], 1)
+
+    async def close(self):
+        pass
+
+
+class MmapVectorStore(VectorStore):
+    """VectorStore de LangChain sobre MmapVectorIndex (para el retriever por defecto y el loader)"""
+
+    def __init__(self, embedding_function: Embeddings, index: Optional[MmapVectorIndex] = None):
+        self.embedding_function = embedding_function
+        # `is None`: un índice vacío tiene len 0 y no debe reemplazarse por el de la config
+        self.index = index if index is not None else MmapVectorIndex()
+
+    @property
+    def embeddings(self) -> Embeddings:
+        return self.embedding_function
+
+    def add_texts(self, texts: Iterable[str], metadatas: Optional[List[dict]] = None,
+                  ids: Optional[List[str]] = None, **kwargs: Any) -> List[str]:
+        texts = list(texts)
+        metadatas = metadatas or [{} for _ in texts]
+        ids = ids or [str(uuid.uuid4()) for _ in texts]
+        documents = [Document(page_content=text, metadata=dict(metadata)) for text, metadata in zip(texts, metadatas)]
+        self.index.swap([], documents, ids, self.embedding_function.embed_documents(texts))
+        return ids
+
+    def delete(self, ids: Optional[List[str]] = None, **kwargs: Any) -> Optional[bool]:
+        if ids:
+            self.index.swap(ids, [], [], [])
+        return True
+
+    # `filter` en la misma sintaxis que PGVector: {"clave": {"in": [...]}}
+
+    def similarity_search_with_score_by_vector(self, embedding: List[float], k: int = RETRIEVAL_K,
+                                               filter: Optional[dict] = None) -> List[Tuple[Document, float]]:
+        return self.index.search([embedding], k, from_store_filter(filter))[0]
+
+    def similarity_search_with_score(self, query: str, k: int = RETRIEVAL_K, **kwargs: Any) -> List[Tuple[Document, float]]:
+        return self.similarity_search_with_score_by_vector(self.embedding_function.embed_query(query), k, kwargs.get("filter"))
+
+    def similarity_search_by_vector(self, embedding: List[float], k: int = RETRIEVAL_K, **kwargs: Any) -> List[Document]:
+        return [doc for doc, _ in self.similarity_search_with_score_by_vector(embedding, k, kwargs.get("filter"))]
+
+    def similarity_search(self, query: str, k: int = RETRIEVAL_K, **kwargs: Any) -> List[Document]:
+        return self.similarity_search_by_vector(self.embedding_function.embed_query(query), k, **kwargs)
+
+    async def asimilarity_search(self, query: str, k: int = RETRIEVAL_K, **kwargs: Any) -> List[Document]:
+        vector = await self.embedding_function.aembed_query(query)
+        results = await asyncio.to_thread(self.index.search, [vector], k, from_store_filter(kwargs.get("filter")))
+        return [doc for doc, _ in results[0]]
+
+    @classmethod
+    def from_texts(cls, texts: List[str], embedding: Embeddings, metadatas: Optional[List[dict]] = None, **kwargs: Any):
+        store = cls(embedding, kwargs.pop("index", None))
+        store.add_texts(texts, metadatas, **kwargs)
+        return store
+
+
+class MmapVersionTracker:
+    """Versión de ingesta para la caché de respuestas: la generación del índice"""
+
+    def __init__(self, index: MmapVectorIndex):
+        self.index = index
+
+    async def current(self) -> int:
+        return self.index.version()
+
+    async def close(self):
+        pass
@@ -0,0 +1,305 @@
+import hashlib
+import os
+import re
+import uuid
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import psycopg
+from langchain_core.documents import Document
+from pgvector.psycopg import register_vector
+from psycopg.types.json import Json, Jsonb
+
+from app.config import (
+    COLLECTION_NAME,
+    COLLECTION_SHARDS,
+    DATABASE_URL,
+    EMBEDDING_DIMENSIONS,
+    HNSW_EF_CONSTRUCTION,
+    HNSW_EF_SEARCH,
+    HNSW_M,
+    INDEX_MAINTENANCE_WORK_MEM,
+    IVFFLAT_LISTS,
+    IVFFLAT_PROBES,
+    METADATA_FILTER_KEYS,
+    PDF_DIRECTORY,
+    VECTOR_BACKEND,
+    VECTOR_INDEX_TYPE,
+)
+
+EMBEDDING_TABLE = "langchain_pg_embedding"
+COLLECTION_TABLE = "langchain_pg_collection"
+
+# Versión de ingesta por colección: cada commit de la ingesta la incrementa
+# (las cachés de respuestas la usan para invalidarse tras una re-ingesta).
+# Con shards se lleva una sola versión, la de COLLECTION_NAME, para todo el corpus
+INGEST_VERSION_TABLE = "rag_ingest_version"
+CREATE_INGEST_VERSION_SQL = (
+    f"CREATE TABLE IF NOT EXISTS {INGEST_VERSION_TABLE} ("
+    " collection_name TEXT PRIMARY KEY,"
+    " version BIGINT NOT NULL DEFAULT 0,"
+    " updated_at TIMESTAMPTZ NOT NULL DEFAULT now())"
+)
+# Parámetros en estilo del driver (psycopg): %(name)s
+BUMP_INGEST_VERSION_SQL = (
+    f"INSERT INTO {INGEST_VERSION_TABLE} (collection_name, version) VALUES (%(name)s, 1) "
+    f"ON CONFLICT (collection_name) DO UPDATE SET version = {INGEST_VERSION_TABLE}.version + 1, updated_at = now()"
+)
+
+
+def libpq_url(url: str = DATABASE_URL) -> str:
+    """Convertir una URL de SQLAlchemy (postgresql+psycopg://) a una de libpq"""
+    return re.sub(r"^postgresql\+\w+://", "postgresql://", url)
+
+
+def connect(url: str = DATABASE_URL) -> psycopg.Connection:
+    conn = psycopg.connect(libpq_url(url))
+    register_vector(conn)
+    return conn
+
+
+def search_engine_args() -> Dict:
+    """engine_args para PGVector: fija ef_search/probes en cada conexión nueva.
+
+    Los parámetros con punto (hnsw.*, ivfflat.*) se aceptan aunque la
+    extensión todavía no esté cargada en la sesión.
+    """
+    options = f"-c hnsw.ef_search={HNSW_EF_SEARCH} -c ivfflat.probes={IVFFLAT_PROBES}"
+    return {"connect_args": {"options": options}}
+
+
+# ========== SHARDS POR FUENTE ==========
+
+def shard_collections(shards: Optional[int] = None) -> List[str]:
+    """Colecciones del corpus: COLLECTION_NAME, o COLLECTION_NAME_0..N-1 con COLLECTION_SHARDS > 1.
+
+    `shards` da las de otra cantidad (la de un manifiesto anterior). El
+    backend mmap es un solo índice en disco y no se reparte.
+    """
+    shards = COLLECTION_SHARDS if shards is None else shards
+    if shards <= 1 or VECTOR_BACKEND == "mmap":
+        return [COLLECTION_NAME]
+    return [f"{COLLECTION_NAME}_{shard}" for shard in range(shards)]
+
+
+def collection_for(path: str) -> str:
+    """Colección de un archivo, por hash estable de su ruta relativa a PDF_DIRECTORY.
+
+    Acepta también la ruta absoluta que la ingesta guarda en `source`, así un
+    filtro por fuente se resuelve a una sola colección.
+    """
+    collections = shard_collections()
+    if len(collections) == 1:
+        return collections[0]
+    rel_path = os.path.normpath(os.path.relpath(path, PDF_DIRECTORY) if os.path.isabs(path) else path)
+    digest = hashlib.sha1(rel_path.encode("utf-8")).digest()
+    return collections[int.from_bytes(digest[:8], "big") % len(collections)]
+
+
+def ensure_ingest_version_table():
+    with connect() as conn:
+        conn.execute(CREATE_INGEST_VERSION_SQL)
+
+
+def get_collection_uuid(conn: psycopg.Connection, collection_name: str = COLLECTION_NAME) -> uuid.UUID:
+    row = conn.execute(f"SELECT uuid FROM {COLLECTION_TABLE} WHERE name = %s", (collection_name,)).fetchone()
+    if row is None:
+        raise ValueError(f"Collection {collection_name} not found")
+    return row[0]
+
+
+def count_collection_rows(collection_name: str = COLLECTION_NAME) -> int:
+    with connect() as conn:
+        collection_id = get_collection_uuid(conn, collection_name)
+        return conn.execute(
+            f"SELECT COUNT(*) FROM {EMBEDDING_TABLE} WHERE collection_id = %s", (collection_id,)
+        ).fetchone()[0]
+
+
+def delete_collection_rows(collection_name: str) -> int:
+    """Borrar todas las filas de una colección (un shard que dejó de existir); 0 si no existe"""
+    with connect() as conn:
+        row = conn.execute(f"SELECT uuid FROM {COLLECTION_TABLE} WHERE name = %s", (collection_name,)).fetchone()
+        if row is None:
+            return 0
+        with conn.transaction(), conn.cursor() as cur:
+            cur.execute(f"DELETE FROM {EMBEDDING_TABLE} WHERE collection_id = %s", (row[0],))
+            deleted = cur.rowcount
+            cur.execute(BUMP_INGEST_VERSION_SQL, {"name": COLLECTION_NAME})
+    return deleted
+
+
+def iter_collection_documents(collection_name: str = COLLECTION_NAME,
+                              ids: Optional[List[str]] = None) -> Iterator[Tuple[str, str, Dict]]:
+    """(custom_id, documento, metadata) de cada fila de la colección (o de los `ids`), con un cursor de servidor"""
+    with connect() as conn:
+        collection_id = get_collection_uuid(conn, collection_name)
+        query = f"SELECT custom_id, document, cmetadata FROM {EMBEDDING_TABLE} WHERE collection_id = %s"
+        params: Tuple = (collection_id,)
+        if ids is not None:
+            query += " AND custom_id = ANY(%s)"
+            params += (list(ids),)
+        with conn.cursor(name="collection_documents") as cursor:
+            cursor.execute(query, params)
+            for custom_id, document, metadata in cursor:
+                yield custom_id, document, metadata or {}
+
+
+def _copy_types(conn: psycopg.Connection) -> List[str]:
+    """Tipos de las columnas a copiar, leídos del catálogo (json o jsonb, vector(n) o vector)"""
+    rows = conn.execute(
+        "SELECT attname, format_type(atttypid, NULL) FROM pg_attribute "
+        "WHERE attrelid = %s::regclass AND attnum > 0 AND NOT attisdropped",
+        (EMBEDDING_TABLE,),
+    ).fetchall()
+    types = dict(rows)
+    return [types[column] for column in ("uuid", "collection_id", "embedding", "document", "cmetadata", "custom_id")]
+
+
+def copy_swap_chunks(
+    delete_ids: List[str],
+    chunks: List[Document],
+    ids: List[str],
+    vectors: List[List[float]],
+    collection_name: str = COLLECTION_NAME,
+):
+    """Reemplazar chunks con DELETE + COPY binario dentro de una sola transacción"""
+    stale_ids = list(set(delete_ids) | set(ids))
+    with connect() as conn:
+        collection_id = get_collection_uuid(conn, collection_name)
+        types = _copy_types(conn)
+        json_wrapper = Jsonb if types[4] == "jsonb" else Json
+
+        with conn.transaction(), conn.cursor() as cur:
+            if stale_ids:
+                cur.execute(
+                    f"DELETE FROM {EMBEDDING_TABLE} WHERE collection_id = %s AND custom_id = ANY(%s)",
+                    (collection_id, stale_ids),
+                )
+            if chunks:
+                with cur.copy(
+                    f"COPY {EMBEDDING_TABLE} (uuid, collection_id, embedding, document, cmetadata, custom_id) "
+                    "FROM STDIN WITH (FORMAT BINARY)"
+                ) as copy:
+                    copy.set_types(types)
+                    for chunk, chunk_id, vector in zip(chunks, ids, vectors):
+                        copy.write_row((
+                            uuid.uuid4(),
+                            collection_id,
+                            vector,
+                            chunk.page_content,
+                            json_wrapper(chunk.metadata),
+                            chunk_id,
+                        ))
+            cur.execute(BUMP_INGEST_VERSION_SQL, {"name": COLLECTION_NAME})
+
+
+# ========== ÍNDICE ANN ==========
+
+def index_name(index_type: str, collection_name: str = COLLECTION_NAME) -> str:
+    return re.sub(r"\W", "_", f"ix_{collection_name}_embedding_{index_type}").lower()
+
+
+def _index_exists(conn: psycopg.Connection, name: str) -> bool:
+    return conn.execute("SELECT to_regclass(%s) IS NOT NULL", (name,)).fetchone()[0]
+
+
+def ensure_vector_index(rebuild: bool = False, collection_name: str = COLLECTION_NAME) -> Dict:
+    """Crear (o reconstruir) el índice HNSW/IVFFlat configurado en VECTOR_INDEX_TYPE.
+
+    La reconstrucción crea el índice nuevo antes de borrar el viejo, así las
+    búsquedas nunca caen a un escaneo secuencial mientras tanto.
+    """
+    if VECTOR_INDEX_TYPE not in ("hnsw", "ivfflat", "none"):
+        raise ValueError(f"Unknown VECTOR_INDEX_TYPE: {VECTOR_INDEX_TYPE}")
+
+    # autocommit: CREATE INDEX CONCURRENTLY no puede ir dentro de una transacción
+    with connect() as conn:
+        conn.autocommit = True
+
+        # Borrar índices de otro tipo (p. ej. al pasar de ivfflat a hnsw)
+        for other in ("hnsw", "ivfflat"):
+            if other != VECTOR_INDEX_TYPE:
+                conn.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {index_name(other, collection_name)}")
+
+        if VECTOR_INDEX_TYPE == "none":
+            return {"index": None}
+
+        name = index_name(VECTOR_INDEX_TYPE, collection_name)
+        exists = _index_exists(conn, name)
+        if exists and not rebuild:
+            return {"index": name, "type": VECTOR_INDEX_TYPE, "created": False}
+
+        # Los índices de pgvector necesitan una columna con dimensión fija
+        column_type = conn.execute(
+            "SELECT format_type(atttypid, atttypmod) FROM pg_attribute "
+            "WHERE attrelid = %s::regclass AND attname = 'embedding'",
+            (EMBEDDING_TABLE,),
+        ).fetchone()[0]
+        if column_type == "vector":
+            conn.execute(
+                f"ALTER TABLE {EMBEDDING_TABLE} ALTER COLUMN embedding TYPE vector({EMBEDDING_DIMENSIONS})"
+            )
+
+        conn.execute(f"SET maintenance_work_mem = '{INDEX_MAINTENANCE_WORK_MEM}'")
+
+        # Con shards cada colección tiene su índice parcial: un grafo/listas más
+        # chicos por shard y sin descartar filas de otras colecciones en la búsqueda
+        scope = ""
+        if COLLECTION_SHARDS > 1:
+            scope = f"WHERE collection_id = '{get_collection_uuid(conn, collection_name)}'"
+
+        if VECTOR_INDEX_TYPE == "hnsw":
+            params = f"m = {HNSW_M}, ef_construction = {HNSW_EF_CONSTRUCTION}"
+        else:
+            # IVFFlat entrena sus centroides con los datos existentes: crear después de cargar
+            lists = IVFFLAT_LISTS
+            if lists <= 0:
+                rows = conn.execute(f"SELECT COUNT(*) FROM {EMBEDDING_TABLE} {scope}").fetchone()[0]
+                lists = max(rows // 1000, 10)
+            params = f"lists = {lists}"
+
+        build_name = f"{name}_new" if exists else name
+        conn.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}_new")
+        conn.execute(
+            f"CREATE INDEX CONCURRENTLY {build_name} ON {EMBEDDING_TABLE} "
+            f"USING {VECTOR_INDEX_TYPE} (embedding vector_cosine_ops) WITH ({params}) {scope}"
+        )
+        if exists:
+            conn.execute(f"DROP INDEX CONCURRENTLY {name}")
+            conn.execute(f"ALTER INDEX {build_name} RENAME TO {name}")
+
+        conn.execute(f"ANALYZE {EMBEDDING_TABLE}")
+        return {"index": name, "type": VECTOR_INDEX_TYPE, "params": params, "created": True}
+
+
+# ========== ÍNDICES DE METADATA ==========
+
+def metadata_index_name(key: str) -> str:
+    return re.sub(r"\W", "_", f"ix_{EMBEDDING_TABLE}_meta_{key}").lower()
+
+
+def ensure_metadata_indexes(keys: List[str] = METADATA_FILTER_KEYS) -> List[str]:
+    """Índices de expresión (collection_id, cmetadata->>'clave') de las claves filtrables.
+
+    Con ellos la búsqueda filtrada lee solo las filas del filtro antes de
+    ordenar por distancia, en vez de recorrer el índice ANN y descartar después.
+    """
+    names = []
+    with connect() as conn:
+        conn.autocommit = True
+        for key in keys:
+            name = metadata_index_name(key)
+            conn.execute(
+                f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} "
+                f"ON {EMBEDDING_TABLE} (collection_id, (cmetadata->>'{key}'))"
+            )
+            names.append(name)
+    return names
+
+
+def ensure_indexes(rebuild: bool = False) -> Dict:
+    """Índice ANN de cada colección del corpus más los índices de metadata"""
+    collections = shard_collections()
+    vector = {name: ensure_vector_index(rebuild, name) for name in collections}
+    info = vector[COLLECTION_NAME] if len(collections) == 1 else {"shards": vector}
+    return {**info, "metadata_indexes": ensure_metadata_indexes()}
@@ -0,0 +1,48 @@
+from typing import TypedDict
+
+from langchain.prompts import PromptTemplate
+from langchain_core.prompts import ChatPromptTemplate
+
+
+# Define input type for the chain
+class RagInput(TypedDict):
+    question: str
+
+
+# Define the prompt template
+template = """
+You are a helpful assistant. Use the following context and previous conversation to answer the user's question.
+
+Chat History:
+{chat_history}
+
+Context:
+{context}
+
+Question: {question}
+"""
+
+ANSWER_PROMPT = ChatPromptTemplate.from_template(template)
+
+# Template for standalone question generation from chat history
+template_with_history = """Given a chat history and the latest user question which might reference context in the chat history, formulate a standalone question which can be understood without the chat history. Do NOT answer the question, just reformulate it if needed and otherwise return it as is.
+
+Chat History:
+{chat_history}
+
+Follow Up Input: {question}
+
+Standalone question:"""
+
+standalone_question_prompt = PromptTemplate.from_template(template_with_history)
+
+# Resumen acumulado de los turnos que salen del presupuesto de tokens del historial
+summary_prompt = PromptTemplate.from_template("""Progressively summarize the lines of conversation provided, adding onto the previous summary and returning a new summary. Keep names, facts, decisions and open questions. Use at most {max_tokens} tokens.
+
+Current summary:
+{summary}
+
+New lines of conversation:
+{new_lines}
+
+New summary:""")
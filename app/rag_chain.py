@@ -1,97 +1,67 @@
-import os
+import asyncio
+import contextvars
+import difflib
+import hashlib
+import re
+import time
+from contextlib import aclosing
 from operator import itemgetter
-from typing import TypedDict, List, Dict, Any
-import json
-
-from dotenv import load_dotenv
-from langchain_community.vectorstores.pgvector import PGVector
-from langchain_core.prompts import ChatPromptTemplate
-from langchain_core.runnables import RunnableParallel, RunnablePassthrough, RunnableLambda
-from langchain_openai import ChatOpenAI, OpenAIEmbeddings
-from langchain.retrievers.multi_query import MultiQueryRetriever
-from langchain.prompts import PromptTemplate
-from langchain_core.output_parsers import StrOutputParser
-from langchain_core.messages import HumanMessage, AIMessage, get_buffer_string
-from sqlalchemy import create_engine, text
-from sqlalchemy.pool import StaticPool
-
-load_dotenv()
-
-# Initialize embeddings with the modern model
-embeddings = OpenAIEmbeddings(model='text-embedding-3-small')
-
-# Connect to the vector store  
-vector_store = PGVector(
-    collection_name="collection164",
-    connection_string=os.getenv("DATABASE_URL"),
-    embedding_function=embeddings
-)
-
-# Define the prompt template
-template = """
-You are a helpful assistant. Use the following context and previous conversation to answer the user's question.
-
-Chat History:
-{chat_history}
+from typing import List, Dict, AsyncIterator, Optional
 
-Context:
-{context}
+from langchain_core.messages import HumanMessage, SystemMessage, get_buffer_string
+from langchain_core.runnables import RunnableParallel
 
-Question: {question}
-"""
-
-ANSWER_PROMPT = ChatPromptTemplate.from_template(template)
-
-# Initialize the LLM with modern model  
-llm = ChatOpenAI(temperature=0, model='gpt-4o-mini', streaming=True)
+from app.config import (
+    BATCH_QUERY_CONCURRENCY,
+    COALESCE_REQUESTS,
+    HISTORY_MODE,
+    HISTORY_SUMMARY_BATCH,
+    HISTORY_SUMMARY_MAX_TOKENS,
+    HISTORY_TOKEN_BUDGET,
+    QUERY_ROUTING,
+    RETRIEVAL_K,
+    RETRIEVER_MODE,
+    SPECULATION_MIN_SIMILARITY,
+    SPECULATIVE_RETRIEVAL,
+)
+from app.coalescing import SingleFlight
+from app.filters import MetadataFilter
+from app.history import split_by_budget
+from app.metrics import observe_stage, stage
+from app.resources import resources
+from app.scheduling import BATCH, SchedulerOverloaded, model_priority
 
-# Define input type for the chain
-class RagInput(TypedDict):
-    question: str
+# Modelos, vector store, retrievers, historial y cachés viven en `resources`:
+# se construyen al primer uso o en el precalentamiento del lifespan (app.server)
 
-# Create MultiQuery retriever for improved document retrieval
-multiquery = MultiQueryRetriever.from_llm(
-    retriever=vector_store.as_retriever(),
-    llm=llm,
-)
+async def pack_context(docs: List, packer=None):
+    """Aplicar el empaquetado; si falla, usar los documentos tal cual"""
+    packer = packer or resources.context_packer
+    if packer is None:
+        return docs
+    try:
+        return await packer.apack(docs)
+    except Exception as e:
+        print(f"⚠️ Error packing context: {e}")
+        return docs
 
-# ========== IMPLEMENTACIÓN DIRECTA DEL HISTORIAL CON SQLAlchemy ==========
+# ========== HISTORIAL CON POOL ASYNC DE CONEXIONES ==========
 
-# Crear engine para la base de datos de historial
-postgres_memory_url = os.getenv("DATABASE_URL_UNO")
-history_engine = create_engine(
-    postgres_memory_url,
-    poolclass=StaticPool,
-    pool_pre_ping=True
-)
+async def get_chat_history(session_id: str) -> List:
+    """Obtener los últimos mensajes del historial desde la DB.
 
-def get_chat_history(session_id: str) -> List:
-    """Obtener historial de chat directamente desde la DB"""
+    En modo "budget" solo los turnos recientes que entran en HISTORY_TOKEN_BUDGET,
+    precedidos por el resumen de los anteriores como SystemMessage.
+    """
     try:
-        with history_engine.connect() as conn:
-            result = conn.execute(
-                text("SELECT message FROM message_store WHERE session_id = :session_id ORDER BY id ASC"),
-                {"session_id": session_id}
-            )
-            
-            messages = []
-            for row in result:
-                msg_data = row[0]  # El mensaje está en JSONB
-                
-                # Convertir el JSONB a objetos de mensaje de LangChain
-                if msg_data.get('type') == 'human':
-                    messages.append(HumanMessage(content=msg_data.get('data', {}).get('content', '')))
-                elif msg_data.get('type') == 'ai':
-                    messages.append(AIMessage(content=msg_data.get('data', {}).get('content', '')))
-            
-            print(f"📜 Loaded {len(messages)} messages from history for session {session_id}")
-            
-            if messages:
-                for i, msg in enumerate(messages):
-                    content_preview = msg.content[:50] + "..." if len(msg.content) > 50 else msg.content
-                    print(f"  Message {i+1}: {type(msg).__name__} - {content_preview}")
-            
-            return messages
+        with stage("history_load"):
+            if HISTORY_MODE != "budget":
+                return await resources.history_store.load(session_id)
+            summary, _, messages = await resources.history_store.load_context(session_id)
+            history = [message for _, message in messages[split_by_budget(messages, HISTORY_TOKEN_BUDGET):]]
+            if summary:
+                history.insert(0, SystemMessage(content=f"Summary of the earlier conversation: {summary}"))
+            return history
             
     except Exception as e:
         print(f"⚠️ Error loading chat history: {e}")
@@ -99,69 +69,60 @@ def get_chat_history(session_id: str) -> List:
         traceback.print_exc()
         return []
 
-def save_to_chat_history(session_id: str, human_message: str, ai_message: str):
-    """Guardar mensajes en el historial directamente en la DB"""
+async def save_to_chat_history(session_id: str, human_message: str, ai_message: str):
+    """Guardar pregunta y respuesta en el historial con un solo INSERT"""
     try:
-        with history_engine.connect() as conn:
-            # Guardar mensaje humano
-            human_msg = {
-                "type": "human",
-                "data": {
-                    "content": human_message,
-                    "type": "human"
-                }
-            }
-            
-            # Usar CAST en lugar de :: para compatibilidad
-            conn.execute(
-                text("INSERT INTO message_store (session_id, message) VALUES (:session_id, CAST(:message AS jsonb))"),
-                {"session_id": session_id, "message": json.dumps(human_msg)}
-            )
-            
-            # Guardar mensaje AI
-            ai_msg = {
-                "type": "ai",
-                "data": {
-                    "content": ai_message,
-                    "type": "ai"
-                }
-            }
-            
-            conn.execute(
-                text("INSERT INTO message_store (session_id, message) VALUES (:session_id, CAST(:message AS jsonb))"),
-                {"session_id": session_id, "message": json.dumps(ai_msg)}
-            )
-            
-            conn.commit()
-            
-            print(f"💾 Saved conversation to history for session {session_id}")
-            
-            # Verificar que se guardó
-            result = conn.execute(
-                text("SELECT COUNT(*) FROM message_store WHERE session_id = :session_id"),
-                {"session_id": session_id}
-            )
-            count = result.scalar()
-            print(f"✅ Verification: Now have {count} messages in history")
+        with stage("history_save"):
+            await resources.history_store.save(session_id, human_message, ai_message)
+        if HISTORY_MODE == "budget":
+            schedule_summary(session_id)
             
     except Exception as e:
         print(f"⚠️ Error saving chat history: {e}")
         import traceback
         traceback.print_exc()
 
-# Template for standalone question generation from chat history
-template_with_history = """Given a chat history and the latest user question which might reference context in the chat history, formulate a standalone question which can be understood without the chat history. Do NOT answer the question, just reformulate it if needed and otherwise return it as is.
+# ========== RESUMEN ACUMULADO DEL HISTORIAL ==========
 
-Chat History:
-{chat_history}
+# Una tarea de resumen por sesión a la vez; la siguiente respuesta reprograma lo pendiente
+summary_tasks: Dict[str, asyncio.Task] = {}
 
-Follow Up Input: {question}
+def schedule_summary(session_id: str):
+    """Compactar en segundo plano los turnos que salieron del presupuesto de tokens"""
+    if session_id in summary_tasks:
+        return
+    # Contexto vacío: el resumen no se suma a los tiempos del request que lo dispara
+    task = asyncio.create_task(refresh_summary(session_id), context=contextvars.Context())
+    summary_tasks[session_id] = task
+    task.add_done_callback(lambda _: summary_tasks.pop(session_id, None))
 
-Standalone question:"""
-
-standalone_question_prompt = PromptTemplate.from_template(template_with_history)
+async def refresh_summary(session_id: str):
+    """Agregar al resumen los mensajes entre el último resumido y la ventana reciente"""
+    try:
+        summary, last_message_id, messages = await resources.history_store.load_context(session_id)
+        start = split_by_budget(messages, HISTORY_TOKEN_BUDGET)
+        if start == 0 and len(messages) < resources.history_store.max_messages:
+            # Todo lo posterior al resumen entra en el presupuesto
+            return
+        boundary = messages[start][0] if start < len(messages) else last_message_id + 1
+        while True:
+            pending = await resources.history_store.load_range(session_id, last_message_id, boundary, HISTORY_SUMMARY_BATCH)
+            if not pending:
+                return
+            # Trabajo de fondo: no le quita turno ni presupuesto a las respuestas interactivas
+            with stage("history_summary"), model_priority(BATCH):
+                summary = (await resources.summary_chain.ainvoke({
+                    "summary": summary or "",
+                    "new_lines": get_buffer_string([message for _, message in pending]),
+                    "max_tokens": HISTORY_SUMMARY_MAX_TOKENS,
+                })).strip()
+            last_message_id = pending[-1][0]
+            await resources.history_store.save_summary(session_id, summary, last_message_id)
+            print(f"📝 History summary updated (session: {session_id}, up to message {last_message_id})")
+    except Exception as e:
+        print(f"⚠️ Error updating history summary: {e}")
 
-def generate_standalone_question(question: str, chat_history: List) -> str:
+async def generate_standalone_question(question: str, chat_history: List) -> str:
     """Generar pregunta standalone basada en el historial"""
     if not chat_history or len(chat_history) == 0:
         print("🔍 No history, using original question")
@@ -173,34 +134,194 @@ def generate_standalone_question(question: str, chat_history: List) -> str:
     
     print(f"🔍 Generating standalone question with {len(recent_history)} recent messages")
     
-    standalone_chain = (
-        standalone_question_prompt 
-        | llm 
-        | StrOutputParser()
-    )
-    
-    standalone = standalone_chain.invoke({
-        "chat_history": history_text,
-        "question": question
-    })
+    with stage("standalone_rewrite"):
+        standalone = await resources.standalone_chain.ainvoke({
+            "chat_history": history_text,
+            "question": question
+        })
     print(f"🔍 Standalone question: {standalone}")
     return standalone
 
-# Chain base SIN historial (para cuando no hay session_id)
-simple_chain = (
-    RunnableParallel(
-        context=(itemgetter("question") | multiquery),
-        question=itemgetter("question"),
-        chat_history=itemgetter("chat_history")
-    ) |
-    RunnableParallel(
-        answer=(ANSWER_PROMPT | llm | StrOutputParser()),
-        docs=itemgetter("context")
+# ========== RECUPERACIÓN ESPECULATIVA ==========
+
+# Cuántas veces se lanzó la recuperación especulativa y cuántas se aprovechó
+speculation_stats = {"attempts": 0, "used": 0, "discarded": 0}
+
+def _normalize_question(question: str) -> str:
+    return " ".join(re.sub(r"[^\w\s]", " ", question.lower()).split())
+
+def questions_match(original: str, rewritten: str) -> bool:
+    """La reescritura no cambió (casi) nada respecto a la pregunta original"""
+    ratio = difflib.SequenceMatcher(None, _normalize_question(original), _normalize_question(rewritten)).ratio()
+    return ratio >= SPECULATION_MIN_SIMILARITY
+
+# ========== CACHÉ SEMÁNTICA DE RESPUESTAS ==========
+
+def history_digest(history_text: str) -> str:
+    """Hash del historial que entra en el prompt de respuesta ("" sin historial)"""
+    return hashlib.sha1(history_text.encode("utf-8")).hexdigest() if history_text else ""
+
+async def lookup_cached_answer(final_question: str, embedder=None, history_text: str = ""):
+    """Buscar una respuesta ya generada para una pregunta equivalente con el mismo historial"""
+    answer_cache = resources.answer_cache
+    if answer_cache is None:
+        return None
+    try:
+        # El embedding queda en la caché de embeddings: la recuperación no lo vuelve a pedir
+        vector = await (embedder or resources.embeddings).aembed_query(final_question)
+        cached = await answer_cache.lookup(vector, history_digest(history_text))
+        if cached:
+            print(f"🗃️ Answer cache hit (similarity {cached['similarity']:.3f}): {cached['question']}")
+        return cached
+    except Exception as e:
+        print(f"⚠️ Error reading answer cache: {e}")
+        return None
+
+async def cache_answer(final_question: str, answer: str, docs: List, embedder=None, history_text: str = ""):
+    answer_cache = resources.answer_cache
+    if answer_cache is None:
+        return
+    try:
+        vector = await (embedder or resources.embeddings).aembed_query(final_question)
+        await answer_cache.store(vector, final_question, answer, docs, history_digest(history_text))
+    except Exception as e:
+        print(f"⚠️ Error writing answer cache: {e}")
+
+async def replay_cached_answer(cached: dict, piece_size: int = 64):
+    """Reproducir una respuesta cacheada con el mismo formato de chunks que el stream"""
+    yield {"docs": cached["docs"]}
+    answer = cached["answer"]
+    for start in range(0, len(answer), piece_size):
+        yield {"answer": answer[start:start + piece_size]}
+
+async def lookup_unfiltered_answer(final_question: str, filters: Optional[MetadataFilter], history_text: str = ""):
+    # La caché no guarda el alcance de la respuesta: las consultas filtradas no la usan
+    return None if filters else await lookup_cached_answer(final_question, history_text=history_text)
+
+async def resolve_question(question: str, chat_history: List, filters: Optional[MetadataFilter] = None):
+    """Reescribir la pregunta y consultar la caché de respuestas.
+
+    En modo especulativo la recuperación sobre la pregunta original arranca
+    en paralelo con la reescritura; si la reescritura sale (casi) igual, se
+    usan esos resultados en vez de esperar otra ronda de MultiQuery.
+    Devuelve (pregunta final, respuesta cacheada o None, recuperación especulativa o None).
+    """
+    if not chat_history:
+        return question, await lookup_unfiltered_answer(question, filters), None
+
+    # La respuesta se genera con el historial en el prompt: la caché la busca con ese historial
+    history_text = get_buffer_string(chat_history)
+    if not SPECULATIVE_RETRIEVAL:
+        final_question = await generate_standalone_question(question, chat_history)
+        return final_question, await lookup_unfiltered_answer(final_question, filters, history_text), None
+
+    speculative = asyncio.create_task(resources.retriever.ainvoke(question, filters=filters))
+    try:
+        final_question = await generate_standalone_question(question, chat_history)
+        cached = await lookup_unfiltered_answer(final_question, filters, history_text)
+    except BaseException:
+        speculative.cancel()
+        raise
+
+    if cached:
+        speculative.cancel()
+        return final_question, cached, None
+
+    speculation_stats["attempts"] += 1
+    if questions_match(question, final_question):
+        speculation_stats["used"] += 1
+        print(f"⚡ Speculative retrieval used ({speculation_stats['used']}/{speculation_stats['attempts']})")
+        return final_question, None, speculative
+
+    speculative.cancel()
+    speculation_stats["discarded"] += 1
+    return final_question, None, None
+
+async def stream_answer(docs: List, final_question: str, history_text: str):
+    """Emitir las fuentes apenas termina la recuperación y luego los tokens"""
+    yield {"docs": docs}
+    async for token in resources.answer_generation.astream({
+        "context": docs,
+        "question": final_question,
+        "chat_history": history_text
+    }):
+        yield {"answer": token}
+
+async def produce_answer(final_question: str, history_text: str, speculative=None,
+                         filters: Optional[MetadataFilter] = None):
+    """Recuperar (solo entre los chunks que cumplen `filters`), generar y guardar en la caché de respuestas"""
+    if speculative is not None:
+        docs = await speculative
+    else:
+        docs = await resources.retriever.ainvoke(final_question, filters=filters)
+    docs = await pack_context(docs)
+    full_answer = ""
+    async for chunk in stream_answer(docs, final_question, history_text):
+        if isinstance(chunk.get("answer"), str):
+            full_answer += chunk["answer"]
+        yield chunk
+    if not filters:
+        await cache_answer(final_question, full_answer, docs, history_text=history_text)
+
+# ========== SINGLE-FLIGHT ==========
+
+# Requests concurrentes con la misma pregunta final comparten recuperación y generación
+flights = SingleFlight()
+
+def flight_key(final_question: str, history_text: str, filters: Optional[MetadataFilter] = None) -> tuple:
+    """Pregunta final normalizada + parámetros de recuperación (filtros incluidos).
+
+    El historial entra como hash: el prompt de respuesta lo incluye, y una
+    respuesta generada con la conversación de otra sesión no se comparte.
+    """
+    return (_normalize_question(final_question), history_digest(history_text), RETRIEVER_MODE, QUERY_ROUTING, RETRIEVAL_K, filters)
+
+async def answer_chunks(question: str, chat_history: List, filters: Optional[MetadataFilter] = None):
+    """Resolver la pregunta y devolver (pregunta final, chunks de fuentes y tokens).
+
+    Si ya hay un pipeline idéntico en curso se suscribe a él: recibe los
+    chunks ya emitidos y luego los nuevos en vivo.
+    """
+    final_question, cached, speculative = await resolve_question(question, chat_history, filters)
+    if cached:
+        return final_question, replay_cached_answer(cached)
+
+    history_text = get_buffer_string(chat_history) if chat_history else ""
+    if not COALESCE_REQUESTS:
+        return final_question, produce_answer(final_question, history_text, speculative, filters)
+
+    flight, leader = flights.join(
+        flight_key(final_question, history_text, filters),
+        lambda: produce_answer(final_question, history_text, speculative, filters),
     )
-).with_types(input_type=RagInput)
+    if not leader:
+        print(f"🔗 Joined in-flight answer for: {final_question}")
+        if speculative is not None:
+            speculative.cancel()
+    return final_question, flight.subscribe()
+
+async def collect_answer(chunks) -> dict:
+    """Juntar los chunks en {"answer", "docs"} para las respuestas no streaming"""
+    answer, docs = "", []
+    async for chunk in chunks:
+        if "docs" in chunk:
+            docs = chunk["docs"]
+        elif isinstance(chunk.get("answer"), str):
+            answer += chunk["answer"]
+    return {"answer": answer, "docs": docs}
+
+def fallback_chain(filters: Optional[MetadataFilter] = None):
+    """Chain simple para los fallbacks; con filtros, recuperando solo dentro de ellos"""
+    if not filters:
+        return resources.simple_chain
+    return RunnableParallel(
+        context=itemgetter("question") | resources.retriever.bind(filters=filters),
+        question=itemgetter("question"),
+        chat_history=lambda x: "",
+    ) | resources.answer_chain
 
 # Chain CON historial (implementación manual)
-async def chain_with_history(question: str, session_id: str):
+async def chain_with_history(question: str, session_id: str, filters: Optional[MetadataFilter] = None):
     """Chain con historial implementado manualmente"""
     try:
         print(f"\n{'='*60}")
@@ -209,38 +330,34 @@ async def chain_with_history(question: str, session_id: str):
         print(f"❓ Question: {question}")
         
         # Obtener historial
-        chat_history = get_chat_history(session_id)
+        chat_history = await get_chat_history(session_id)
         
-        # Generar pregunta standalone si hay historial
-        if chat_history and len(chat_history) > 0:
-            final_question = generate_standalone_question(question, chat_history)
-        else:
-            final_question = question
+        # Generar pregunta standalone (si hay historial), recuperar documentos y responder
+        final_question, chunks = await answer_chunks(question, chat_history, filters)
         
         print(f"✨ Final question: {final_question}")
         
-        history_text = get_buffer_string(chat_history) if chat_history else ""
-        result = await simple_chain.ainvoke({
-            "question": final_question,
-            "chat_history": history_text
-        })
+        result = await collect_answer(chunks)
         
-        # Guardar en historial
+        # Guardar en historial (cada caller en su sesión, aunque compartan el pipeline)
         answer_text = result.get("answer", "")
-        save_to_chat_history(session_id, question, answer_text)
+        await save_to_chat_history(session_id, question, answer_text)
         
         print(f"{'='*60}\n")
         return result
         
+    except SchedulerOverloaded:
+        # Sin capacidad para el modelo: el fallback volvería a chocar con el mismo límite
+        raise
     except Exception as e:
         # Fallback a chain simple sin historial
         print(f"❌ Error in chain_with_history: {e}")
         import traceback
         traceback.print_exc()
-        return await simple_chain.ainvoke({"question": question})
+        return await fallback_chain(filters).ainvoke({"question": question})
 
 # Stream con historial
-async def stream_with_history(question: str, session_id: str):
+async def stream_with_history(question: str, session_id: str, filters: Optional[MetadataFilter] = None):
     """Stream con historial implementado manualmente"""
     try:
         print(f"\n{'='*60}")
@@ -249,7 +366,7 @@ async def stream_with_history(question: str, session_id: str):
         print(f"❓ Question: {question}")
         
         # Obtener historial
-        chat_history = get_chat_history(session_id)
+        chat_history = await get_chat_history(session_id)
         
         # Detectar si la pregunta es sobre la conversación misma
         question_lower = question.lower().strip()
@@ -283,73 +400,135 @@ async def stream_with_history(question: str, session_id: str):
             yield {"answer": answer}
             
             # Guardar en historial
-            save_to_chat_history(session_id, question, answer)
+            await save_to_chat_history(session_id, question, answer)
             print(f"💾 Saved meta-conversation")
             print(f"{'='*60}\n")
             return
         
         # Para preguntas normales, continuar con el flujo normal
-        # Generar pregunta standalone si hay historial
-        if chat_history and len(chat_history) > 0:
-            final_question = generate_standalone_question(question, chat_history)
-        else:
-            final_question = question
+        # Generar pregunta standalone (si hay historial) y recuperar documentos
+        final_question, chunks = await answer_chunks(question, chat_history, filters)
         
         print(f"✨ Final question for streaming: {final_question}")
         
         # Recolectar la respuesta completa para guardarla después
         full_answer = ""
         
-        history_text = get_buffer_string(chat_history) if chat_history else ""
-        async for chunk in simple_chain.astream({
-            "question": final_question,
-            "chat_history": history_text
-        }):
-            # Capturar el texto de la respuesta
-            if isinstance(chunk, dict) and 'answer' in chunk:
-                answer_part = chunk['answer']
-                if hasattr(answer_part, 'content'):
-                    full_answer += answer_part.content
-                elif isinstance(answer_part, str):
-                    full_answer += answer_part
-            
-            yield chunk
+        # aclosing: si el cliente se desconecta, la suscripción al vuelo se cierra enseguida
+        async with aclosing(chunks):
+            async for chunk in chunks:
+                # Capturar el texto de la respuesta
+                if isinstance(chunk, dict) and 'answer' in chunk:
+                    answer_part = chunk['answer']
+                    if hasattr(answer_part, 'content'):
+                        full_answer += answer_part.content
+                    elif isinstance(answer_part, str):
+                        full_answer += answer_part
+                
+                yield chunk
         
         # Guardar en historial después del stream
         if full_answer:
-            save_to_chat_history(session_id, question, full_answer)
+            await save_to_chat_history(session_id, question, full_answer)
             print(f"💾 Saved streamed conversation")
         
         print(f"{'='*60}\n")
         
+    except SchedulerOverloaded:
+        raise
     except Exception as e:
         # Fallback a stream simple sin historial
         print(f"❌ Error in stream_with_history: {e}")
         import traceback
         traceback.print_exc()
-        async for chunk in simple_chain.astream({"question": question}):
+        async for chunk in fallback_chain(filters).astream({"question": question}):
+            yield chunk
+
+# Chain SIN historial (misma recuperación y caché que con historial)
+async def chain_without_history(question: str, filters: Optional[MetadataFilter] = None):
+    """Responder sin historial, consultando la caché de respuestas"""
+    _, chunks = await answer_chunks(question, [], filters)
+    return await collect_answer(chunks)
+
+async def stream_without_history(question: str, filters: Optional[MetadataFilter] = None):
+    """Stream sin historial, reproduciendo la respuesta cacheada si existe"""
+    _, chunks = await answer_chunks(question, [], filters)
+    async with aclosing(chunks):
+        async for chunk in chunks:
             yield chunk
 
 # Función principal para elegir la cadena correcta
-async def get_chain_response(question: str, config: dict = None):
+async def get_chain_response(question: str, config: dict = None, filters: Optional[MetadataFilter] = None):
     """Elige entre chain con historial o sin historial"""
     if config and config.get('configurable', {}).get('session_id'):
         session_id = config['configurable']['session_id']
         print(f"🔄 Using chain WITH history (session: {session_id})")
-        return await chain_with_history(question, session_id)
+        with stage("total"):
+            return await chain_with_history(question, session_id, filters)
     else:
         print(f"🔄 Using chain WITHOUT history")
-        return await simple_chain.ainvoke({"question": question})
+        with stage("total"):
+            return await chain_without_history(question, filters)
+
+async def answer_batch_question(question: str):
+    """Responder una pregunta del lote (sin historial) con los recursos compartidos"""
+    cached = await lookup_cached_answer(question, resources.batch_embeddings)
+    if cached:
+        return {"answer": cached["answer"], "docs": cached["docs"]}
+    docs = await pack_context(await resources.batch_retriever.ainvoke(question), resources.batch_context_packer)
+    result = await resources.answer_chain.ainvoke({
+        "context": docs,
+        "question": question,
+        "chat_history": ""
+    })
+    await cache_answer(question, result.get("answer", ""), docs, resources.batch_embeddings)
+    return result
+
+async def get_batch_responses(questions: List[str], concurrency: int = BATCH_QUERY_CONCURRENCY) -> AsyncIterator[dict]:
+    """Responder muchas preguntas con concurrencia acotada.
+
+    Produce {"index", "question", "answer", "docs"} (o "error") a medida que
+    cada pregunta termina, no en el orden de entrada.
+    """
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+
+    async def run(index: int, question: str):
+        async with semaphore:
+            try:
+                # Las preguntas del lote ceden el turno a los requests interactivos
+                with model_priority(BATCH), stage("total"):
+                    result = await answer_batch_question(question)
+                return {"index": index, "question": question, **result}
+            except Exception as e:
+                print(f"❌ Error in batch question {index}: {e}")
+                return {"index": index, "question": question, "error": str(e)}
+
+    tasks = [asyncio.create_task(run(index, question)) for index, question in enumerate(questions)]
+    try:
+        for finished in asyncio.as_completed(tasks):
+            yield await finished
+    finally:
+        # El cliente se desconectó o el consumidor dejó de iterar
+        for task in tasks:
+            task.cancel()
 
 # Función para streaming
-async def get_chain_stream(question: str, config: dict = None):
+async def get_chain_stream(question: str, config: dict = None, filters: Optional[MetadataFilter] = None):
     """Elige entre stream con historial o sin historial"""
+    started = time.perf_counter()
     if config and config.get('configurable', {}).get('session_id'):
         session_id = config['configurable']['session_id']
         print(f"🔄 Using stream WITH history (session: {session_id})")
-        async for chunk in stream_with_history(question, session_id):
-            yield chunk
+        chunks = stream_with_history(question, session_id, filters)
     else:
         print(f"🔄 Using stream WITHOUT history")
-        async for chunk in simple_chain.astream({"question": question}):
+        chunks = stream_without_history(question, filters)
+    
+    first_token = True
+    with stage("total"):
+        async for chunk in chunks:
+            # Tiempo hasta el primer token de la respuesta (las fuentes salen antes)
+            if first_token and isinstance(chunk, dict) and 'answer' in chunk:
+                observe_stage("ttft", time.perf_counter() - started)
+                first_token = False
             yield chunk
\ No newline at end of file
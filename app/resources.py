@@ -0,0 +1,381 @@
+import asyncio
+import functools
+import threading
+import time
+from operator import itemgetter
+from typing import Any, Callable, Dict, List, Optional
+
+import httpx
+from langchain_community.vectorstores.pgvector import PGVector
+from langchain_core.output_parsers import StrOutputParser
+from langchain_core.runnables import RunnableParallel
+from langchain_openai import ChatOpenAI
+
+from app.config import (
+    ANSWER_CACHE_ENABLED,
+    COLLECTION_NAME,
+    COLLECTION_SHARDS,
+    CONTEXT_PACKING,
+    DATABASE_URL,
+    EMBEDDING_DIMENSIONS,
+    HTTP_KEEPALIVE_EXPIRY,
+    HTTP_MAX_CONNECTIONS,
+    HTTP_MAX_KEEPALIVE_CONNECTIONS,
+    HTTP_TIMEOUT,
+    LEXICAL_INDEX_ENABLED,
+    MODEL_SCHEDULER,
+    QUERY_ROUTING,
+    RETRIEVAL_K,
+    RETRIEVER_MODE,
+    VECTOR_BACKEND,
+    WARMUP_POOL_CONNECTIONS,
+    WARMUP_RETRY_SECONDS,
+)
+from app.answer_cache import IngestVersionTracker, SemanticAnswerCache
+from app.batching import BatchingEmbeddings, BatchingSearcher
+from app.context_packing import ContextPacker
+from app.embedding_cache import build_embeddings
+from app.history import ChatHistoryStore
+from app.lexical import LexicalIndexReader
+from app.metrics import LLMMetricsCallbackHandler
+from app.mmap_index import MmapSearcher, MmapVectorIndex, MmapVectorStore, MmapVersionTracker
+from app.pgvector_admin import search_engine_args
+from app.prompts import ANSWER_PROMPT, RagInput, standalone_question_prompt, summary_prompt
+from app.retrieval import (
+    AdaptiveRetriever,
+    BatchedMultiQueryRetriever,
+    InstrumentedMultiQueryRetriever,
+    PGVectorSearcher,
+)
+from app.scheduling import ScheduledChatModel, scheduler_for
+
+
+def lazy(build: Callable[[Any], Any]) -> property:
+    """Recurso construido en el primer acceso, una sola vez aunque haya varios hilos.
+
+    El primer acceso bloquea (y puede esperar el lock de otro hilo que esté
+    construyendo): desde el event loop se pasa antes por `Resources.abuild`.
+    """
+    name = build.__name__
+
+    @functools.wraps(build)
+    def getter(self):
+        try:
+            return self._built[name]
+        except KeyError:
+            pass
+        with self._lock:
+            if name not in self._built:
+                started = time.perf_counter()
+                self._built[name] = build(self)
+                self.build_seconds[name] = round(time.perf_counter() - started, 4)
+            return self._built[name]
+
+    return property(getter)
+
+
+class Resources:
+    """Contenedor de los recursos del servidor: modelos, vector store, retrievers,
+    historial y cachés.
+
+    Nada se construye al importar: cada recurso se crea al primer uso (o en el
+    precalentamiento del lifespan), así importar `app.server` no necesita
+    variables de entorno ni la base de datos, y cada worker lee su propia
+    configuración al arrancar.
+    """
+
+    def __init__(self):
+        self._built: Dict[str, Any] = {}
+        self._lock = threading.RLock()
+        self._async_build_lock = asyncio.Lock()
+        self._all_built = False
+        self.build_seconds: Dict[str, float] = {}
+        # Lo marca el lifespan: al terminar el precalentamiento, o de entrada si no hay
+        self.ready = False
+        self.warmup_report: Dict[str, Dict] = {}
+
+    def peek(self, name: str) -> Optional[Any]:
+        """El recurso si ya se construyó, sin construirlo (para /stats y /metrics)"""
+        return self._built.get(name)
+
+    # ========== CLIENTES HTTP ==========
+
+    def _http_limits(self) -> httpx.Limits:
+        return httpx.Limits(
+            max_connections=HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+        )
+
+    @lazy
+    def http_client(self) -> httpx.Client:
+        # Compartido por el chat y los embeddings: mismas conexiones keep-alive a la API
+        return httpx.Client(limits=self._http_limits(), timeout=HTTP_TIMEOUT)
+
+    @lazy
+    def http_async_client(self) -> httpx.AsyncClient:
+        return httpx.AsyncClient(limits=self._http_limits(), timeout=HTTP_TIMEOUT)
+
+    # ========== MODELOS Y VECTOR STORE ==========
+
+    @lazy
+    def embeddings(self):
+        # Initialize embeddings with the modern model (cached on disk, shared with the loader)
+        return build_embeddings(http_client=self.http_client, http_async_client=self.http_async_client)
+
+    @lazy
+    def vector_index(self) -> Optional[MmapVectorIndex]:
+        # Índice en disco compartido por todos los workers vía page cache, sin base de datos
+        return MmapVectorIndex() if VECTOR_BACKEND == "mmap" else None
+
+    @lazy
+    def vector_store(self):
+        # Connect to the vector store (VECTOR_BACKEND: pgvector | mmap)
+        if self.vector_index is not None:
+            return MmapVectorStore(self.embeddings, self.vector_index)
+        return PGVector(
+            collection_name=COLLECTION_NAME,
+            connection_string=DATABASE_URL,
+            embedding_function=self.embeddings,
+            embedding_length=EMBEDDING_DIMENSIONS,
+            # ef_search / probes del índice ANN en cada conexión
+            engine_args=search_engine_args(),
+        )
+
+    @lazy
+    def llm(self):
+        # Initialize the LLM with modern model
+        # (stream_usage: el último chunk del stream trae el uso de tokens para /metrics)
+        model = 'gpt-4o-mini'
+        llm = ChatOpenAI(
+            temperature=0,
+            model=model,
+            streaming=True,
+            stream_usage=True,
+            callbacks=[LLMMetricsCallbackHandler()],
+            http_client=self.http_client,
+            http_async_client=self.http_async_client,
+        )
+        # Reescritura, MultiQuery, respuesta y resúmenes comparten concurrencia y presupuesto
+        return ScheduledChatModel(llm, scheduler_for("llm", model)) if MODEL_SCHEDULER else llm
+
+    # ========== RECUPERACIÓN ==========
+
+    @lazy
+    def multiquery(self):
+        # Create MultiQuery retriever for improved document retrieval
+        multiquery = InstrumentedMultiQueryRetriever.from_llm(
+            retriever=self.vector_store.as_retriever(search_kwargs={"k": RETRIEVAL_K}),
+            llm=self.llm,
+        )
+        # Con shards solo el searcher ve todas las colecciones: el vector store es una sola
+        if RETRIEVER_MODE == "batched" or (COLLECTION_SHARDS > 1 and self.vector_index is None):
+            # Mismas variantes, pero un solo embedding por lote, una sola consulta SQL y fusión RRF
+            return BatchedMultiQueryRetriever(
+                llm_chain=multiquery.llm_chain,
+                embeddings=self.embeddings,
+                searcher=self.searcher,
+                k=RETRIEVAL_K,
+            )
+        return multiquery
+
+    @lazy
+    def query_generator(self):
+        return self.multiquery.llm_chain
+
+    @lazy
+    def searcher(self):
+        # Búsqueda k-NN de varios vectores por round-trip sobre el backend configurado
+        return MmapSearcher(self.vector_index) if self.vector_index is not None else PGVectorSearcher()
+
+    @lazy
+    def lexical_index(self) -> Optional[LexicalIndexReader]:
+        return LexicalIndexReader() if LEXICAL_INDEX_ENABLED else None
+
+    @lazy
+    def retriever(self):
+        # Routing: búsqueda barata primero, MultiQuery solo si los resultados no son confiables
+        if QUERY_ROUTING:
+            return AdaptiveRetriever(
+                embeddings=self.embeddings,
+                searcher=self.searcher,
+                expander=self.multiquery,
+                lexical=self.lexical_index,
+                k=RETRIEVAL_K,
+            )
+        return self.multiquery
+
+    # Recuperación para /batch_query: las preguntas concurrentes del lote comparten
+    # las llamadas de embeddings y las búsquedas k-NN (micro-lotes), por eso usa
+    # siempre el retriever por lotes aunque RETRIEVER_MODE sea "multiquery"
+
+    @lazy
+    def batch_embeddings(self) -> BatchingEmbeddings:
+        return BatchingEmbeddings(self.embeddings)
+
+    @lazy
+    def batch_searcher(self) -> BatchingSearcher:
+        return BatchingSearcher(self.searcher)
+
+    @lazy
+    def batch_retriever(self):
+        batch_retriever = BatchedMultiQueryRetriever(
+            llm_chain=self.query_generator,
+            embeddings=self.batch_embeddings,
+            searcher=self.batch_searcher,
+            k=RETRIEVAL_K,
+        )
+        if QUERY_ROUTING:
+            return AdaptiveRetriever(
+                embeddings=self.batch_embeddings,
+                searcher=self.batch_searcher,
+                expander=batch_retriever,
+                lexical=self.lexical_index,
+                k=RETRIEVAL_K,
+            )
+        return batch_retriever
+
+    # Deduplicación y presupuesto de tokens del contexto antes de ANSWER_PROMPT
+
+    @lazy
+    def context_packer(self) -> Optional[ContextPacker]:
+        return ContextPacker(self.searcher, self.embeddings) if CONTEXT_PACKING else None
+
+    @lazy
+    def batch_context_packer(self) -> Optional[ContextPacker]:
+        return ContextPacker(self.batch_searcher, self.batch_embeddings) if CONTEXT_PACKING else None
+
+    # ========== CHAINS ==========
+
+    @lazy
+    def standalone_chain(self):
+        return standalone_question_prompt | self.llm | StrOutputParser()
+
+    @lazy
+    def summary_chain(self):
+        return summary_prompt | self.llm | StrOutputParser()
+
+    @lazy
+    def answer_generation(self):
+        # Generación de la respuesta a partir del contexto ya recuperado
+        return ANSWER_PROMPT | self.llm | StrOutputParser()
+
+    @lazy
+    def answer_chain(self):
+        # Chain de respuesta: recibe el contexto ya recuperado
+        return RunnableParallel(
+            answer=self.answer_generation,
+            docs=itemgetter("context"),
+        )
+
+    @lazy
+    def simple_chain(self):
+        # Chain base SIN historial (para cuando no hay session_id)
+        return (
+            RunnableParallel(
+                context=(itemgetter("question") | self.retriever),
+                question=itemgetter("question"),
+                chat_history=lambda x: x.get("chat_history", ""),
+            ) |
+            self.answer_chain
+        ).with_types(input_type=RagInput)
+
+    # ========== HISTORIAL Y CACHÉS ==========
+
+    @lazy
+    def history_store(self) -> ChatHistoryStore:
+        # Pool async para la base de datos de historial (no bloquea el event loop)
+        return ChatHistoryStore()
+
+    @lazy
+    def answer_cache(self) -> Optional[SemanticAnswerCache]:
+        # Respuestas indexadas por el embedding de la pregunta final; se invalidan al re-ingestar
+        # (con el backend mmap la versión es la generación del índice)
+        if not ANSWER_CACHE_ENABLED:
+            return None
+        tracker = MmapVersionTracker(self.vector_index) if self.vector_index is not None else IngestVersionTracker()
+        return SemanticAnswerCache(tracker)
+
+    # ========== CICLO DE VIDA ==========
+
+    def build_all(self):
+        """Construir todos los recursos (PGVector crea su esquema al construirse)"""
+        for name in (
+            "retriever", "batch_retriever", "context_packer", "batch_context_packer",
+            "standalone_chain", "summary_chain", "answer_chain", "simple_chain",
+            "history_store", "answer_cache",
+        ):
+            getattr(self, name)
+        self._all_built = True
+
+    async def abuild(self):
+        """build_all en un hilo, una sola vez: el event loop nunca espera el lock ni
+        las conexiones síncronas de PGVector y los engines"""
+        if self._all_built:
+            return
+        async with self._async_build_lock:
+            if not self._all_built:
+                await asyncio.to_thread(self.build_all)
+
+    async def _preload_index(self, vector: List[float]):
+        """Traer el índice a memoria y abrir las conexiones de búsqueda antes del primer request"""
+        await self.searcher.awarmup(vector, WARMUP_POOL_CONNECTIONS)
+        if self.lexical_index is not None:
+            await asyncio.to_thread(self.lexical_index.current)
+
+    async def warmup(self) -> Dict[str, Dict]:
+        """Construir todo, llenar el pool de historial, pedir un embedding de prueba y
+        precargar el índice. El worker queda listo solo cuando todos los pasos
+        salen bien: los que fallan se reintentan cada WARMUP_RETRY_SECONDS y el
+        reporte de /health/ready muestra cuál falta."""
+        report: Dict[str, Dict] = {}
+        vector = None
+
+        async def step(name: str, run):
+            if report.get(name, {}).get("ok"):
+                return
+            started = time.perf_counter()
+            try:
+                result = await run()
+                report[name] = {"ok": True, "seconds": round(time.perf_counter() - started, 3)}
+                return result
+            except Exception as e:
+                attempts = report.get(name, {}).get("attempts", 0) + 1
+                report[name] = {
+                    "ok": False, "seconds": round(time.perf_counter() - started, 3),
+                    "error": str(e), "attempts": attempts,
+                }
+                print(f"⚠️ Warmup step {name} failed (attempt {attempts}): {e}")
+                return None
+
+        while True:
+            # Construir en un hilo: PGVector y los engines conectan de forma síncrona
+            await step("build", self.abuild)
+
+            await step("history_pool", lambda: self.history_store.warmup(WARMUP_POOL_CONNECTIONS))
+            vector = await step("embedding", lambda: self.embeddings.aembed_query("warmup")) or vector
+            if vector is not None:
+                await step("vector_index", lambda: self._preload_index(vector))
+
+            self.warmup_report = report
+            if all(entry["ok"] for entry in report.values()) and "vector_index" in report:
+                break
+            await asyncio.sleep(WARMUP_RETRY_SECONDS)
+
+        self.ready = True
+        print(f"🔥 Warmup finished: {report}")
+        return report
+
+    async def close(self):
+        """Cerrar solo lo que se llegó a construir"""
+        for name in ("history_store", "answer_cache", "searcher"):
+            resource = self.peek(name)
+            if resource is not None:
+                await resource.close()
+        if self.peek("http_async_client") is not None:
+            await self.http_async_client.aclose()
+        if self.peek("http_client") is not None:
+            self.http_client.close()
+
+
+resources = Resources()
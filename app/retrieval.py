@@ -0,0 +1,458 @@
+import asyncio
+import functools
+import heapq
+import json
+import time
+from typing import Dict, List, Optional, Tuple
+
+from langchain_core.callbacks import AsyncCallbackManagerForRetrieverRun, CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.retrievers import BaseRetriever
+from pydantic import Field
+from langchain_core.runnables import Runnable
+from langchain.retrievers.multi_query import MultiQueryRetriever
+from sqlalchemy import create_engine, text
+
+from app.config import (
+    DATABASE_URL,
+    RETRIEVAL_K,
+    ROUTING_MIN_AGREEMENT,
+    ROUTING_MIN_SIMILARITY,
+    RRF_K,
+    VECTOR_MAX_OVERFLOW,
+    VECTOR_POOL_SIZE,
+    VECTOR_POOL_TIMEOUT,
+)
+from app.db import PooledDatabase
+from app.filters import MetadataFilter, store_filter
+from app.lexical import LexicalIndexReader
+from app.metrics import ROUTING_DECISIONS_TOTAL, ROUTING_SAVED_SECONDS_TOTAL, stage
+from app.pgvector_admin import COLLECTION_TABLE, EMBEDDING_TABLE, collection_for, search_engine_args, shard_collections
+
+# Un vector de consulta por fila, con su posición en el lote
+QUERIES_CTE = """queries AS (
+            SELECT ord - 1 AS query_index, CAST(vec AS vector) AS embedding
+            FROM unnest(CAST(:vectors AS text[])) WITH ORDINALITY AS q(vec, ord)
+        )"""
+
+COLLECTION_SQL = text(f"SELECT uuid FROM {COLLECTION_TABLE} WHERE name = :name")
+
+# Embeddings ya guardados de chunks recuperados (para deduplicar el contexto)
+VECTORS_SQL = text(f"""
+    SELECT custom_id, CAST(embedding AS text)
+    FROM {EMBEDDING_TABLE}
+    WHERE collection_id = ANY(CAST(:collection_ids AS uuid[])) AND custom_id = ANY(:ids)
+""")
+
+SearchResults = List[List[Tuple[Document, float]]]
+
+@functools.lru_cache(maxsize=256)
+def multi_search_sql(collection_id: str, filter_keys: Tuple[str, ...] = ()):
+    """Todas las búsquedas k-NN de una colección en un solo round-trip: un LATERAL por vector.
+
+    El uuid de la colección va literal para que el planner pueda usar el
+    índice ANN parcial de su shard. Con filtro, las filas que lo cumplen salen
+    primero por el índice de metadata (CTE materializada, una vez para todas
+    las consultas) y se ordenan por distancia exacta: nunca quedan menos de k
+    resultados por descartar filas después del índice ANN.
+    """
+    if not filter_keys:
+        return text(f"""
+            WITH {QUERIES_CTE}
+            SELECT q.query_index, r.document, r.cmetadata, r.custom_id, r.distance
+            FROM queries q
+            CROSS JOIN LATERAL (
+                SELECT e.document, e.cmetadata, e.custom_id, e.embedding <=> q.embedding AS distance
+                FROM {EMBEDDING_TABLE} e
+                WHERE e.collection_id = '{collection_id}'
+                ORDER BY e.embedding <=> q.embedding
+                LIMIT :k
+            ) r
+            ORDER BY q.query_index, r.distance
+        """)
+    conditions = " ".join(
+        f"AND (e.cmetadata->>'{key}') = ANY(CAST(:filter_{position} AS text[]))"
+        for position, key in enumerate(filter_keys)
+    )
+    return text(f"""
+        WITH {QUERIES_CTE},
+        scoped AS MATERIALIZED (
+            SELECT e.document, e.cmetadata, e.custom_id, e.embedding
+            FROM {EMBEDDING_TABLE} e
+            WHERE e.collection_id = '{collection_id}' {conditions}
+        )
+        SELECT q.query_index, r.document, r.cmetadata, r.custom_id, r.distance
+        FROM queries q
+        CROSS JOIN LATERAL (
+            SELECT s.document, s.cmetadata, s.custom_id, s.embedding <=> q.embedding AS distance
+            FROM scoped s
+            ORDER BY s.embedding <=> q.embedding
+            LIMIT :k
+        ) r
+        ORDER BY q.query_index, r.distance
+    """)
+
+
+def merge_shard_results(shards: List[SearchResults], k: int) -> SearchResults:
+    """Unir las búsquedas de varias colecciones: por consulta, los k de menor distancia.
+
+    Todas usan el mismo modelo de embeddings y distancia coseno exacta, así que
+    las distancias de distintas shards se comparan directamente.
+    """
+    return [
+        heapq.nsmallest(k, (hit for shard in shards for hit in shard[position]), key=lambda hit: hit[1])
+        for position in range(len(shards[0]))
+    ]
+
+
+def vector_literal(vector: List[float]) -> str:
+    return "[" + ",".join(repr(float(x)) for x in vector) + "]"
+
+
+class VectorSearcher:
+    """Búsqueda k-NN de varios vectores a la vez; cada backend de vectores implementa una.
+
+    `filters` (MetadataFilter) restringe la búsqueda a los chunks cuya
+    metadata cumple el filtro, antes de elegir los k vecinos.
+    """
+
+    async def asearch_many(self, vectors: List[List[float]], k: int = RETRIEVAL_K,
+                           filters: Optional[MetadataFilter] = None) -> SearchResults:
+        raise NotImplementedError
+
+    def search_many(self, vectors: List[List[float]], k: int = RETRIEVAL_K,
+                    filters: Optional[MetadataFilter] = None) -> SearchResults:
+        raise NotImplementedError
+
+    async def avectors(self, ids: List[str]) -> Dict[str, List[float]]:
+        """Vectores guardados de los chunks indicados; {} si el backend no los expone"""
+        return {}
+
+    async def awarmup(self, vector: List[float], connections: int = 1):
+        """Una búsqueda real antes del primer request (cachés e índice ANN calientes)"""
+        await self.asearch_many([vector], 1)
+
+    async def close(self):
+        pass
+
+
+class PGVectorSearcher(VectorSearcher):
+    """Búsqueda k-NN de varios vectores a la vez sobre la tabla de PGVector.
+
+    Con el corpus repartido en varias colecciones (COLLECTION_SHARDS) busca en
+    todas en paralelo, cada una por su conexión del pool, y se queda con los k
+    más cercanos; un filtro por `source` consulta solo las shards de esos archivos.
+    """
+
+    def __init__(self, url: str = DATABASE_URL, collection_names: Optional[List[str]] = None):
+        self.url = url
+        self.collection_names = collection_names or shard_collections()
+        self.db = PooledDatabase(
+            url, VECTOR_POOL_SIZE, VECTOR_MAX_OVERFLOW, VECTOR_POOL_TIMEOUT, **search_engine_args()
+        )
+        self._sync_engine = None
+        self._collection_ids: Dict[str, str] = {}
+
+    def _route(self, filters: Optional[MetadataFilter]) -> List[str]:
+        """Colecciones a consultar: todas, o solo las de las fuentes del filtro"""
+        sources = dict(filters or ()).get("source")
+        if not sources or len(self.collection_names) == 1:
+            return self.collection_names
+        wanted = {collection_for(source) for source in sources}
+        return [name for name in self.collection_names if name in wanted]
+
+    @staticmethod
+    def _params(vectors: List[List[float]], k: int, filters: Optional[MetadataFilter]) -> Dict:
+        params = {"vectors": [vector_literal(vector) for vector in vectors], "k": k}
+        for position, (_, values) in enumerate(filters or ()):
+            params[f"filter_{position}"] = list(values)
+        return params
+
+    def _sql(self, name: str, filters: Optional[MetadataFilter]):
+        return multi_search_sql(self._collection_ids[name], tuple(key for key, _ in filters or ()))
+
+    def _group(self, rows, count: int) -> SearchResults:
+        results: SearchResults = [[] for _ in range(count)]
+        for query_index, document, metadata, custom_id, distance in rows:
+            metadata = dict(metadata or {})
+            if custom_id is not None:
+                metadata.setdefault("id", custom_id)
+            results[query_index].append((Document(page_content=document, metadata=metadata), float(distance)))
+        return results
+
+    async def _resolve(self, conn, names: List[str]):
+        for name in names:
+            if name not in self._collection_ids:
+                self._collection_ids[name] = str((await conn.execute(COLLECTION_SQL, {"name": name})).scalar_one())
+
+    async def _asearch_collection(self, name: str, vectors: List[List[float]], k: int,
+                                  filters: Optional[MetadataFilter]) -> SearchResults:
+        async with self.db.connect() as conn:
+            await self._resolve(conn, [name])
+            rows = (await conn.execute(self._sql(name, filters), self._params(vectors, k, filters))).fetchall()
+        return self._group(rows, len(vectors))
+
+    async def asearch_many(self, vectors: List[List[float]], k: int = RETRIEVAL_K,
+                           filters: Optional[MetadataFilter] = None) -> SearchResults:
+        if not vectors:
+            return []
+        names = self._route(filters)
+        if not names:
+            return [[] for _ in vectors]
+        if len(names) == 1:
+            return await self._asearch_collection(names[0], vectors, k, filters)
+        shards = await asyncio.gather(*(self._asearch_collection(name, vectors, k, filters) for name in names))
+        return merge_shard_results(shards, k)
+
+    async def awarmup(self, vector: List[float], connections: int = 1):
+        # Conexiones abiertas de antemano: la búsqueda resuelve además las colecciones
+        await self.db.prefill(connections)
+        await self.asearch_many([vector], 1)
+
+    async def avectors(self, ids: List[str]) -> Dict[str, List[float]]:
+        if not ids:
+            return {}
+        async with self.db.connect() as conn:
+            await self._resolve(conn, self.collection_names)
+            params = {"collection_ids": [self._collection_ids[name] for name in self.collection_names], "ids": ids}
+            rows = (await conn.execute(VECTORS_SQL, params)).fetchall()
+        # El texto de un vector de pgvector ("[0.1,0.2,...]") es JSON válido
+        return {custom_id: json.loads(vector) for custom_id, vector in rows}
+
+    def search_many(self, vectors: List[List[float]], k: int = RETRIEVAL_K,
+                    filters: Optional[MetadataFilter] = None) -> SearchResults:
+        if not vectors:
+            return []
+        if self._sync_engine is None:
+            self._sync_engine = create_engine(self.url, pool_pre_ping=True, **search_engine_args())
+        # Camino sincrónico (poco usado): las shards se consultan una tras otra
+        shards = []
+        with self._sync_engine.connect() as conn:
+            for name in self._route(filters):
+                if name not in self._collection_ids:
+                    self._collection_ids[name] = str(conn.execute(COLLECTION_SQL, {"name": name}).scalar_one())
+                rows = conn.execute(self._sql(name, filters), self._params(vectors, k, filters)).fetchall()
+                shards.append(self._group(rows, len(vectors)))
+        return merge_shard_results(shards, k) if shards else [[] for _ in vectors]
+
+    async def close(self):
+        await self.db.dispose()
+        if self._sync_engine is not None:
+            self._sync_engine.dispose()
+
+
+def reciprocal_rank_fusion(results: SearchResults, rrf_k: int = RRF_K, limit: Optional[int] = None) -> List[Document]:
+    """Fusionar varias listas rankeadas con RRF: score = sum(1 / (rrf_k + rank)).
+
+    Cada documento devuelto lleva en metadata su `rrf_score` y la mejor
+    similitud coseno (`similarity`) entre todas las consultas.
+    """
+    fused: Dict[str, Dict] = {}
+    for ranked in results:
+        for rank, (doc, distance) in enumerate(ranked, start=1):
+            key = doc.metadata.get("id") or doc.page_content
+            entry = fused.setdefault(key, {"doc": doc, "score": 0.0, "distance": distance})
+            entry["score"] += 1.0 / (rrf_k + rank)
+            entry["distance"] = min(entry["distance"], distance)
+
+    ordered = sorted(fused.values(), key=lambda entry: entry["score"], reverse=True)
+    if limit:
+        ordered = ordered[:limit]
+
+    documents = []
+    for entry in ordered:
+        doc = entry["doc"]
+        doc.metadata["rrf_score"] = round(entry["score"], 6)
+        doc.metadata["similarity"] = round(1.0 - entry["distance"], 6)
+        documents.append(doc)
+    return documents
+
+
+class BatchedMultiQueryRetriever(BaseRetriever):
+    """MultiQuery con un solo embedding por lote y una sola consulta SQL.
+
+    Genera las variantes con el mismo llm_chain de MultiQueryRetriever, embebe
+    pregunta original + variantes en una llamada, busca los k vecinos de todas
+    en un round-trip y fusiona los resultados con Reciprocal Rank Fusion.
+    """
+
+    llm_chain: Runnable
+    embeddings: Embeddings
+    searcher: VectorSearcher
+    k: int = RETRIEVAL_K
+    rrf_k: int = RRF_K
+    limit: Optional[int] = None
+    include_original: bool = True
+
+    def _queries(self, query: str, variants: List[str]) -> List[str]:
+        queries = [query] if self.include_original else []
+        for variant in variants:
+            variant = variant.strip()
+            if variant and variant not in queries:
+                queries.append(variant)
+        return queries or [query]
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun,
+                                filters: Optional[MetadataFilter] = None) -> List[Document]:
+        with stage("multi_query_generation"):
+            variants = self.llm_chain.invoke({"question": query}, config={"callbacks": run_manager.get_child()})
+        queries = self._queries(query, variants)
+        with stage("embedding"):
+            vectors = self.embeddings.embed_documents(queries)
+        with stage("vector_search"):
+            results = self.searcher.search_many(vectors, self.k, filters)
+        return reciprocal_rank_fusion(results, self.rrf_k, self.limit)
+
+    async def _aget_relevant_documents(self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun,
+                                       filters: Optional[MetadataFilter] = None) -> List[Document]:
+        with stage("multi_query_generation"):
+            variants = await self.llm_chain.ainvoke({"question": query}, config={"callbacks": run_manager.get_child()})
+        queries = self._queries(query, variants)
+        with stage("embedding"):
+            vectors = await self.embeddings.aembed_documents(queries)
+        with stage("vector_search"):
+            results = await self.searcher.asearch_many(vectors, self.k, filters)
+        return reciprocal_rank_fusion(results, self.rrf_k, self.limit)
+
+
+class InstrumentedMultiQueryRetriever(MultiQueryRetriever):
+    """MultiQueryRetriever de LangChain con tiempos por etapa.
+
+    El retriever interno embebe y busca cada variante por separado, así que
+    ambas cosas quedan medidas juntas como `vector_search`. Los filtros de
+    metadata llegan al vector store como su argumento `filter`.
+    """
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun,
+                                filters: Optional[MetadataFilter] = None) -> List[Document]:
+        if not filters:
+            return super()._get_relevant_documents(query, run_manager=run_manager)
+        queries = self.generate_queries(query, run_manager)
+        if self.include_original:
+            queries.append(query)
+        with stage("vector_search"):
+            documents = [
+                doc for variant in queries
+                for doc in self.retriever.invoke(variant, config={"callbacks": run_manager.get_child()},
+                                                 filter=store_filter(filters))
+            ]
+        return self.unique_union(documents)
+
+    async def _aget_relevant_documents(self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun,
+                                       filters: Optional[MetadataFilter] = None) -> List[Document]:
+        if not filters:
+            return await super()._aget_relevant_documents(query, run_manager=run_manager)
+        queries = await self.agenerate_queries(query, run_manager)
+        if self.include_original:
+            queries.append(query)
+        with stage("vector_search"):
+            document_lists = await asyncio.gather(*(
+                self.retriever.ainvoke(variant, config={"callbacks": run_manager.get_child()}, filter=store_filter(filters))
+                for variant in queries
+            ))
+        return self.unique_union([doc for docs in document_lists for doc in docs])
+
+    def generate_queries(self, question: str, run_manager: CallbackManagerForRetrieverRun) -> List[str]:
+        with stage("multi_query_generation"):
+            return super().generate_queries(question, run_manager)
+
+    async def agenerate_queries(self, question: str, run_manager: AsyncCallbackManagerForRetrieverRun) -> List[str]:
+        with stage("multi_query_generation"):
+            return await super().agenerate_queries(question, run_manager)
+
+    def retrieve_documents(self, queries: List[str], run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        with stage("vector_search"):
+            return super().retrieve_documents(queries, run_manager)
+
+    async def aretrieve_documents(self, queries: List[str], run_manager: AsyncCallbackManagerForRetrieverRun) -> List[Document]:
+        with stage("vector_search"):
+            return await super().aretrieve_documents(queries, run_manager)
+
+
+class AdaptiveRetriever(BaseRetriever):
+    """Routing antes de la recuperación: expandir la consulta solo cuando hace falta.
+
+    Primero una pasada barata: un embedding + una búsqueda vectorial y, si hay
+    índice BM25, una búsqueda léxica. Si el mejor resultado es suficientemente
+    similar y ambas búsquedas coinciden, se devuelve su fusión RRF; si no, se
+    delega en `expander` (MultiQuery), que paga la llamada extra al LLM.
+    """
+
+    embeddings: Embeddings
+    searcher: VectorSearcher
+    expander: BaseRetriever
+    lexical: Optional[LexicalIndexReader] = None
+    k: int = RETRIEVAL_K
+    rrf_k: int = RRF_K
+    min_similarity: float = ROUTING_MIN_SIMILARITY
+    min_agreement: float = ROUTING_MIN_AGREEMENT
+    stats: Dict = Field(default_factory=lambda: {
+        "direct": 0, "expanded": 0, "expansion_seconds_avg": None, "latency_saved_seconds": 0.0,
+    })
+
+    def _route(self, vector_results: List[Tuple[Document, float]], lexical_results: List[Tuple[Document, float]]) -> Optional[str]:
+        """Motivo para expandir la consulta, o None si la pasada barata alcanza"""
+        if not vector_results or 1.0 - vector_results[0][1] < self.min_similarity:
+            return "low_score"
+        if lexical_results:
+            vector_ids = {doc.metadata.get("id") or doc.page_content for doc, _ in vector_results}
+            lexical_ids = {doc.metadata.get("id") or doc.page_content for doc, _ in lexical_results}
+            if len(vector_ids & lexical_ids) / max(len(vector_ids), 1) < self.min_agreement:
+                return "disagreement"
+        return None
+
+    def _direct(self, vector_results, lexical_results) -> List[Document]:
+        self.stats["direct"] += 1
+        ROUTING_DECISIONS_TOTAL.inc(route="direct", reason="confident")
+        saved = self.stats["expansion_seconds_avg"]
+        if saved:
+            # Lo que habría costado la expansión, según el promedio de las expansiones medidas
+            self.stats["latency_saved_seconds"] += saved
+            ROUTING_SAVED_SECONDS_TOTAL.inc(saved)
+        # BM25 no tiene distancia coseno: entra al ranking RRF sin aportar `similarity`
+        lexical_ranked = [(doc, 1.0) for doc, _ in lexical_results]
+        return reciprocal_rank_fusion([vector_results, lexical_ranked], self.rrf_k, self.k)
+
+    def _record_expansion(self, reason: str, seconds: float):
+        self.stats["expanded"] += 1
+        ROUTING_DECISIONS_TOTAL.inc(route="expanded", reason=reason)
+        average = self.stats["expansion_seconds_avg"]
+        # Media móvil exponencial: sigue los cambios de latencia del LLM
+        self.stats["expansion_seconds_avg"] = seconds if average is None else 0.8 * average + 0.2 * seconds
+
+    def snapshot(self) -> Dict:
+        total = self.stats["direct"] + self.stats["expanded"]
+        return {
+            **self.stats,
+            "latency_saved_seconds": round(self.stats["latency_saved_seconds"], 3),
+            "expansion_rate": round(self.stats["expanded"] / total, 4) if total else 0.0,
+        }
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun,
+                                filters: Optional[MetadataFilter] = None) -> List[Document]:
+        with stage("routing"):
+            vector_results = self.searcher.search_many([self.embeddings.embed_query(query)], self.k, filters)[0]
+            lexical_results = self.lexical.search(query, self.k, filters) if self.lexical else []
+        reason = self._route(vector_results, lexical_results)
+        if reason is None:
+            return self._direct(vector_results, lexical_results)
+        started = time.perf_counter()
+        docs = self.expander.invoke(query, config={"callbacks": run_manager.get_child()}, filters=filters)
+        self._record_expansion(reason, time.perf_counter() - started)
+        return docs
+
+    async def _aget_relevant_documents(self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun,
+                                       filters: Optional[MetadataFilter] = None) -> List[Document]:
+        with stage("routing"):
+            vector = await self.embeddings.aembed_query(query)
+            vector_results = (await self.searcher.asearch_many([vector], self.k, filters))[0]
+            # BM25 en Python puro (y la recarga del índice tras una ingesta): fuera del event loop
+            lexical_results = await asyncio.to_thread(self.lexical.search, query, self.k, filters) if self.lexical else []
+        reason = self._route(vector_results, lexical_results)
+        if reason is None:
+            return self._direct(vector_results, lexical_results)
+        started = time.perf_counter()
+        docs = await self.expander.ainvoke(query, config={"callbacks": run_manager.get_child()}, filters=filters)
+        self._record_expansion(reason, time.perf_counter() - started)
+        return docs
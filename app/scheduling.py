@@ -0,0 +1,362 @@
+import asyncio
+import heapq
+import itertools
+import math
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional, Tuple
+
+from langchain_core.embeddings import Embeddings
+from langchain_core.messages import BaseMessage, get_buffer_string
+from langchain_core.prompt_values import PromptValue
+from langchain_core.runnables import Runnable, RunnableConfig
+
+from app.config import (
+    EMBEDDING_MAX_CONCURRENCY,
+    EMBEDDING_TOKENS_PER_MINUTE,
+    LLM_MAX_CONCURRENCY,
+    LLM_OUTPUT_TOKENS_ESTIMATE,
+    LLM_TOKENS_PER_MINUTE,
+    SCHEDULER_MAX_QUEUE,
+    SCHEDULER_MAX_WAIT_S,
+)
+from app.metrics import MODEL_CALLS_SHED_TOTAL, MODEL_QUEUE_WAIT_SECONDS, observe_stage
+from app.tokens import count_tokens
+
+# Prioridades: el número menor pasa primero
+INTERACTIVE = "interactive"
+BATCH = "batch"
+INGEST = "ingest"
+PRIORITIES = {INTERACTIVE: 0, BATCH: 1, INGEST: 2}
+
+# Prioridad de las llamadas del request/tarea en curso (las tareas hijas la heredan)
+_priority: ContextVar[Optional[str]] = ContextVar("rag_model_priority", default=None)
+# Prioridad del proceso cuando el contexto no fija una (p. ej. los hilos de la ingesta)
+_process_priority = INTERACTIVE
+
+
+def current_priority() -> str:
+    return _priority.get() or _process_priority
+
+
+def set_process_priority(priority: str):
+    global _process_priority
+    _process_priority = priority
+
+
+@contextmanager
+def model_priority(priority: str):
+    """Ejecutar las llamadas a modelos del bloque con otra prioridad"""
+    token = _priority.set(priority)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+class SchedulerOverloaded(Exception):
+    """El scheduler rechazó una llamada interactiva (el servidor responde 429)"""
+
+    def __init__(self, model: str, reason: str, retry_after: float):
+        super().__init__(f"Model {model} is overloaded ({reason}), retry in {retry_after:.0f}s")
+        self.model = model
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """Presupuesto de tokens por minuto con reservas.
+
+    Cada llamada descuenta sus tokens al reservar; el nivel puede quedar
+    negativo (deuda) y quien reservó espera lo que tarda en recargarse.
+    Seguro entre hilos: lo usan tanto el event loop como la ingesta.
+    """
+
+    def __init__(self, tokens_per_minute: float):
+        self.capacity = float(tokens_per_minute)
+        self.rate = self.capacity / 60.0
+        self.level = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, tokens: int) -> float:
+        """Descontar `tokens` y devolver cuántos segundos esperar antes de llamar"""
+        with self._lock:
+            self._refill()
+            # Una llamada mayor que el presupuesto completo espera como mucho un minuto
+            self.level -= min(tokens, self.capacity)
+            return max(0.0, -self.level / self.rate)
+
+    def refund(self, tokens: int):
+        with self._lock:
+            self.level = min(self.capacity, self.level + min(tokens, self.capacity))
+
+    def available(self) -> float:
+        with self._lock:
+            self._refill()
+            return self.level
+
+
+class ModelScheduler:
+    """Admisión y ritmo de las llamadas a un modelo.
+
+    - Como mucho `max_concurrency` llamadas en vuelo; las demás esperan en
+      una cola ordenada por prioridad (y por llegada dentro de cada una).
+    - Antes de llamar se reservan los tokens estimados en el TokenBucket del
+      modelo: con el presupuesto agotado la llamada espera en vez de recibir
+      un 429 del proveedor.
+    - Las llamadas interactivas se rechazan enseguida (SchedulerOverloaded)
+      si ya hay `max_queue` interactivas esperando o si la espera superaría
+      `max_wait` segundos. Batch e ingesta nunca se rechazan: solo esperan.
+
+    La cola es de asyncio (un event loop por proceso). Las llamadas síncronas
+    (hilos de la ingesta, en su propio proceso) comparten el ritmo por
+    tokens y un semáforo de concurrencia aparte, sin prioridades.
+    """
+
+    def __init__(self, name: str, max_concurrency: int, tokens_per_minute: float,
+                 max_queue: int = SCHEDULER_MAX_QUEUE, max_wait: float = SCHEDULER_MAX_WAIT_S):
+        self.name = name
+        self.max_concurrency = max(1, max_concurrency)
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.bucket = TokenBucket(tokens_per_minute) if tokens_per_minute > 0 else None
+        self._active = 0
+        self._waiters: List[Tuple[int, int, asyncio.Future]] = []
+        self._seq = itertools.count()
+        self._sync_slots = threading.BoundedSemaphore(self.max_concurrency)
+        self.queued = {priority: 0 for priority in PRIORITIES}
+        self.stats = {"calls": 0, "waited": 0, "shed": 0, "wait_seconds_total": 0.0, "wait_seconds_max": 0.0}
+
+    # ---------- Admisión ----------
+
+    def _shed(self, reason: str, retry_after: float):
+        self.stats["shed"] += 1
+        MODEL_CALLS_SHED_TOTAL.inc(model=self.name, reason=reason)
+        raise SchedulerOverloaded(self.name, reason, retry_after)
+
+    def check_admission(self, priority: str = INTERACTIVE):
+        """Rechazar de entrada si la cola interactiva ya está llena"""
+        if priority == INTERACTIVE and self.queued[INTERACTIVE] >= self.max_queue:
+            self._shed("queue_full", self.max_wait)
+
+    async def _acquire(self, priority: str):
+        # Invariante: con slots libres la cola está vacía, así que nadie se salta a nadie
+        if self._active < self.max_concurrency:
+            self._active += 1
+            return
+        self.check_admission(priority)
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (PRIORITIES[priority], next(self._seq), future))
+        self.queued[priority] += 1
+        try:
+            if priority == INTERACTIVE:
+                await asyncio.wait_for(future, self.max_wait)
+            else:
+                await future
+        except BaseException as e:
+            if future.done() and not future.cancelled():
+                # El slot llegó junto con la cancelación o el timeout: devolverlo
+                self._release()
+            else:
+                future.cancel()
+            if isinstance(e, TimeoutError):
+                self._shed("timeout", self.max_wait)
+            raise
+        finally:
+            self.queued[priority] -= 1
+
+    def _release(self):
+        # El slot pasa directo al siguiente en espera (los cancelados se descartan)
+        while self._waiters:
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                future.set_result(None)
+                return
+        self._active -= 1
+
+    def _pace(self, tokens: int, priority: str) -> float:
+        """Reservar tokens; segundos a esperar (o rechazo si es interactivo y excede max_wait)"""
+        if self.bucket is None:
+            return 0.0
+        pause = self.bucket.reserve(tokens)
+        if pause > self.max_wait and priority == INTERACTIVE:
+            self.bucket.refund(tokens)
+            self._shed("rate_limit", pause)
+        return pause
+
+    def _record(self, priority: str, waited: float):
+        self.stats["calls"] += 1
+        MODEL_QUEUE_WAIT_SECONDS.observe(waited, model=self.name, priority=priority)
+        if waited >= 0.001:
+            self.stats["waited"] += 1
+            self.stats["wait_seconds_total"] += waited
+            self.stats["wait_seconds_max"] = max(self.stats["wait_seconds_max"], waited)
+            observe_stage("model_queue", waited)
+
+    @asynccontextmanager
+    async def slot(self, tokens: int, priority: Optional[str] = None):
+        """Esperar turno y presupuesto, y ocupar un slot mientras dura la llamada"""
+        priority = priority or current_priority()
+        started = time.perf_counter()
+        await self._acquire(priority)
+        try:
+            pause = self._pace(tokens, priority)
+            if pause > 0:
+                await asyncio.sleep(pause)
+            self._record(priority, time.perf_counter() - started)
+            yield
+        finally:
+            self._release()
+
+    @contextmanager
+    def slot_sync(self, tokens: int, priority: Optional[str] = None):
+        priority = priority or current_priority()
+        started = time.perf_counter()
+        with self._sync_slots:
+            pause = self._pace(tokens, priority)
+            if pause > 0:
+                time.sleep(pause)
+            self._record(priority, time.perf_counter() - started)
+            yield
+
+    def snapshot(self) -> Dict:
+        waited = self.stats["waited"]
+        return {
+            **self.stats,
+            "in_flight": self._active,
+            "max_concurrency": self.max_concurrency,
+            "queue_depth": dict(self.queued),
+            "tokens_available": round(self.bucket.available()) if self.bucket else None,
+            "wait_seconds_avg": round(self.stats["wait_seconds_total"] / waited, 4) if waited else 0.0,
+            "wait_seconds_total": round(self.stats["wait_seconds_total"], 4),
+            "wait_seconds_max": round(self.stats["wait_seconds_max"], 4),
+        }
+
+
+# ========== REGISTRO POR MODELO ==========
+
+# Un scheduler por modelo y proceso, compartido por todo lo que llama a ese modelo
+schedulers: Dict[str, ModelScheduler] = {}
+_registry_lock = threading.Lock()
+
+
+def scheduler_for(kind: str, model: str, tpm_share: float = 1.0) -> ModelScheduler:
+    """Scheduler del modelo (`kind`: "llm" | "embedding"), creado con su configuración"""
+    name = f"{kind}:{model}"
+    with _registry_lock:
+        if name not in schedulers:
+            if kind == "llm":
+                concurrency, tokens_per_minute = LLM_MAX_CONCURRENCY, LLM_TOKENS_PER_MINUTE
+            else:
+                concurrency, tokens_per_minute = EMBEDDING_MAX_CONCURRENCY, EMBEDDING_TOKENS_PER_MINUTE
+            schedulers[name] = ModelScheduler(name, concurrency, tokens_per_minute * tpm_share)
+        return schedulers[name]
+
+
+def check_admission(priority: str = INTERACTIVE):
+    """Rechazar un request antes de empezar si algún modelo tiene la cola llena"""
+    for scheduler in list(schedulers.values()):
+        scheduler.check_admission(priority)
+
+
+def schedulers_snapshot() -> Dict:
+    return {name: scheduler.snapshot() for name, scheduler in list(schedulers.items())}
+
+
+# ========== ENVOLTORIOS DE MODELOS ==========
+
+def _prompt_text(value: Any) -> str:
+    if isinstance(value, PromptValue):
+        return value.to_string()
+    if isinstance(value, str):
+        return value
+    if isinstance(value, list) and all(isinstance(item, BaseMessage) for item in value):
+        return get_buffer_string(value)
+    return str(value)
+
+
+class ScheduledChatModel(Runnable):
+    """Modelo de chat cuyas llamadas pasan por un ModelScheduler.
+
+    Se compone en los chains igual que el modelo (`prompt | llm | parser`);
+    en streaming el slot queda ocupado hasta el último token. Reserva los
+    tokens del prompt más `output_tokens` estimados de respuesta.
+    """
+
+    def __init__(self, bound: Runnable, scheduler: ModelScheduler, output_tokens: int = LLM_OUTPUT_TOKENS_ESTIMATE):
+        self.bound = bound
+        self.scheduler = scheduler
+        self.output_tokens = output_tokens
+
+    @property
+    def InputType(self):
+        return self.bound.InputType
+
+    @property
+    def OutputType(self):
+        return self.bound.OutputType
+
+    def get_name(self, suffix: Optional[str] = None, *, name: Optional[str] = None) -> str:
+        return self.bound.get_name(suffix, name=name)
+
+    def _tokens(self, input: Any) -> int:
+        return count_tokens(_prompt_text(input)) + self.output_tokens
+
+    def invoke(self, input: Any, config: Optional[RunnableConfig] = None, **kwargs: Any) -> Any:
+        with self.scheduler.slot_sync(self._tokens(input)):
+            return self.bound.invoke(input, config, **kwargs)
+
+    async def ainvoke(self, input: Any, config: Optional[RunnableConfig] = None, **kwargs: Any) -> Any:
+        async with self.scheduler.slot(self._tokens(input)):
+            return await self.bound.ainvoke(input, config, **kwargs)
+
+    def stream(self, input: Any, config: Optional[RunnableConfig] = None, **kwargs: Any) -> Iterator[Any]:
+        with self.scheduler.slot_sync(self._tokens(input)):
+            yield from self.bound.stream(input, config, **kwargs)
+
+    async def astream(self, input: Any, config: Optional[RunnableConfig] = None, **kwargs: Any) -> AsyncIterator[Any]:
+        async with self.scheduler.slot(self._tokens(input)):
+            async for chunk in self.bound.astream(input, config, **kwargs):
+                yield chunk
+
+
+class ScheduledEmbeddings(Embeddings):
+    """Embeddings cuyas llamadas a la API pasan por un ModelScheduler
+    (va debajo de la caché: los aciertos no consumen presupuesto)"""
+
+    def __init__(self, underlying: Embeddings, scheduler: ModelScheduler):
+        self.underlying = underlying
+        self.scheduler = scheduler
+
+    @staticmethod
+    def _tokens(texts: List[str]) -> int:
+        return sum(count_tokens(text) for text in texts)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        with self.scheduler.slot_sync(self._tokens(texts)):
+            return self.underlying.embed_documents(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        with self.scheduler.slot_sync(self._tokens([text])):
+            return self.underlying.embed_query(text)
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        async with self.scheduler.slot(self._tokens(texts)):
+            return await self.underlying.aembed_documents(texts)
+
+    async def aembed_query(self, text: str) -> List[float]:
+        async with self.scheduler.slot(self._tokens([text])):
+            return await self.underlying.aembed_query(text)
+
+
+def retry_after_seconds(error: SchedulerOverloaded) -> str:
+    """Valor del header Retry-After (segundos enteros, al menos 1)"""
+    return str(max(1, math.ceil(error.retry_after)))
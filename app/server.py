@@ -1,22 +1,61 @@
-from fastapi import FastAPI, File, UploadFile, HTTPException
-from fastapi.responses import RedirectResponse, StreamingResponse
+import contextlib
+from contextlib import asynccontextmanager
+from fastapi import Depends, FastAPI, File, UploadFile, HTTPException, Response
+from fastapi.responses import JSONResponse, PlainTextResponse, RedirectResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
-from typing import AsyncGenerator
+from typing import AsyncGenerator, List
 import asyncio
 import json
 import os
-import shutil
-import subprocess
+import time
 
 # Importar las funciones correctas desde rag_chain
-from app.rag_chain import get_chain_response, get_chain_stream
+from app.rag_chain import (
+    flights,
+    get_batch_responses,
+    get_chain_response,
+    get_chain_stream,
+    speculation_stats,
+)
+from app.config import BATCH_QUERY_CONCURRENCY, BATCH_QUERY_MAX_QUESTIONS, STREAM_COALESCE, STREAM_FLUSH_CHARS, STREAM_FLUSH_INTERVAL_MS, UPLOAD_AUTO_INDEX, WARMUP_ON_STARTUP
+from app.filters import normalize_filters
+from app.jobs import job_manager
+from app.resources import resources
+from app.scheduling import SchedulerOverloaded, check_admission, retry_after_seconds, schedulers_snapshot
+from app.uploads import save_upload
+from app.retrieval import AdaptiveRetriever
+from app.metrics import REGISTRY, REQUESTS_TOTAL, log_request, server_timing_header, start_request
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Precalentar los recursos al arrancar y cerrarlos al apagar el worker.
+
+    El precalentamiento corre en segundo plano: el proceso acepta conexiones
+    (liveness) enseguida y /health/ready responde 503 hasta que termina.
+    """
+    warmup = None
+    if WARMUP_ON_STARTUP:
+        warmup = asyncio.create_task(resources.warmup())
+    else:
+        resources.ready = True
+    try:
+        yield
+    finally:
+        if warmup is not None and not warmup.done():
+            warmup.cancel()
+        # Espera acotada al job de ingesta en curso, fuera del event loop
+        await asyncio.to_thread(job_manager.shutdown)
+        await resources.close()
+
 
 app = FastAPI(
     title="Modern RAG API",
     description="A modern RAG application for querying PDF documents (2025 update)",
-    version="5.0.0"
+    version="5.0.0",
+    lifespan=lifespan,
 )
 
 # Add CORS middleware to enable frontend communication
@@ -42,11 +81,99 @@ os.makedirs(pdf_directory, exist_ok=True)
 class QueryRequest(BaseModel):
     question: str
     config: dict = {}
+    # Filtros de metadata: {"source": "manual.pdf"} o {"source": ["a.pdf", "b.pdf"], "page": 3}
+    filters: dict = {}
 
 
 class QueryResponse(BaseModel):
     answer: str
     docs: list = []
+    # Score de fusión (RRF) de cada documento, alineado con `docs` (None si no tiene)
+    scores: list = []
+
+
+class BatchQueryRequest(BaseModel):
+    questions: List[str]
+    concurrency: int = BATCH_QUERY_CONCURRENCY
+
+
+class IngestJobRequest(BaseModel):
+    full: bool = False
+
+
+def request_filters(request: QueryRequest):
+    """Filtros normalizados del request; 400 si alguna clave no es filtrable"""
+    try:
+        return normalize_filters(request.filters)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+async def serving_resources():
+    """503 mientras el worker no está listo; si no, los recursos ya construidos.
+
+    Los recursos se construyen en un hilo (`resources.abuild`), así ningún
+    handler construye ni espera el lock de construcción en el event loop.
+    """
+    if not resources.ready:
+        raise HTTPException(status_code=503, detail="Worker is warming up", headers={"Retry-After": "1"})
+    await resources.abuild()
+
+
+def sse_event(payload: dict) -> str:
+    """Serializar un frame SSE con un payload JSON"""
+    return f"data: {json.dumps(payload)}\n\n"
+
+
+def overloaded(error: SchedulerOverloaded) -> HTTPException:
+    """429 con Retry-After cuando el scheduler de modelos rechaza el request"""
+    return HTTPException(status_code=429, detail=str(error), headers={"Retry-After": retry_after_seconds(error)})
+
+
+def runtime_metrics():
+    """Exportar en /metrics los mismos contadores que /stats (sin construir recursos)"""
+    families = []
+    history_store = resources.peek("history_store")
+    pool = history_store.stats() if history_store else None
+    if pool:
+        families.append(("rag_history_pool_connections", "gauge", "History pool connections by state", [
+            ({"state": "checked_out"}, pool["checked_out"]),
+            ({"state": "checked_in"}, pool["checked_in"]),
+            ({"state": "overflow"}, pool["overflow"]),
+        ]))
+        families.append(("rag_history_pool_wait_seconds_total", "counter", "Time spent waiting for a history connection",
+                         [({}, pool["wait_seconds_total"])]))
+    families.append(("rag_speculative_retrievals_total", "counter", "Speculative retrievals by outcome", [
+        ({"outcome": "used"}, speculation_stats["used"]),
+        ({"outcome": "discarded"}, speculation_stats["discarded"]),
+    ]))
+    embedding_stats = getattr(resources.peek("embeddings"), "stats", None)
+    if embedding_stats:
+        families.append(("rag_embedding_calls_total", "counter", "Embedding API calls (cache misses are batched per call)",
+                         [({}, embedding_stats["calls"])]))
+        families.append(("rag_embedding_cache_lookups_total", "counter", "Embedding cache lookups by result", [
+            ({"result": "hit"}, embedding_stats["hits"]),
+            ({"result": "miss"}, embedding_stats["misses"]),
+        ]))
+    answer_cache = resources.peek("answer_cache")
+    if answer_cache:
+        families.append(("rag_answer_cache_lookups_total", "counter", "Answer cache lookups by result", [
+            ({"result": "hit"}, answer_cache.stats["hits"]),
+            ({"result": "miss"}, answer_cache.stats["misses"]),
+        ]))
+    model_stats = schedulers_snapshot()
+    if model_stats:
+        families.append(("rag_model_queue_depth", "gauge", "Model calls waiting for a scheduler slot", [
+            ({"model": name, "priority": priority}, depth)
+            for name, stats in model_stats.items() for priority, depth in stats["queue_depth"].items()
+        ]))
+        families.append(("rag_model_in_flight", "gauge", "Model calls holding a scheduler slot", [
+            ({"model": name}, stats["in_flight"]) for name, stats in model_stats.items()
+        ]))
+    return families
+
+
+REGISTRY.add_collector(runtime_metrics)
 
 
 @app.get("/")
@@ -54,85 +181,171 @@ async def redirect_root_to_docs():
     return RedirectResponse("/docs")
 
 
-@app.post("/query", response_model=QueryResponse)
-async def query_documents(request: QueryRequest):
+@app.post("/query", response_model=QueryResponse, dependencies=[Depends(serving_resources)])
+async def query_documents(request: QueryRequest, response: Response):
     """
     Query the RAG system with a question about the uploaded documents.
+    Optional `filters` restrict retrieval to chunks whose metadata matches
+    (e.g. {"source": "manual.pdf"}).
+    Stage timings are returned in the Server-Timing header.
     """
+    REQUESTS_TOTAL.inc(endpoint="query")
+    filters = request_filters(request)
+    timings = start_request()
     try:
+        check_admission()
         result = await get_chain_response(
             question=request.question,
-            config=request.config if hasattr(request, 'config') and request.config else None
+            config=request.config if hasattr(request, 'config') and request.config else None,
+            filters=filters,
         )
         
+        response.headers["Server-Timing"] = server_timing_header(timings)
+        log_request("query", timings)
+        docs = result.get("docs", [])
         return QueryResponse(
             answer=str(result.get("answer", "")),
-            docs=[doc.page_content for doc in result.get("docs", [])]
+            docs=[doc.page_content for doc in docs],
+            scores=[doc.metadata.get("rrf_score") for doc in docs]
         )
+    except SchedulerOverloaded as e:
+        raise overloaded(e)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error processing query: {str(e)}")
 
 
-@app.post("/stream")
+@app.post("/stream", dependencies=[Depends(serving_resources)])
 async def stream_query(request: QueryRequest):
     """
     Stream the RAG response for real-time interaction.
+    Accepts the same `filters` as /query.
+    The headers go out before any stage runs, so stage timings are sent
+    as a final `timings` frame right before [DONE].
+    Returns 429 before streaming when the model queues are full.
     """
+    REQUESTS_TOTAL.inc(endpoint="stream")
+    filters = request_filters(request)
+    try:
+        check_admission()
+    except SchedulerOverloaded as e:
+        raise overloaded(e)
+    
     async def generate_response():
+        timings = start_request()
         try:
             collected_answer = ""
             collected_docs = []
             
-            async for chunk in get_chain_stream(
+            # Tokens pendientes de enviar: se agrupan en un solo frame SSE
+            pending = []
+            pending_chars = 0
+            first_token_sent = False
+            last_flush = time.monotonic()
+            
+            def flush() -> str:
+                nonlocal pending, pending_chars, first_token_sent, last_flush
+                event = sse_event({'chunk': {'answer': "".join(pending)}})
+                pending, pending_chars = [], 0
+                first_token_sent = True
+                last_flush = time.monotonic()
+                return event
+            
+            stream = get_chain_stream(
                 question=request.question,
-                config=request.config if hasattr(request, 'config') and request.config else None
-            ):
-                # Procesar cada chunk según su tipo
-                if isinstance(chunk, dict):
-                    # Si el chunk tiene 'answer', es contenido de texto
-                    if 'answer' in chunk:
-                        answer_content = chunk['answer']
-                        # Extraer el contenido del mensaje si es un objeto
-                        if hasattr(answer_content, 'content'):
-                            text_chunk = answer_content.content
-                        elif isinstance(answer_content, str):
-                            text_chunk = answer_content
-                        else:
-                            text_chunk = str(answer_content)
+                config=request.config if hasattr(request, 'config') and request.config else None,
+                filters=filters,
+            )
+            # El siguiente chunk se espera como tarea: si el modelo se demora, lo
+            # pendiente sale al vencer STREAM_FLUSH_INTERVAL_MS sin cancelar la espera
+            next_chunk = None
+            try:
+                while True:
+                    if next_chunk is None:
+                        next_chunk = asyncio.ensure_future(anext(stream))
+                    timeout = None
+                    if pending:
+                        timeout = max(0.0, STREAM_FLUSH_INTERVAL_MS / 1000 - (time.monotonic() - last_flush))
+                    done, _ = await asyncio.wait({next_chunk}, timeout=timeout)
+                    if not done:
+                        yield flush()
+                        continue
+                    try:
+                        chunk = next_chunk.result()
+                    except StopAsyncIteration:
+                        break
+                    finally:
+                        next_chunk = None
+                    
+                    # Procesar cada chunk según su tipo
+                    if isinstance(chunk, dict):
+                        # Si el chunk tiene 'docs', son los documentos fuente
+                        if 'docs' in chunk:
+                            docs = chunk['docs']
+                            collected_docs = docs
                         
-                        collected_answer += text_chunk
+                            # Extraer las fuentes de los documentos
+                            sources = []
+                            for doc in docs:
+                                if hasattr(doc, 'metadata') and 'source' in doc.metadata:
+                                    # Extraer solo el nombre del archivo, no la ruta completa
+                                    full_path = doc.metadata['source']
+                                    filename = os.path.basename(full_path)
+                                    sources.append(filename)
                         
-                        # Enviar el chunk de texto al frontend
-                        yield f"data: {json.dumps({'chunk': {'answer': text_chunk}})}\n\n"
+                            # Enviar las fuentes al frontend (llegan antes que el primer token)
+                            if sources:
+                                yield sse_event({'chunk': {'docs': sources}})
                     
-                    # Si el chunk tiene 'docs', son los documentos fuente
-                    if 'docs' in chunk:
-                        docs = chunk['docs']
-                        collected_docs = docs
+                        # Si el chunk tiene 'answer', es contenido de texto
+                        if 'answer' in chunk:
+                            answer_content = chunk['answer']
+                            # Extraer el contenido del mensaje si es un objeto
+                            if hasattr(answer_content, 'content'):
+                                text_chunk = answer_content.content
+                            elif isinstance(answer_content, str):
+                                text_chunk = answer_content
+                            else:
+                                text_chunk = str(answer_content)
+                        
+                            collected_answer += text_chunk
                         
-                        # Extraer las fuentes de los documentos
-                        sources = []
-                        for doc in docs:
-                            if hasattr(doc, 'metadata') and 'source' in doc.metadata:
-                                # Extraer solo el nombre del archivo, no la ruta completa
-                                full_path = doc.metadata['source']
-                                filename = os.path.basename(full_path)
-                                sources.append(filename)
+                            if not STREAM_COALESCE:
+                                yield sse_event({'chunk': {'answer': text_chunk}})
+                                continue
                         
-                        # Enviar las fuentes al frontend
-                        if sources:
-                            yield f"data: {json.dumps({'chunk': {'docs': sources}})}\n\n"
-                
-                # Pequeña pausa para evitar saturar la conexión
-                await asyncio.sleep(0.01)
+                            pending.append(text_chunk)
+                            pending_chars += len(text_chunk)
+                            
+                            # El primer token sale enseguida; los demás se agrupan por tamaño o tiempo
+                            if (
+                                not first_token_sent
+                                or pending_chars >= STREAM_FLUSH_CHARS
+                                or (time.monotonic() - last_flush) * 1000 >= STREAM_FLUSH_INTERVAL_MS
+                            ):
+                                yield flush()
+            finally:
+                if next_chunk is not None:
+                    next_chunk.cancel()
+                    with contextlib.suppress(BaseException):
+                        await next_chunk
+                await stream.aclose()
+            
+            if pending:
+                yield flush()
+            
+            log_request("stream", timings)
+            yield sse_event({'timings': {name: round(seconds * 1000, 1) for name, seconds in timings.items()}})
             
             # Enviar mensaje de finalización
             yield f"data: [DONE]\n\n"
             
+        except SchedulerOverloaded as e:
+            # Ya se enviaron los headers: el rechazo va como frame de error
+            yield sse_event({'error': f"Error in streaming: {e}", 'retry_after': e.retry_after})
         except Exception as e:
             error_msg = f"Error in streaming: {str(e)}"
             print(error_msg)  # Log para debugging
-            yield f"data: {json.dumps({'error': error_msg})}\n\n"
+            yield sse_event({'error': error_msg})
     
     return StreamingResponse(
         generate_response(),
@@ -145,52 +358,189 @@ async def stream_query(request: QueryRequest):
     )
 
 
+@app.post("/batch_query", dependencies=[Depends(serving_resources)])
+async def batch_query(request: BatchQueryRequest):
+    """
+    Answer many questions (without history) with bounded concurrency.
+    Embedding calls and vector searches are shared across the batch.
+    Results are streamed as NDJSON, one line per question as soon as it finishes:
+    `{"index", "question", "answer", "docs", "scores"}` or `{"index", "question", "error"}`.
+    """
+    if len(request.questions) > BATCH_QUERY_MAX_QUESTIONS:
+        raise HTTPException(
+            status_code=413,
+            detail=f"Too many questions ({len(request.questions)}), the limit is {BATCH_QUERY_MAX_QUESTIONS}"
+        )
+    REQUESTS_TOTAL.inc(endpoint="batch_query")
+    concurrency = max(1, min(request.concurrency, BATCH_QUERY_CONCURRENCY))
+
+    async def generate_results():
+        async for result in get_batch_responses(request.questions, concurrency=concurrency):
+            if "error" not in result:
+                docs = result.get("docs", [])
+                result = {
+                    "index": result["index"],
+                    "question": result["question"],
+                    "answer": str(result.get("answer", "")),
+                    "docs": [doc.page_content for doc in docs],
+                    "scores": [doc.metadata.get("rrf_score") for doc in docs],
+                }
+            yield json.dumps(result) + "\n"
+
+    return StreamingResponse(generate_results(), media_type="application/x-ndjson")
+
+
 @app.post("/upload")
-async def upload_files(files: list[UploadFile] = File(...)):
+async def upload_files(files: list[UploadFile] = File(...), index: bool = UPLOAD_AUTO_INDEX):
     """
     Upload one or more PDF files to the server.
+    Files are copied in chunks off the event loop and hashed; content that is already
+    indexed is skipped instead of overwriting anything. Content already uploaded but
+    not indexed (e.g. its job failed) reuses the existing file.
+    With `index=true` a job indexes just the new or unindexed files right away.
     """
+    for file in files:
+        # Validate file type
+        if not file.filename.lower().endswith('.pdf'):
+            raise HTTPException(status_code=400, detail=f"Invalid file type: {file.filename}. Only PDF files are allowed.")
+
     uploaded_files = []
+    duplicates = []
     for file in files:
         try:
-            # Validate file type
-            if not file.filename.lower().endswith('.pdf'):
-                raise HTTPException(status_code=400, detail=f"Invalid file type: {file.filename}. Only PDF files are allowed.")
-            
-            # Save file to PDF directory
-            file_path = os.path.join(pdf_directory, file.filename)
-            with open(file_path, "wb") as buffer:
-                shutil.copyfileobj(file.file, buffer)
-            uploaded_files.append(file.filename)
+            result = await save_upload(file)
         except Exception as e:
             raise HTTPException(status_code=500, detail=f"Could not save file {file.filename}: {e}")
-    
-    return {"message": "Files uploaded successfully", "filenames": uploaded_files}
+        if result["status"] == "duplicate":
+            duplicates.append({"filename": file.filename, "existing": result["existing"]})
+        elif result["filename"] not in uploaded_files:
+            uploaded_files.append(result["filename"])
+
+    job = job_manager.submit(paths=uploaded_files) if index and uploaded_files else None
+    return {
+        "message": "Files uploaded successfully",
+        "filenames": uploaded_files,
+        "duplicates": duplicates,
+        "job": job,
+    }
 
 
-@app.post("/load-and-process-pdfs")
+@app.post("/load-and-process-pdfs", status_code=202)
 async def load_and_process_pdfs():
     """
     Load and process all PDF files from the pdf-documents directory.
+    The work runs as a background ingest job; poll /ingest/jobs/{job_id} for progress.
     """
-    try:
-        # Run the RAG data loader script to process PDFs
-        subprocess.run(["python", "./rag-data-loader/rag_load_and_process.py"], check=True, cwd=".")
-        return {"message": "PDFs loaded and processed successfully"}
-    except subprocess.CalledProcessError as e:
-        raise HTTPException(status_code=500, detail=f"Failed to execute processing script: {e}")
-    except FileNotFoundError:
-        raise HTTPException(status_code=500, detail="Processing script not found. Please ensure rag-data-loader/rag_load_and_process.py exists.")
+    job = job_manager.submit(full=False)
+    return {"message": "PDF processing job enqueued", "job_id": job["id"], "job": job}
+
+
+@app.post("/ingest/jobs", status_code=202)
+async def create_ingest_job(request: IngestJobRequest = IngestJobRequest()):
+    """
+    Enqueue an ingest job (incremental by default, full rebuild with `full: true`).
+    Jobs run one at a time in a separate worker process.
+    """
+    return job_manager.submit(full=request.full)
+
+
+@app.get("/ingest/jobs")
+async def list_ingest_jobs():
+    """
+    List queued, running and recently finished ingest jobs.
+    """
+    return {"jobs": job_manager.list()}
+
+
+@app.get("/ingest/jobs/{job_id}")
+async def get_ingest_job(job_id: str):
+    """
+    Report the status and progress (files parsed, chunks embedded, rows written, throughput) of a job.
+    """
+    job = job_manager.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found")
+    return job
+
+
+@app.delete("/ingest/jobs/{job_id}")
+async def cancel_ingest_job(job_id: str):
+    """
+    Cancel a queued job, or stop a running one after the file it is currently processing.
+    """
+    job = job_manager.cancel(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found")
+    return job
+
+
+@app.get("/stats")
+async def get_stats():
+    """
+    Runtime statistics (history connection pool sizing and wait times,
+    speculative retrieval usage, answer cache hits/misses, query routing,
+    /batch_query micro-batch sizes, coalesced identical requests, context packing,
+    model scheduler queue depth and waits,
+    resource build and warmup times). Resources that were never used report null.
+    """
+    def snapshot(name: str):
+        resource = resources.peek(name)
+        return resource.snapshot() if resource is not None else None
+
+    speculation = dict(speculation_stats)
+    speculation["hit_rate"] = round(speculation["used"] / speculation["attempts"], 4) if speculation["attempts"] else 0.0
+    history_store = resources.peek("history_store")
+    retriever = resources.peek("retriever")
+    batch_embeddings = resources.peek("batch_embeddings")
+    batch_searcher = resources.peek("batch_searcher")
+    return {
+        "history_pool": history_store.stats() if history_store else None,
+        "speculation": speculation,
+        "answer_cache": snapshot("answer_cache"),
+        "routing": retriever.snapshot() if isinstance(retriever, AdaptiveRetriever) else None,
+        "coalescing": flights.snapshot(),
+        "scheduler": schedulers_snapshot(),
+        "context_packing": snapshot("context_packer"),
+        "batching": {
+            "embedding": batch_embeddings.batcher.snapshot() if batch_embeddings else None,
+            "search": batch_searcher.batcher.snapshot() if batch_searcher else None,
+            "context_packing": snapshot("batch_context_packer"),
+        },
+        "resources": {
+            "ready": resources.ready,
+            "build_seconds": resources.build_seconds,
+            "warmup": resources.warmup_report,
+        },
+    }
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    """
+    Prometheus metrics: per-stage latency histograms, token and embedding call counters.
+    """
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
 
 
 @app.get("/health")
+@app.get("/health/live")
 async def health_check():
     """
-    Simple health check endpoint.
+    Liveness check: the process is up and serving the event loop.
     """
     return {"status": "healthy", "version": "5.0.0"}
 
 
+@app.get("/health/ready")
+async def readiness_check():
+    """
+    Readiness check: 503 until the startup warmup (model clients, DB pools,
+    test embedding, index preload) has finished, with the per-step report.
+    """
+    body = {"status": "ready" if resources.ready else "warming_up", "warmup": resources.warmup_report}
+    return JSONResponse(body, status_code=200 if resources.ready else 503)
+
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
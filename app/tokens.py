@@ -0,0 +1,34 @@
+import threading
+from typing import Optional
+
+import tiktoken
+
+# Modelo de chat usado para las respuestas (define el tokenizer)
+TOKENIZER_MODEL = "gpt-4o-mini"
+
+_encoding: Optional[tiktoken.Encoding] = None
+_encoding_failed = False
+_lock = threading.Lock()
+
+
+def get_encoding() -> Optional[tiktoken.Encoding]:
+    """Tokenizer del modelo, cargado una sola vez (tiktoken lo descarga la primera vez)"""
+    global _encoding, _encoding_failed
+    if _encoding is None and not _encoding_failed:
+        with _lock:
+            if _encoding is None and not _encoding_failed:
+                try:
+                    _encoding = tiktoken.encoding_for_model(TOKENIZER_MODEL)
+                except Exception as e:
+                    # Sin red ni caché de tiktoken: estimar en vez de fallar
+                    print(f"⚠️ Could not load tiktoken encoding, estimating token counts: {e}")
+                    _encoding_failed = True
+    return _encoding
+
+
+def count_tokens(text: str) -> int:
+    encoding = get_encoding()
+    if encoding is None:
+        # ~4 caracteres por token en inglés/español
+        return (len(text) + 3) // 4
+    return len(encoding.encode(text, disallowed_special=()))
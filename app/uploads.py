@@ -0,0 +1,95 @@
+import asyncio
+import hashlib
+import os
+import uuid
+from typing import Dict, Optional, Tuple
+
+from fastapi import UploadFile
+
+from app.config import INGEST_MANIFEST_PATH, PDF_DIRECTORY, UPLOAD_CHUNK_BYTES
+
+
+def _write_block(buffer, digest, block: bytes):
+    digest.update(block)
+    buffer.write(block)
+
+
+def _candidate_names(filename: str, content_hash: str):
+    """Nombre original y, si está ocupado por otro contenido, uno con el hash"""
+    stem, ext = os.path.splitext(filename)
+    return [filename, f"{stem}-{content_hash[:8]}{ext}"]
+
+
+def _find_existing(pdf_dir: str, filename: str, content_hash: str) -> Tuple[Optional[str], bool]:
+    """(ruta relativa de un archivo con el mismo contenido, si ya está indexado).
+
+    Solo un archivo del manifiesto es un duplicado: uno que ya está en el
+    directorio pero sin indexar (p. ej. su job falló o se canceló) se reutiliza
+    y se vuelve a encolar.
+    """
+    # Importar aquí para que el servidor no cargue el pipeline de ingesta al arrancar
+    from app.ingest import file_sha256, find_indexed, load_manifest
+
+    indexed = find_indexed(load_manifest(INGEST_MANIFEST_PATH), content_hash)
+    if indexed:
+        return indexed, True
+    for name in _candidate_names(filename, content_hash):
+        path = os.path.join(pdf_dir, name)
+        if os.path.exists(path) and file_sha256(path) == content_hash:
+            return name, False
+    return None, False
+
+
+def _publish(tmp_path: str, pdf_dir: str, filename: str, content_hash: str) -> str:
+    """Mover el temporal al primer nombre libre (os.link falla si el nombre ya existe,
+    así dos subidas concurrentes nunca se pisan)"""
+    stem, ext = os.path.splitext(filename)
+    for name in _candidate_names(filename, content_hash) + [f"{stem}-{content_hash}{ext}"]:
+        try:
+            os.link(tmp_path, os.path.join(pdf_dir, name))
+        except FileExistsError:
+            continue
+        os.remove(tmp_path)
+        return name
+    raise FileExistsError(f"No free name for {filename}")
+
+
+async def save_upload(file: UploadFile, pdf_dir: str = PDF_DIRECTORY) -> Dict:
+    """Copiar una subida al directorio de PDFs por bloques, calculando su SHA-256.
+
+    La escritura y el hash corren en un hilo: el event loop sigue atendiendo
+    consultas. No se sobreescribe un archivo existente con otro contenido; si
+    el contenido ya está indexado el archivo se descarta, y si ya se subió
+    pero no se indexó se reutiliza ese archivo.
+    Devuelve {"filename", "sha256", "size", "status": saved | unindexed | duplicate, "existing"}.
+    """
+    filename = os.path.basename(file.filename)
+    os.makedirs(pdf_dir, exist_ok=True)
+    # Temporal oculto y sin extensión .pdf: la ingesta nunca lo ve a medias
+    tmp_path = os.path.join(pdf_dir, f".{uuid.uuid4().hex}.upload")
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        with open(tmp_path, "wb") as buffer:
+            while True:
+                block = await file.read(UPLOAD_CHUNK_BYTES)
+                if not block:
+                    break
+                await asyncio.to_thread(_write_block, buffer, digest, block)
+                size += len(block)
+        content_hash = digest.hexdigest()
+
+        existing, indexed = await asyncio.to_thread(_find_existing, pdf_dir, filename, content_hash)
+        if existing:
+            os.remove(tmp_path)
+            if indexed:
+                return {"filename": filename, "sha256": content_hash, "size": size, "status": "duplicate", "existing": existing}
+            # Mismo contenido ya en disco pero sin indexar: se indexa con su nombre actual
+            return {"filename": existing, "sha256": content_hash, "size": size, "status": "unindexed", "existing": existing}
+
+        saved_name = await asyncio.to_thread(_publish, tmp_path, pdf_dir, filename, content_hash)
+        return {"filename": saved_name, "sha256": content_hash, "size": size, "status": "saved", "existing": None}
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
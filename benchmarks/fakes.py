@@ -0,0 +1,388 @@
+"""Stand-ins locales y deterministas para correr la app sin OpenAI ni Postgres.
+
+`install()` reemplaza las clases con las que `app.resources` construye los
+recursos (modelo de chat, embeddings, PGVector, searcher, historial y versión
+de ingesta), así que debe llamarse ANTES de importar `app.resources`/`app.server`.
+"""
+import asyncio
+import functools
+import hashlib
+import random
+import re
+import threading
+import time
+from collections import defaultdict
+from typing import Any, AsyncIterator, Dict, Iterable, Iterator, List, Optional
+
+import numpy as np
+from langchain_core.callbacks import AsyncCallbackManagerForLLMRun, CallbackManagerForLLMRun
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage, HumanMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from langchain_core.vectorstores import VectorStore
+from pydantic import ConfigDict, Field
+
+from app.filters import MetadataFilter, from_store_filter, matches_filters
+from app.retrieval import VectorSearcher
+
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+
+
+def _seed(text: str) -> int:
+    return int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "big")
+
+
+# ========== MODELOS ==========
+
+class FakeChatModel(BaseChatModel):
+    """Modelo de chat determinista con latencia y velocidad de tokens configurables.
+
+    Reconoce los tres prompts de la app: variantes de MultiQuery, reescritura
+    standalone y respuesta final. Cuenta una palabra como un token.
+    """
+
+    model_config = ConfigDict(populate_by_name=True)
+
+    model_name: str = Field(default="fake-chat", alias="model")
+    temperature: float = 0.0
+    streaming: bool = False
+    stream_usage: bool = False
+    # Latencia hasta el primer token y tokens por segundo a partir de ahí
+    latency_ms: float = 300.0
+    tokens_per_second: float = 50.0
+    answer_tokens: int = 120
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-chat"
+
+    def _reply(self, prompt: str) -> str:
+        if "different versions" in prompt and "Original question:" in prompt:
+            question = prompt.rsplit("Original question:", 1)[1].strip()
+            return "\n".join(f"{prefix} {question}" for prefix in ("Explain:", "Details about:", "Information on:"))
+        if "Standalone question:" in prompt and "Follow Up Input:" in prompt:
+            return prompt.rsplit("Follow Up Input:", 1)[1].split("\n", 1)[0].strip()
+        # Respuesta: palabras del propio contexto elegidas de forma determinista
+        words = _WORD_RE.findall(prompt) or ["answer"]
+        rng = random.Random(_seed(prompt))
+        return " ".join(rng.choice(words) for _ in range(self.answer_tokens))
+
+    @staticmethod
+    def _prompt(messages: List[BaseMessage]) -> str:
+        return "\n".join(str(message.content) for message in messages)
+
+    def _tokens(self, text: str) -> List[str]:
+        words = text.split(" ")
+        return [word if i == 0 else " " + word for i, word in enumerate(words)]
+
+    def _usage(self, prompt: str, reply: str) -> Dict[str, int]:
+        input_tokens = len(prompt.split())
+        output_tokens = len(reply.split())
+        return {"input_tokens": input_tokens, "output_tokens": output_tokens, "total_tokens": input_tokens + output_tokens}
+
+    def _result(self, prompt: str, reply: str) -> ChatResult:
+        message = AIMessage(
+            content=reply,
+            usage_metadata=self._usage(prompt, reply),
+            response_metadata={"model_name": self.model_name},
+        )
+        return ChatResult(generations=[ChatGeneration(message=message)], llm_output={"model_name": self.model_name})
+
+    def _duration(self, reply: str) -> float:
+        return self.latency_ms / 1000 + len(reply.split()) / max(self.tokens_per_second, 1e-9)
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                  run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs: Any) -> ChatResult:
+        prompt = self._prompt(messages)
+        reply = self._reply(prompt)
+        time.sleep(self._duration(reply))
+        return self._result(prompt, reply)
+
+    async def _agenerate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                         run_manager: Optional[AsyncCallbackManagerForLLMRun] = None, **kwargs: Any) -> ChatResult:
+        prompt = self._prompt(messages)
+        reply = self._reply(prompt)
+        await asyncio.sleep(self._duration(reply))
+        return self._result(prompt, reply)
+
+    def _final_chunk(self, prompt: str, reply: str) -> ChatGenerationChunk:
+        return ChatGenerationChunk(message=AIMessageChunk(
+            content="",
+            usage_metadata=self._usage(prompt, reply) if self.stream_usage else None,
+            response_metadata={"model_name": self.model_name},
+        ))
+
+    def _stream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs: Any) -> Iterator[ChatGenerationChunk]:
+        prompt = self._prompt(messages)
+        reply = self._reply(prompt)
+        time.sleep(self.latency_ms / 1000)
+        for token in self._tokens(reply):
+            time.sleep(1 / max(self.tokens_per_second, 1e-9))
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content=token))
+            if run_manager:
+                run_manager.on_llm_new_token(token, chunk=chunk)
+            yield chunk
+        yield self._final_chunk(prompt, reply)
+
+    async def _astream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                       run_manager: Optional[AsyncCallbackManagerForLLMRun] = None, **kwargs: Any) -> AsyncIterator[ChatGenerationChunk]:
+        prompt = self._prompt(messages)
+        reply = self._reply(prompt)
+        await asyncio.sleep(self.latency_ms / 1000)
+        for token in self._tokens(reply):
+            await asyncio.sleep(1 / max(self.tokens_per_second, 1e-9))
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content=token))
+            if run_manager:
+                await run_manager.on_llm_new_token(token, chunk=chunk)
+            yield chunk
+        yield self._final_chunk(prompt, reply)
+
+
+class FakeEmbeddings(Embeddings):
+    """Embeddings deterministas por hashing de palabras (textos parecidos, vectores parecidos)"""
+
+    def __init__(self, model: str = "fake-embedding", dimensions: int = 256, latency_ms: float = 20.0, **kwargs):
+        self.model = model
+        self.dimensions = dimensions
+        self.latency_ms = latency_ms
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def _vector(self, text: str) -> List[float]:
+        vector = np.zeros(self.dimensions, dtype=np.float32)
+        for word in _WORD_RE.findall(text.lower()):
+            seed = _seed(word)
+            vector[seed % self.dimensions] += 1.0 if (seed >> 32) & 1 else -1.0
+        norm = np.linalg.norm(vector)
+        if not norm:
+            vector[_seed(text) % self.dimensions] = 1.0
+            norm = 1.0
+        return (vector / norm).tolist()
+
+    def _count(self):
+        with self._lock:
+            self.calls += 1
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        self._count()
+        time.sleep(self.latency_ms / 1000)
+        return [self._vector(text) for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        self._count()
+        await asyncio.sleep(self.latency_ms / 1000)
+        return [self._vector(text) for text in texts]
+
+    async def aembed_query(self, text: str) -> List[float]:
+        return (await self.aembed_documents([text]))[0]
+
+
+# ========== VECTOR STORE / HISTORIAL LOCALES ==========
+
+class LocalIndex:
+    """Búsqueda exacta por similitud coseno sobre una matriz en memoria"""
+
+    def __init__(self):
+        self.documents: List[Document] = []
+        self._matrix: Optional[np.ndarray] = None
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.documents)
+
+    def add(self, documents: List[Document], vectors: List[List[float]]):
+        if not documents:
+            return
+        array = np.asarray(vectors, dtype=np.float32)
+        array /= np.maximum(np.linalg.norm(array, axis=1, keepdims=True), 1e-12)
+        with self._lock:
+            self.documents.extend(documents)
+            self._matrix = array if self._matrix is None else np.vstack([self._matrix, array])
+
+    def search(self, vectors: List[List[float]], k: int, filters: Optional[MetadataFilter] = None) -> List[List[tuple]]:
+        """Para cada vector, los k documentos más cercanos (que cumplen `filters`) como (Document, distancia coseno)"""
+        if self._matrix is None or not vectors:
+            return [[] for _ in vectors]
+        candidates = np.asarray([
+            i for i, doc in enumerate(self.documents) if matches_filters(doc.metadata, filters)
+        ], dtype=np.int64)
+        if not len(candidates):
+            return [[] for _ in vectors]
+        queries = np.asarray(vectors, dtype=np.float32)
+        queries /= np.maximum(np.linalg.norm(queries, axis=1, keepdims=True), 1e-12)
+        similarities = queries @ self._matrix[candidates].T
+        k = min(k, len(candidates))
+        results = []
+        for row in similarities:
+            top = np.argpartition(-row, k - 1)[:k]
+            top = top[np.argsort(-row[top])]
+            results.append([
+                (Document(page_content=self.documents[candidates[i]].page_content,
+                          metadata=dict(self.documents[candidates[i]].metadata)),
+                 float(1.0 - row[i]))
+                for i in top
+            ])
+        return results
+
+
+_index = LocalIndex()
+
+
+class LocalVectorStore(VectorStore):
+    """Reemplazo de PGVector: acepta sus mismos argumentos y busca en el LocalIndex compartido"""
+
+    def __init__(self, collection_name: str = "", connection_string: str = "", embedding_function: Embeddings = None,
+                 index: Optional[LocalIndex] = None, **kwargs):
+        self.collection_name = collection_name
+        self.embedding_function = embedding_function
+        self.index = index or _index
+
+    @property
+    def embeddings(self) -> Embeddings:
+        return self.embedding_function
+
+    def add_texts(self, texts: Iterable[str], metadatas: Optional[List[dict]] = None, **kwargs) -> List[str]:
+        texts = list(texts)
+        metadatas = metadatas or [{} for _ in texts]
+        documents = [Document(page_content=text, metadata=dict(metadata)) for text, metadata in zip(texts, metadatas)]
+        self.index.add(documents, self.embedding_function.embed_documents(texts))
+        return [str(len(self.index) - len(texts) + i) for i in range(len(texts))]
+
+    def similarity_search_with_score_by_vector(self, embedding: List[float], k: int = 4,
+                                               filter: Optional[dict] = None) -> List[tuple]:
+        return self.index.search([embedding], k, from_store_filter(filter))[0]
+
+    def similarity_search(self, query: str, k: int = 4, **kwargs) -> List[Document]:
+        vector = self.embedding_function.embed_query(query)
+        return [doc for doc, _ in self.similarity_search_with_score_by_vector(vector, k, kwargs.get("filter"))]
+
+    async def asimilarity_search(self, query: str, k: int = 4, **kwargs) -> List[Document]:
+        vector = await self.embedding_function.aembed_query(query)
+        return [doc for doc, _ in self.similarity_search_with_score_by_vector(vector, k, kwargs.get("filter"))]
+
+    @classmethod
+    def from_texts(cls, texts: List[str], embedding: Embeddings, metadatas: Optional[List[dict]] = None, **kwargs):
+        store = cls(embedding_function=embedding, index=LocalIndex())
+        store.add_texts(texts, metadatas)
+        return store
+
+
+class LocalSearcher(VectorSearcher):
+    """Reemplazo de PGVectorSearcher que busca en el LocalIndex compartido"""
+
+    def __init__(self, *args, index: Optional[LocalIndex] = None, **kwargs):
+        self.index = index or _index
+
+    async def asearch_many(self, vectors, k=4, filters=None):
+        return self.index.search(vectors, k, filters)
+
+    def search_many(self, vectors, k=4, filters=None):
+        return self.index.search(vectors, k, filters)
+
+
+class InMemoryHistoryStore:
+    """Misma interfaz que ChatHistoryStore, en memoria y con latencia simulada"""
+
+    def __init__(self, url: str = "", max_messages: int = 20, latency_ms: float = 2.0):
+        self.max_messages = max_messages
+        self.latency_ms = latency_ms
+        # Mensajes como (id, mensaje), con ids crecientes como SERIAL
+        self._sessions: Dict[str, List[tuple]] = defaultdict(list)
+        self._summaries: Dict[str, tuple] = {}
+        self._next_id = 1
+        self.operations = 0
+
+    async def ensure_schema(self):
+        pass
+
+    async def warmup(self, connections: int):
+        pass
+
+    async def load(self, session_id: str, limit: Optional[int] = None) -> List[BaseMessage]:
+        self.operations += 1
+        await asyncio.sleep(self.latency_ms / 1000)
+        return [message for _, message in self._sessions[session_id][-(limit or self.max_messages):]]
+
+    async def load_context(self, session_id: str, limit: Optional[int] = None):
+        self.operations += 1
+        await asyncio.sleep(self.latency_ms / 1000)
+        summary, last_message_id = self._summaries.get(session_id, (None, 0))
+        after = [item for item in self._sessions[session_id] if item[0] > last_message_id]
+        return summary, last_message_id, after[-(limit or self.max_messages):]
+
+    async def load_range(self, session_id: str, after_id: int, before_id: int, limit: int):
+        self.operations += 1
+        await asyncio.sleep(self.latency_ms / 1000)
+        return [item for item in self._sessions[session_id] if after_id < item[0] < before_id][:limit]
+
+    async def save_summary(self, session_id: str, summary: str, last_message_id: int):
+        self.operations += 1
+        await asyncio.sleep(self.latency_ms / 1000)
+        if last_message_id > self._summaries.get(session_id, (None, 0))[1]:
+            self._summaries[session_id] = (summary, last_message_id)
+
+    async def save(self, session_id: str, human_message: str, ai_message: str):
+        self.operations += 1
+        await asyncio.sleep(self.latency_ms / 1000)
+        first_id = self._next_id
+        self._next_id += 2
+        self._sessions[session_id].extend([
+            (first_id, HumanMessage(content=human_message)),
+            (first_id + 1, AIMessage(content=ai_message)),
+        ])
+
+    def stats(self) -> Dict:
+        return {
+            "size": 0, "checked_out": 0, "checked_in": 0, "overflow": 0,
+            "acquisitions": self.operations, "wait_seconds_total": 0.0,
+            "wait_seconds_avg": 0.0, "wait_seconds_max": 0.0,
+        }
+
+    async def close(self):
+        pass
+
+
+class StaticVersionTracker:
+    """La colección local no se re-ingesta durante el benchmark"""
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    async def current(self) -> int:
+        return 0
+
+    async def close(self):
+        pass
+
+
+# ========== INSTALACIÓN ==========
+
+def install(llm_latency_ms: float = 300.0, tokens_per_second: float = 50.0, answer_tokens: int = 120,
+            embedding_latency_ms: float = 20.0, embedding_dimensions: int = 256,
+            history_latency_ms: float = 2.0) -> LocalIndex:
+    """Reemplazar los componentes externos por los locales. Devuelve el índice compartido."""
+    import langchain_openai
+    from langchain_community.vectorstores import pgvector
+
+    import app.answer_cache
+    import app.embedding_cache
+    import app.history
+    import app.retrieval
+
+    langchain_openai.ChatOpenAI = functools.partial(
+        FakeChatModel, latency_ms=llm_latency_ms, tokens_per_second=tokens_per_second, answer_tokens=answer_tokens,
+    )
+    app.embedding_cache.OpenAIEmbeddings = functools.partial(
+        FakeEmbeddings, dimensions=embedding_dimensions, latency_ms=embedding_latency_ms,
+    )
+    pgvector.PGVector = LocalVectorStore
+    app.retrieval.PGVectorSearcher = LocalSearcher
+    app.history.ChatHistoryStore = functools.partial(InMemoryHistoryStore, latency_ms=history_latency_ms)
+    app.answer_cache.IngestVersionTracker = StaticVersionTracker
+    return _index
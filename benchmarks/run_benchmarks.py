@@ -0,0 +1,329 @@
+import argparse
+import asyncio
+import json
+import math
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+from contextlib import nullcontext
+from typing import Dict, List, Optional
+
+# Permitir importar `app` y `benchmarks` al ejecutar el script desde cualquier directorio
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+QUESTIONS = [
+    "Who was John F. Kennedy?",
+    "When was John F. Kennedy elected president?",
+    "What happened during the Cuban Missile Crisis?",
+    "Who was Joseph P. Kennedy Sr.?",
+    "What business did Joseph P. Kennedy Sr. run?",
+    "What was Robert F. Kennedy's role as Attorney General?",
+    "How did Robert F. Kennedy die?",
+    "What experience does Julian David Ortega Solarte have?",
+    "Which programming languages does Julian Ortega know?",
+    "What position is Julian Ortega applying for in the cover letter?",
+    "How were John and Robert Kennedy related?",
+    "What was the New Frontier?",
+]
+
+
+def percentile(values: List[float], pct: float) -> Optional[float]:
+    """Percentil por rango más cercano"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(math.ceil(pct / 100 * len(ordered)), 1)
+    return ordered[rank - 1]
+
+
+def summarize(latencies: List[float], ttfts: List[float], errors: int, elapsed: float) -> Dict:
+    def ms(value):
+        return round(value * 1000, 1) if value is not None else None
+
+    return {
+        "requests": len(latencies) + errors,
+        "errors": errors,
+        "requests_per_second": round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+        "latency_ms": {name: ms(percentile(latencies, pct)) for name, pct in (("p50", 50), ("p95", 95), ("p99", 99))},
+        "ttft_ms": {name: ms(percentile(ttfts, pct)) for name, pct in (("p50", 50), ("p95", 95), ("p99", 99))} if ttfts else None,
+    }
+
+
+# ========== CARGA DE PDFs ==========
+
+def bench_loader(pdf_dir: str, index) -> Dict:
+    """Correr el pipeline real de ingesta con embeddings falsos, escribiendo al índice local"""
+    from app.chunking import build_text_splitter
+    from app.config import EMBEDDING_MODEL, VECTOR_BACKEND
+    from app.embedding_cache import build_embeddings
+    from app.ingest import chunk_ids_for, empty_manifest, plan_ingest
+    from app.ingest_pipeline import CountingEmbeddings, run_pipeline
+    from app.lexical import BM25Index
+    from app.mmap_index import MmapVectorIndex
+
+    embeddings = CountingEmbeddings(build_embeddings())
+    items, _ = plan_ingest(empty_manifest(), pdf_dir)
+    mmap_index = MmapVectorIndex() if VECTOR_BACKEND == "mmap" else None
+
+    def commit_batch(batch):
+        for item, chunks, vectors in batch:
+            if mmap_index is not None:
+                mmap_index.swap([], chunks, chunk_ids_for(item["rel_path"], item["sha256"], EMBEDDING_MODEL, len(chunks)), vectors)
+            else:
+                index.add(chunks, vectors)
+
+    started = time.perf_counter()
+    # Una sola generación mmap por carga, igual que la ingesta real
+    with mmap_index.batch() if mmap_index is not None else nullcontext():
+        result = run_pipeline(items, build_text_splitter(embeddings), embeddings, commit_batch)
+    elapsed = time.perf_counter() - started
+
+    # Índice BM25 para el routing, como al final de una ingesta real
+    if mmap_index is not None:
+        records = mmap_index.iter_documents()
+    else:
+        records = ((str(i), doc.page_content, doc.metadata) for i, doc in enumerate(index.documents))
+    BM25Index.build(records).save(os.environ["LEXICAL_INDEX_PATH"])
+
+    stages = result["stages"]
+    pages = stages["parse"]["items"]
+    chunks = stages["chunk"]["items"]
+    return {
+        "files": len(items),
+        "pages": pages,
+        "chunks": chunks,
+        "elapsed_seconds": round(elapsed, 3),
+        "pages_per_second": round(pages / elapsed, 2) if elapsed else 0.0,
+        "chunks_per_second": round(chunks / elapsed, 2) if elapsed else 0.0,
+        "embedding_calls": embeddings.snapshot(pages, chunks),
+        "stages": stages,
+    }
+
+
+# ========== CARGA HTTP ==========
+
+def start_server(app) -> tuple:
+    """Levantar la app en un hilo con uvicorn, en un puerto libre"""
+    import httpx
+    import uvicorn
+
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    thread = threading.Thread(target=server.run, name="bench-server", daemon=True)
+    thread.start()
+    while not server.started:
+        if not thread.is_alive():
+            raise RuntimeError("Benchmark server failed to start")
+        time.sleep(0.05)
+    base_url = f"http://127.0.0.1:{port}"
+    # Como un balanceador: no mandar tráfico hasta que el precalentamiento termine
+    while httpx.get(f"{base_url}/health/ready").status_code != 200:
+        if not thread.is_alive():
+            raise RuntimeError("Benchmark server failed to start")
+        time.sleep(0.05)
+    return server, thread, base_url
+
+
+async def _query(client, payload: Dict) -> tuple:
+    started = time.perf_counter()
+    response = await client.post("/query", json=payload)
+    response.raise_for_status()
+    return time.perf_counter() - started, None
+
+
+async def _stream(client, payload: Dict) -> tuple:
+    started = time.perf_counter()
+    ttft = None
+    async with client.stream("POST", "/stream", json=payload) as response:
+        response.raise_for_status()
+        async for line in response.aiter_lines():
+            if not line.startswith("data: "):
+                continue
+            data = line[len("data: "):]
+            if data == "[DONE]":
+                break
+            event = json.loads(data)
+            if "error" in event:
+                raise RuntimeError(event["error"])
+            if ttft is None and "answer" in event.get("chunk", {}):
+                ttft = time.perf_counter() - started
+    return time.perf_counter() - started, ttft
+
+
+async def bench_endpoint(base_url: str, endpoint: str, requests: int, concurrency: int, sessions: bool) -> Dict:
+    import httpx
+
+    call = _query if endpoint == "query" else _stream
+    latencies, ttfts = [], []
+    errors = 0
+    counter = iter(range(requests))
+
+    async def client_worker(worker_id: int, client):
+        nonlocal errors
+        for i in counter:
+            payload = {"question": QUESTIONS[i % len(QUESTIONS)]}
+            if sessions:
+                # Cada cliente simulado mantiene su propia conversación
+                payload["config"] = {"configurable": {"session_id": f"bench-{endpoint}-{worker_id}"}}
+            try:
+                latency, ttft = await call(client, payload)
+            except Exception as e:
+                errors += 1
+                print(f"  ⚠️ {endpoint} request failed: {e}")
+                continue
+            latencies.append(latency)
+            if ttft is not None:
+                ttfts.append(ttft)
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, timeout=120.0, limits=limits) as client:
+        started = time.perf_counter()
+        await asyncio.gather(*(client_worker(worker_id, client) for worker_id in range(concurrency)))
+        elapsed = time.perf_counter() - started
+    return summarize(latencies, ttfts, errors, elapsed)
+
+
+async def bench_batch(base_url: str, requests: int, concurrency: int) -> Dict:
+    """Un solo /batch_query con `requests` preguntas; la latencia de cada una es
+    el tiempo hasta que llega su línea NDJSON"""
+    import httpx
+
+    payload = {
+        "questions": [QUESTIONS[i % len(QUESTIONS)] for i in range(requests)],
+        "concurrency": concurrency,
+    }
+    latencies = []
+    errors = 0
+    async with httpx.AsyncClient(base_url=base_url, timeout=600.0) as client:
+        started = time.perf_counter()
+        async with client.stream("POST", "/batch_query", json=payload) as response:
+            response.raise_for_status()
+            async for line in response.aiter_lines():
+                if not line:
+                    continue
+                result = json.loads(line)
+                if "error" in result:
+                    errors += 1
+                    print(f"  ⚠️ batch question {result['index']} failed: {result['error']}")
+                    continue
+                latencies.append(time.perf_counter() - started)
+        elapsed = time.perf_counter() - started
+    return summarize(latencies, [], errors, elapsed)
+
+
+# ========== MAIN ==========
+
+def print_report(results: Dict):
+    loader = results.get("loader")
+    if loader:
+        print(f"\nLoader: {loader['files']} files, {loader['pages']} pages, {loader['chunks']} chunks "
+              f"in {loader['elapsed_seconds']}s -> {loader['pages_per_second']} pages/s, "
+              f"{loader['chunks_per_second']} chunks/s")
+        calls = loader["embedding_calls"]
+        print(f"  embedding calls: {calls['calls']} ({calls['calls_per_page']} per page), "
+              f"{calls['texts']} texts ({calls['texts_per_chunk']} per chunk)")
+        for stage, entry in loader["stages"].items():
+            print(f"  {stage:>6}: {entry['items_per_second']} items/s, busy {entry['busy_seconds']}s")
+
+    for endpoint in ("query", "stream", "batch_query"):
+        entry = results.get(endpoint)
+        if not entry:
+            continue
+        latency = entry["latency_ms"]
+        line = (f"\n/{endpoint}: {entry['requests']} requests ({entry['errors']} errors), "
+                f"{entry['requests_per_second']} req/s, latency p50 {latency['p50']} ms, "
+                f"p95 {latency['p95']} ms, p99 {latency['p99']} ms")
+        if entry["ttft_ms"]:
+            ttft = entry["ttft_ms"]
+            line += f", TTFT p50 {ttft['p50']} ms, p95 {ttft['p95']} ms, p99 {ttft['p99']} ms"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark of the loader, /query, /stream and /batch_query")
+    parser.add_argument("--requests", type=int, default=100, help="Requests per endpoint")
+    parser.add_argument("--concurrency", type=int, default=8, help="Concurrent clients per endpoint")
+    parser.add_argument("--endpoints", default="query,stream", help="Comma separated: query,stream,batch_query")
+    parser.add_argument("--sessions", action="store_true", help="Send a session_id so the history path is exercised")
+    parser.add_argument("--pdf-dir", default=os.path.join(ROOT, "pdf-documents"))
+    parser.add_argument("--skip-loader", action="store_true", help="Index the PDFs but do not report loader throughput")
+    parser.add_argument("--chunker", choices=["semantic", "token", "langchain"], default="semantic",
+                        help="Loader chunking mode (INGEST_CHUNKER)")
+    parser.add_argument("--llm-latency-ms", type=float, default=300.0, help="Fake chat model time to first token")
+    parser.add_argument("--tokens-per-second", type=float, default=50.0, help="Fake chat model generation speed")
+    parser.add_argument("--answer-tokens", type=int, default=120, help="Tokens per generated answer")
+    parser.add_argument("--embedding-latency-ms", type=float, default=20.0, help="Fake embedding latency per call")
+    parser.add_argument("--history-latency-ms", type=float, default=2.0, help="Fake history store latency per operation")
+    parser.add_argument("--vector-backend", choices=["local", "mmap"], default="local",
+                        help="In-memory index, or the real mmap backend in a temporary directory")
+    parser.add_argument("--answer-cache", action="store_true", help="Keep the semantic answer cache enabled")
+    parser.add_argument("--embedding-cache", action="store_true", help="Wrap the fake embeddings with the embedding cache")
+    parser.add_argument("--output", help="Write the results as JSON to this path")
+    args = parser.parse_args()
+
+    # La configuración se lee al importar app.config: fijarla antes de importar la app.
+    # La caché de embeddings va a un directorio temporal para no mezclar vectores falsos con los reales.
+    cache_dir = tempfile.mkdtemp(prefix="rag-bench-")
+    os.environ["EMBEDDING_CACHE_ENABLED"] = "true" if args.embedding_cache else "false"
+    os.environ["EMBEDDING_CACHE_PATH"] = os.path.join(cache_dir, "embeddings.sqlite3")
+    os.environ["ANSWER_CACHE_ENABLED"] = "true" if args.answer_cache else "false"
+    os.environ["LEXICAL_INDEX_PATH"] = os.path.join(cache_dir, "bm25.json")
+    os.environ.setdefault("METRICS_LOG_SAMPLE_RATE", "0")
+    os.environ["INGEST_CHUNKER"] = args.chunker
+    if args.vector_backend == "mmap":
+        os.environ["VECTOR_BACKEND"] = "mmap"
+        os.environ["MMAP_INDEX_DIR"] = os.path.join(cache_dir, "index")
+    else:
+        os.environ["VECTOR_BACKEND"] = "pgvector"
+
+    from benchmarks.fakes import install
+
+    index = install(
+        llm_latency_ms=args.llm_latency_ms,
+        tokens_per_second=args.tokens_per_second,
+        answer_tokens=args.answer_tokens,
+        embedding_latency_ms=args.embedding_latency_ms,
+        history_latency_ms=args.history_latency_ms,
+    )
+
+    results = {"settings": vars(args)}
+    print(f"Indexing PDFs from {args.pdf_dir}...")
+    loader = bench_loader(args.pdf_dir, index)
+    if not args.skip_loader:
+        results["loader"] = loader
+
+    # server.py monta ./pdf-documents relativo al directorio actual
+    os.chdir(ROOT)
+    from app.server import app
+
+    server, thread, base_url = start_server(app)
+    try:
+        for endpoint in [name.strip() for name in args.endpoints.split(",") if name.strip()]:
+            print(f"Benchmarking /{endpoint} ({args.requests} requests, {args.concurrency} clients)...")
+            if endpoint == "batch_query":
+                # Sin historial: --sessions no aplica
+                results[endpoint] = asyncio.run(bench_batch(base_url, args.requests, args.concurrency))
+                continue
+            results[endpoint] = asyncio.run(
+                bench_endpoint(base_url, endpoint, args.requests, args.concurrency, args.sessions)
+            )
+    finally:
+        server.should_exit = True
+        thread.join(timeout=10)
+
+    print_report(results)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"\nResults written to {args.output}")
+
+
+# El pipeline de ingesta parsea en procesos "spawn", que reimportan este módulo
+if __name__ == "__main__":
+    main()
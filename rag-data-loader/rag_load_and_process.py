@@ -1,43 +1,58 @@
+import argparse
 import os
-
-from dotenv import load_dotenv
-from langchain_community.document_loaders import DirectoryLoader, PyPDFLoader
-from langchain_community.vectorstores.pgvector import PGVector
-from langchain_experimental.text_splitter import SemanticChunker
-from langchain_openai import OpenAIEmbeddings
-
-load_dotenv()
-
-loader = DirectoryLoader(
-    os.path.abspath("./pdf-documents"),
-    glob="**/*.pdf",
-    use_multithreading=True,
-    show_progress=True,
-    max_concurrency=50,
-    loader_cls=PyPDFLoader,
-)
-docs = loader.load()
-
-# Using the modern text-embedding-3-small model (5x cheaper than ada-002)
-embeddings = OpenAIEmbeddings(model='text-embedding-3-small')
-
-text_splitter = SemanticChunker(
-    embeddings=embeddings
-)
-
-# The docs structure has been simplified in newer versions
-# No need for the flattening step that was required in the original
-chunks = text_splitter.split_documents(docs)
-
-print(f"Created {len(chunks)} chunks from {len(docs)} documents")
-
-# Create the vector database with the processed chunks
-PGVector.from_documents(
-    documents=chunks,
-    embedding=embeddings,
-    collection_name="collection164",
-    connection_string=os.getenv("DATABASE_URL"),
-    pre_delete_collection=True,
-)
-
-print("Vector database created successfully!")
\ No newline at end of file
+import sys
+
+# Permitir importar el paquete `app` al ejecutar el script desde la raíz del repo
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.config import VECTOR_BACKEND  # noqa: E402
+from app.ingest import run_full, run_incremental  # noqa: E402
+from app.mmap_index import MmapVectorIndex  # noqa: E402
+from app.pgvector_admin import ensure_indexes  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load PDFs into the PGVector collection")
+    parser.add_argument(
+        "--full",
+        action="store_true",
+        help="Reprocess every file instead of only new/changed ones",
+    )
+    parser.add_argument(
+        "--reindex",
+        action="store_true",
+        help="Only rebuild the ANN indexes (VECTOR_INDEX_TYPE per collection, or the mmap partitions) and the metadata indexes",
+    )
+    args = parser.parse_args()
+
+    if args.reindex:
+        index = MmapVectorIndex().rebuild() if VECTOR_BACKEND == "mmap" else ensure_indexes(rebuild=True)
+        print(f"Vector index rebuilt: {index}")
+        return
+
+    if args.full:
+        # Reprocesar todo: cada archivo se reemplaza en su transacción y
+        # al final se borran las filas huérfanas
+        stats = run_full()
+    else:
+        # Modo incremental (por defecto): solo archivos nuevos/modificados,
+        # borra los chunks de archivos eliminados y reemplaza cada archivo
+        # en una sola transacción
+        stats = run_incremental()
+
+    # Throughput por etapa del pipeline (parseo, chunking, embeddings, escritura)
+    for stage, entry in stats.pop("stages", {}).items():
+        print(f"  {stage:>6}: {entry['items']} items from {entry['files']} files, "
+              f"{entry['items_per_second']} items/s, busy {entry['busy_seconds']}s")
+    calls = stats.pop("embedding_calls", {})
+    if calls:
+        print(f"  embedding calls: {calls['calls']} ({calls['calls_per_page']} per page), "
+              f"{calls['texts']} texts ({calls['texts_per_chunk']} per chunk), "
+              f"{stats['chunks_per_second']} chunks/s")
+
+    print(f"Vector database updated successfully! {stats}")
+
+
+# El pool de procesos de parseo usa "spawn", que reimporta este módulo
+if __name__ == "__main__":
+    main()
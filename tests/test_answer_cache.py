@@ -0,0 +1,28 @@
+import asyncio
+
+from langchain_core.documents import Document
+
+from app.answer_cache import SemanticAnswerCache
+
+
+class FixedVersion:
+    async def current(self):
+        return 1
+
+
+def test_answers_are_reused_only_with_the_same_history():
+    async def main():
+        cache = SemanticAnswerCache(FixedVersion(), threshold=0.9)
+        docs = [Document(page_content="contexto", metadata={"source": "a.pdf"})]
+        await cache.store([1.0, 0.0], "¿y el precio?", "depende de la conversación", docs, history="h1")
+        await cache.store([1.0, 0.0], "¿y el precio?", "sin historial", docs)
+        return (
+            await cache.lookup([1.0, 0.0], "h1"),
+            await cache.lookup([1.0, 0.0], "h2"),
+            await cache.lookup([1.0, 0.0]),
+        )
+
+    same, other, none = asyncio.run(main())
+    assert same["answer"] == "depende de la conversación"
+    assert other is None
+    assert none["answer"] == "sin historial"
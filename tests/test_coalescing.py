@@ -0,0 +1,99 @@
+import asyncio
+from contextlib import aclosing
+
+from app.coalescing import SingleFlight
+
+
+async def collect(flight):
+    return [chunk async for chunk in flight.subscribe()]
+
+
+def test_concurrent_callers_share_one_run():
+    runs = []
+
+    async def producer():
+        runs.append(1)
+        for i in range(3):
+            await asyncio.sleep(0.01)
+            yield {"answer": str(i)}
+
+    async def main():
+        flights = SingleFlight()
+        first, leader = flights.join("k", producer)
+        await asyncio.sleep(0.015)
+        # Llega tarde: recibe lo ya emitido y sigue en vivo
+        second, joined_leader = flights.join("k", producer)
+        assert leader and not joined_leader and first is second
+        results = await asyncio.gather(collect(first), collect(second))
+        return flights, results
+
+    flights, results = asyncio.run(main())
+    assert runs == [1]
+    assert results[0] == results[1] == [{"answer": "0"}, {"answer": "1"}, {"answer": "2"}]
+    assert flights.snapshot()["in_flight"] == 0
+    assert flights.stats == {"leaders": 1, "joined": 1, "abandoned": 0}
+
+
+def test_key_is_released_after_finishing():
+    async def producer():
+        yield {"answer": "x"}
+
+    async def main():
+        flights = SingleFlight()
+        flight, _ = flights.join("k", producer)
+        await collect(flight)
+        return flights.join("k", producer)[1]
+
+    assert asyncio.run(main())
+
+
+def test_errors_reach_every_subscriber():
+    async def producer():
+        yield {"answer": "parcial"}
+        raise RuntimeError("boom")
+
+    async def main():
+        flights = SingleFlight()
+        flight, _ = flights.join("k", producer)
+        return await asyncio.gather(collect(flight), collect(flight), return_exceptions=True)
+
+    results = asyncio.run(main())
+    assert all(isinstance(result, RuntimeError) for result in results)
+
+
+def test_producer_is_cancelled_when_every_subscriber_leaves():
+    produced, cancelled = [], []
+
+    async def producer():
+        try:
+            for i in range(100):
+                await asyncio.sleep(0.01)
+                produced.append(i)
+                yield {"answer": str(i)}
+        except asyncio.CancelledError:
+            cancelled.append(True)
+            raise
+
+    async def first_chunk(flight):
+        # Un cliente que se desconecta: el servidor cierra su stream
+        async with aclosing(flight.subscribe()) as chunks:
+            async for chunk in chunks:
+                return chunk
+
+    async def main():
+        flights = SingleFlight()
+        flight, _ = flights.join("k", producer)
+        flights.join("k", producer)
+        # El primero se va; el segundo sigue leyendo y el productor no se corta
+        assert await first_chunk(flight) == {"answer": "0"}
+        assert flights.snapshot()["in_flight"] == 1
+        # Se va el último: la clave se libera y el productor se cancela
+        await first_chunk(flight)
+        assert flights.snapshot()["in_flight"] == 0
+        await asyncio.sleep(0.05)
+        return flights
+
+    flights = asyncio.run(main())
+    assert cancelled == [True]
+    assert len(produced) < 10
+    assert flights.stats["abandoned"] == 1
@@ -0,0 +1,41 @@
+import os
+
+import pytest
+
+from app.config import PDF_DIRECTORY
+from app.filters import from_store_filter, matches_filters, normalize_filters, store_filter
+
+
+def test_normalizes_values_and_sorts_keys():
+    filters = normalize_filters({"page": [3, 1], "source": "manual.pdf"})
+    assert filters == (
+        ("page", ("1", "3")),
+        ("source", (os.path.join(PDF_DIRECTORY, "manual.pdf"),)),
+    )
+
+
+def test_empty_filters_are_none():
+    assert normalize_filters({}) is None
+    assert normalize_filters(None) is None
+
+
+def test_rejects_unknown_keys_and_empty_values():
+    with pytest.raises(ValueError):
+        normalize_filters({"author": "x"})
+    with pytest.raises(ValueError):
+        normalize_filters({"page": []})
+
+
+def test_matches_filters():
+    filters = normalize_filters({"source": "a.pdf", "page": [1, 2]})
+    source = os.path.join(PDF_DIRECTORY, "a.pdf")
+    assert matches_filters({"source": source, "page": 2}, filters)
+    assert not matches_filters({"source": source, "page": 3}, filters)
+    assert not matches_filters({"page": 1}, filters)
+    assert matches_filters({}, None)
+
+
+def test_store_filter_round_trip():
+    filters = normalize_filters({"source": ["b.pdf", "a.pdf"], "page": 1})
+    assert from_store_filter(store_filter(filters)) == filters
+    assert from_store_filter(None) is None
@@ -0,0 +1,31 @@
+from langchain_core.documents import Document
+
+from app.retrieval import reciprocal_rank_fusion
+
+
+def doc(doc_id: str) -> Document:
+    return Document(page_content=f"texto {doc_id}", metadata={"id": doc_id})
+
+
+def test_documents_in_several_lists_rank_first():
+    fused = reciprocal_rank_fusion([
+        [(doc("a"), 0.1), (doc("b"), 0.2)],
+        [(doc("b"), 0.3), (doc("c"), 0.4)],
+    ], rrf_k=60)
+    assert [d.metadata["id"] for d in fused] == ["b", "a", "c"]
+    assert fused[0].metadata["rrf_score"] == round(1 / 62 + 1 / 61, 6)
+
+
+def test_keeps_best_similarity_and_applies_limit():
+    fused = reciprocal_rank_fusion([
+        [(doc("a"), 0.5)],
+        [(doc("a"), 0.1), (doc("b"), 0.2)],
+    ], rrf_k=60, limit=1)
+    assert len(fused) == 1
+    assert fused[0].metadata["similarity"] == 0.9
+
+
+def test_without_id_falls_back_to_content():
+    same = [(Document(page_content="igual"), 0.2)]
+    fused = reciprocal_rank_fusion([same, [(Document(page_content="igual"), 0.3)]])
+    assert len(fused) == 1
@@ -0,0 +1,37 @@
+from langchain_core.messages import AIMessage, HumanMessage
+
+import app.history
+from app.history import split_by_budget
+
+
+def messages(*texts):
+    return [
+        (position, (HumanMessage if position % 2 == 0 else AIMessage)(content=text))
+        for position, text in enumerate(texts)
+    ]
+
+
+def test_keeps_whole_turns_within_budget(monkeypatch):
+    monkeypatch.setattr(app.history, "count_tokens", lambda text: 10)
+    history = messages("q1", "a1", "q2", "a2", "q3", "a3")
+    # Cada turno (pregunta + respuesta) cuesta 20
+    assert split_by_budget(history, 40) == 2
+    assert split_by_budget(history, 59) == 2
+    assert split_by_budget(history, 60) == 0
+
+
+def test_last_turn_is_kept_even_over_budget(monkeypatch):
+    monkeypatch.setattr(app.history, "count_tokens", lambda text: 100)
+    history = messages("q1", "a1", "q2", "a2")
+    assert split_by_budget(history, 10) == 2
+
+
+def test_trailing_question_counts_alone(monkeypatch):
+    monkeypatch.setattr(app.history, "count_tokens", lambda text: 10)
+    history = messages("q1", "a1", "q2")
+    assert split_by_budget(history, 10) == 2
+    assert split_by_budget(history, 30) == 0
+
+
+def test_empty_history():
+    assert split_by_budget([], 100) == 0
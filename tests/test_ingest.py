@@ -0,0 +1,267 @@
+import json
+import os
+
+import pytest
+from langchain_core.documents import Document
+from langchain_core.embeddings import DeterministicFakeEmbedding
+
+import app.chunking
+import app.ingest
+import app.pgvector_admin
+from app.config import COLLECTION_NAME
+from app.ingest import (
+    MANIFEST_VERSION,
+    chunk_ids_for,
+    empty_manifest,
+    file_sha256,
+    find_indexed,
+    load_manifest,
+    plan_ingest,
+    run_incremental,
+    save_manifest,
+    stale_collections,
+    update_lexical_index,
+)
+from app.chunking import chunker_profile
+from app.ingest_pipeline import PipelineStats
+from app.lexical import BM25Index
+from app.mmap_index import MmapVectorIndex, MmapVectorStore
+
+MODEL = "text-embedding-3-small"
+
+
+@pytest.fixture
+def pdf_dir(tmp_path):
+    directory = tmp_path / "pdfs"
+    (directory / "sub").mkdir(parents=True)
+    (directory / "a.pdf").write_bytes(b"%PDF a")
+    (directory / "sub" / "b.PDF").write_bytes(b"%PDF b")
+    (directory / "notes.txt").write_text("no es un pdf")
+    return str(directory)
+
+
+def indexed(manifest, items):
+    """Registrar los items como indexados, igual que commit_batch"""
+    for item in items:
+        manifest["files"][item["rel_path"]] = {
+            "sha256": item["sha256"],
+            "size": item["size"],
+            "mtime": item["mtime"],
+            "embedding_model": MODEL,
+            "chunker": chunker_profile(),
+            "chunk_ids": chunk_ids_for(item["rel_path"], item["sha256"], MODEL, 2),
+        }
+    return manifest
+
+
+def test_new_files_are_planned(pdf_dir):
+    changed, removed = plan_ingest(empty_manifest(), pdf_dir, MODEL)
+    assert [item["rel_path"] for item in changed] == ["a.pdf", os.path.join("sub", "b.PDF")]
+    assert removed == {}
+    assert changed[0]["sha256"] == file_sha256(os.path.join(pdf_dir, "a.pdf"))
+
+
+def test_unchanged_files_are_skipped(pdf_dir):
+    manifest = indexed(empty_manifest(), plan_ingest(empty_manifest(), pdf_dir, MODEL)[0])
+    assert plan_ingest(manifest, pdf_dir, MODEL) == ([], {})
+
+
+def test_modified_removed_and_touched_files(pdf_dir):
+    manifest = indexed(empty_manifest(), plan_ingest(empty_manifest(), pdf_dir, MODEL)[0])
+    old_ids = manifest["files"]["a.pdf"]["chunk_ids"]
+
+    with open(os.path.join(pdf_dir, "a.pdf"), "ab") as f:
+        f.write(b" nuevo")
+    os.remove(os.path.join(pdf_dir, "sub", "b.PDF"))
+    changed, removed = plan_ingest(manifest, pdf_dir, MODEL)
+    assert [item["rel_path"] for item in changed] == ["a.pdf"]
+    assert changed[0]["old_chunk_ids"] == old_ids
+    assert list(removed) == [os.path.join("sub", "b.PDF")]
+
+
+def test_touched_file_only_updates_mtime(pdf_dir):
+    manifest = indexed(empty_manifest(), plan_ingest(empty_manifest(), pdf_dir, MODEL)[0])
+    path = os.path.join(pdf_dir, "a.pdf")
+    os.utime(path, (1, 1))
+    assert plan_ingest(manifest, pdf_dir, MODEL)[0] == []
+    assert manifest["files"]["a.pdf"]["mtime"] == 1
+
+
+def test_model_or_chunker_change_reprocesses(pdf_dir, monkeypatch):
+    manifest = indexed(empty_manifest(), plan_ingest(empty_manifest(), pdf_dir, MODEL)[0])
+    assert len(plan_ingest(manifest, pdf_dir, "otro-modelo")[0]) == 2
+
+    monkeypatch.setattr(app.chunking, "CHUNK_VECTORS", "reuse" if app.chunking.CHUNK_VECTORS == "embed" else "embed")
+    assert len(plan_ingest(manifest, pdf_dir, MODEL)[0]) == 2
+
+
+def test_chunk_ids_are_deterministic():
+    ids = chunk_ids_for("a.pdf", "abc", MODEL, 3, "semantic")
+    assert ids == chunk_ids_for("a.pdf", "abc", MODEL, 3, "semantic")
+    assert len(set(ids)) == 3
+    assert ids != chunk_ids_for("a.pdf", "abc", MODEL, 3, "token")
+    assert ids != chunk_ids_for("a.pdf", "abd", MODEL, 3, "semantic")
+    # Mismo contenido en otra ruta: otras filas
+    assert set(ids).isdisjoint(chunk_ids_for("copia.pdf", "abc", MODEL, 3, "semantic"))
+
+
+def test_find_indexed(pdf_dir):
+    manifest = indexed(empty_manifest(), plan_ingest(empty_manifest(), pdf_dir, MODEL)[0])
+    content_hash = manifest["files"]["a.pdf"]["sha256"]
+    assert find_indexed(manifest, content_hash, MODEL) == "a.pdf"
+    assert find_indexed(manifest, content_hash, "otro-modelo") is None
+    assert find_indexed(manifest, "0" * 64, MODEL) is None
+
+
+def test_manifest_round_trip_and_invalidation(tmp_path):
+    path = str(tmp_path / "manifest.json")
+    assert load_manifest(path) == empty_manifest()
+
+    manifest = empty_manifest()
+    manifest["files"]["a.pdf"] = {"sha256": "x", "chunk_ids": []}
+    save_manifest(manifest, path)
+    assert load_manifest(path) == manifest
+
+    # Otra versión del formato u otra colección: se reindexa todo
+    for change in ({"version": MANIFEST_VERSION + 1}, {"collection": "otra"}, {"shards": 99}):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({**manifest, **change}, f)
+        assert load_manifest(path)["files"] == {}
+
+
+@pytest.fixture
+def mmap_ingest(tmp_path, monkeypatch):
+    """run_incremental sobre un índice mmap temporal, con un pipeline sin parseo ni API"""
+    index = MmapVectorIndex(str(tmp_path / "index"), partitions=1, dimensions=8)
+    embeddings = DeterministicFakeEmbedding(size=8)
+
+    def fake_pipeline(items, text_splitter, embeddings, commit_batch, on_stage_progress=None, should_cancel=None):
+        # Dos chunks por archivo, un lote por archivo
+        for item in items:
+            chunks = [
+                Document(page_content=f"{item['sha256']} {i}", metadata={"source": item["path"], "page": i})
+                for i in range(2)
+            ]
+            commit_batch([(item, chunks, embeddings.embed_documents([c.page_content for c in chunks]))])
+        return {"stages": PipelineStats().snapshot(), "cancelled": False}
+
+    monkeypatch.setattr(app.ingest, "run_pipeline", fake_pipeline)
+    monkeypatch.setattr(app.ingest, "build_ingest_embeddings", lambda: embeddings)
+    monkeypatch.setattr(app.ingest, "build_stores", lambda e: {COLLECTION_NAME: MmapVectorStore(e, index)})
+    monkeypatch.setattr(app.ingest, "LEXICAL_INDEX_ENABLED", False)
+    return index, str(tmp_path / "manifest.json")
+
+
+def test_identical_files_at_different_paths_keep_their_own_rows(tmp_path, mmap_ingest):
+    index, manifest_path = mmap_ingest
+    pdf_dir = tmp_path / "pdfs"
+    pdf_dir.mkdir()
+    (pdf_dir / "a.pdf").write_bytes(b"%PDF igual")
+    (pdf_dir / "copia.pdf").write_bytes(b"%PDF igual")
+
+    run_incremental(str(pdf_dir), manifest_path)
+    manifest = load_manifest(manifest_path)
+    assert len(index) == 4
+    assert set(manifest["files"]["a.pdf"]["chunk_ids"]).isdisjoint(manifest["files"]["copia.pdf"]["chunk_ids"])
+
+    # Borrar una copia no toca las filas de la otra
+    os.remove(pdf_dir / "copia.pdf")
+    run_incremental(str(pdf_dir), manifest_path)
+    manifest = load_manifest(manifest_path)
+    assert list(manifest["files"]) == ["a.pdf"]
+    assert sorted(chunk_id for chunk_id, _, _ in index.iter_documents()) == sorted(manifest["files"]["a.pdf"]["chunk_ids"])
+
+
+def test_mmap_ingest_publishes_one_generation_per_run(tmp_path, mmap_ingest):
+    index, manifest_path = mmap_ingest
+    pdf_dir = tmp_path / "pdfs"
+    pdf_dir.mkdir()
+    for name in ("a", "b", "c"):
+        (pdf_dir / f"{name}.pdf").write_bytes(f"%PDF {name}".encode())
+
+    run_incremental(str(pdf_dir), manifest_path)
+    assert index.snapshot().generation == 1
+    assert len(index) == 6
+
+    (pdf_dir / "b.pdf").write_bytes(b"%PDF b v2")
+    (pdf_dir / "d.pdf").write_bytes(b"%PDF d")
+    run_incremental(str(pdf_dir), manifest_path)
+    manifest = load_manifest(manifest_path)
+    assert index.snapshot().generation == 2
+    expected = [chunk_id for entry in manifest["files"].values() for chunk_id in entry["chunk_ids"]]
+    assert sorted(chunk_id for chunk_id, _, _ in index.iter_documents()) == sorted(expected)
+
+
+def test_stale_collections_after_a_layout_change(tmp_path, monkeypatch):
+    monkeypatch.setattr(app.pgvector_admin, "VECTOR_BACKEND", "pgvector")
+    monkeypatch.setattr(app.pgvector_admin, "COLLECTION_SHARDS", 2)
+    path = str(tmp_path / "manifest.json")
+    assert stale_collections(path) is None
+    manifest = empty_manifest()
+    save_manifest(manifest, path)
+    assert stale_collections(path) is None
+
+    # Antes sin shards, o con más: esas colecciones quedan fuera del reparto nuevo
+    save_manifest({**manifest, "shards": 1}, path)
+    assert stale_collections(path) == [COLLECTION_NAME]
+    save_manifest({**manifest, "shards": 4}, path)
+    assert stale_collections(path) == [f"{COLLECTION_NAME}_2", f"{COLLECTION_NAME}_3"]
+    # Otro formato pide un run completo aunque no sobre ninguna colección
+    save_manifest({**manifest, "version": MANIFEST_VERSION + 1}, path)
+    assert stale_collections(path) == []
+    save_manifest({**manifest, "collection": "otra"}, path)
+    assert stale_collections(path) == []
+    # Un run completo cortado deja la limpieza pendiente en el manifiesto nuevo
+    save_manifest({**manifest, "stale_collections": [COLLECTION_NAME]}, path)
+    assert stale_collections(path) == [COLLECTION_NAME]
+
+
+def test_incremental_run_after_a_format_change_runs_full(tmp_path, mmap_ingest):
+    index, manifest_path = mmap_ingest
+    pdf_dir = tmp_path / "pdfs"
+    pdf_dir.mkdir()
+    (pdf_dir / "a.pdf").write_bytes(b"%PDF a")
+    run_incremental(str(pdf_dir), manifest_path)
+
+    # Filas de un formato anterior, con ids que el manifiesto nuevo ya no conoce
+    index.swap([], [Document(page_content="vieja", metadata={})], ["vieja"], [[1.0] * 8])
+    with open(manifest_path, encoding="utf-8") as f:
+        manifest = json.load(f)
+    save_manifest({**manifest, "version": MANIFEST_VERSION + 1}, manifest_path)
+
+    run_incremental(str(pdf_dir), manifest_path)
+    with open(manifest_path, encoding="utf-8") as f:
+        manifest = json.load(f)
+    assert manifest["version"] == MANIFEST_VERSION
+    assert "stale_collections" not in manifest
+    assert sorted(chunk_id for chunk_id, _, _ in index.iter_documents()) == sorted(manifest["files"]["a.pdf"]["chunk_ids"])
+
+
+def test_lexical_index_is_updated_with_the_changed_files_only(tmp_path, mmap_ingest):
+    index, manifest_path = mmap_ingest
+    stores = {COLLECTION_NAME: MmapVectorStore(DeterministicFakeEmbedding(size=8), index)}
+    path = str(tmp_path / "bm25.json")
+    pdf_dir = tmp_path / "pdfs"
+    pdf_dir.mkdir()
+    (pdf_dir / "a.pdf").write_bytes(b"%PDF a")
+    (pdf_dir / "b.pdf").write_bytes(b"%PDF b")
+    run_incremental(str(pdf_dir), manifest_path)
+    # Sin índice previo se construye completo
+    assert "added" not in update_lexical_index(stores, [], [], path)
+    assert len(BM25Index.load(path)) == 4
+
+    before = load_manifest(manifest_path)
+    (pdf_dir / "b.pdf").write_bytes(b"%PDF b v2")
+    os.remove(pdf_dir / "a.pdf")
+    run_incremental(str(pdf_dir), manifest_path)
+    after = load_manifest(manifest_path)
+    removed = before["files"]["a.pdf"]["chunk_ids"] + before["files"]["b.pdf"]["chunk_ids"]
+    assert update_lexical_index(stores, removed, after["files"]["b.pdf"]["chunk_ids"], path)["added"] == 2
+    assert sorted(doc["id"] for doc in BM25Index.load(path).docs) == sorted(after["files"]["b.pdf"]["chunk_ids"])
+
+    # Un índice desfasado del vector store (aquí, sin quitar lo borrado) se reconstruye
+    (pdf_dir / "c.pdf").write_bytes(b"%PDF c")
+    run_incremental(str(pdf_dir), manifest_path)
+    BM25Index.build([("vieja", "fila huérfana", {})]).save(path)
+    result = update_lexical_index(stores, [], load_manifest(manifest_path)["files"]["c.pdf"]["chunk_ids"], path)
+    assert "added" not in result and result["documents"] == 4
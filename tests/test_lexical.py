@@ -0,0 +1,73 @@
+import os
+
+from app.lexical import BM25Index, LexicalIndexReader, tokenize
+
+RECORDS = [
+    ("1", "El gato duerme en el sillón", {"source": "/docs/a.pdf", "page": 1}),
+    ("2", "El perro corre por el parque", {"source": "/docs/a.pdf", "page": 2}),
+    ("3", "Gato y gato: dos gatos juegan", {"source": "/docs/b.pdf", "page": 1}),
+]
+
+
+def test_tokenize_drops_single_characters():
+    assert tokenize("Y el Gato, ñandú!") == ["el", "gato", "ñandú"]
+
+
+def test_ranks_by_term_frequency():
+    results = BM25Index.build(RECORDS).search("gato", 5)
+    assert [doc.metadata["id"] for doc, _ in results] == ["3", "1"]
+    assert results[0][1] > results[1][1]
+
+
+def test_filters_before_ranking():
+    filters = (("source", ("/docs/a.pdf",)),)
+    results = BM25Index.build(RECORDS).search("gato", 5, filters)
+    assert [doc.metadata["id"] for doc, _ in results] == ["1"]
+
+
+def test_unknown_terms_and_empty_index():
+    assert BM25Index.build(RECORDS).search("elefante", 5) == []
+    assert BM25Index.build([]).search("gato", 5) == []
+
+
+def test_save_and_load_keep_texts_out_of_the_index(tmp_path):
+    path = str(tmp_path / "bm25.json")
+    index = BM25Index.build(RECORDS)
+    index.save(path)
+    with open(path, encoding="utf-8") as f:
+        assert RECORDS[0][1] not in f.read()
+
+    loaded = BM25Index.load(path)
+    assert [(doc.page_content, score) for doc, score in loaded.search("perro", 1)] == \
+        [(doc.page_content, score) for doc, score in index.search("perro", 1)]
+
+
+def test_reader_reloads_after_a_new_ingest(tmp_path):
+    path = str(tmp_path / "bm25.json")
+    reader = LexicalIndexReader(path)
+    assert reader.search("gato", 5) == []
+
+    BM25Index.build(RECORDS).save(path)
+    assert len(reader.search("gato", 5)) == 2
+
+    BM25Index.build(RECORDS[1:2]).save(path)
+    assert reader.search("gato", 5) == []
+    assert reader.search("perro", 5)[0][0].page_content == RECORDS[1][1]
+    # Solo queda el archivo de textos de la última versión
+    assert len([name for name in os.listdir(tmp_path) if name.endswith(".texts")]) == 1
+
+
+def test_update_only_touches_the_changed_chunks(tmp_path):
+    path = str(tmp_path / "bm25.json")
+    BM25Index.build(RECORDS).save(path)
+    new = ("4", "Un gato nuevo", {"source": "/docs/c.pdf", "page": 1})
+    # Quitar "1", reemplazar "2" y agregar "4"
+    updated = BM25Index.load(path).update(["1"], [("2", "El perro ladra", RECORDS[1][2]), new])
+    expected = BM25Index.build([RECORDS[2], ("2", "El perro ladra", RECORDS[1][2]), new])
+
+    for query in ("gato", "perro ladra", "corre", "sillón"):
+        assert [(doc.metadata["id"], doc.page_content, round(score, 6)) for doc, score in updated.search(query, 5)] == \
+            [(doc.metadata["id"], doc.page_content, round(score, 6)) for doc, score in expected.search(query, 5)]
+
+    updated.save(path)
+    assert [doc.page_content for doc, _ in BM25Index.load(path).search("gato", 5)] == [RECORDS[2][1], new[1]]
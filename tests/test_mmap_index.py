@@ -0,0 +1,56 @@
+import numpy as np
+from langchain_core.documents import Document
+
+from app.mmap_index import MmapVectorIndex
+
+
+def _chunks(*texts):
+    return [Document(page_content=text, metadata={"source": f"{text}.pdf"}) for text in texts]
+
+
+def _vectors(count, seed=0):
+    return np.random.default_rng(seed).normal(size=(count, 4)).tolist()
+
+
+def _ids(index):
+    return sorted(chunk_id for chunk_id, _, _ in index.iter_documents())
+
+
+def test_batch_publishes_one_generation(tmp_path):
+    index = MmapVectorIndex(str(tmp_path), partitions=1, dimensions=4)
+    index.swap([], _chunks("a", "b"), ["a", "b"], _vectors(2))
+    assert index.snapshot().generation == 1
+
+    with index.batch():
+        index.swap([], _chunks("c"), ["c"], _vectors(1, 1))
+        index.swap(["a"], _chunks("d", "e"), ["d", "e"], _vectors(2, 2))
+        # Reemplazar una fila del mismo batch y borrar otra
+        index.swap(["d"], _chunks("c"), ["c"], _vectors(1, 3))
+        # Los lectores siguen viendo la generación anterior
+        assert _ids(index) == ["a", "b"]
+
+    assert index.snapshot().generation == 2
+    assert _ids(index) == ["b", "c", "e"]
+    texts = {chunk_id: text for chunk_id, text, _ in index.iter_documents()}
+    assert texts == {"b": "b", "c": "c", "e": "e"}
+    # El vector de "c" es el del último swap, no el del primero
+    expected = np.asarray(_vectors(1, 3)[0], dtype=np.float32)
+    assert np.allclose(index.vectors(["c"])["c"], expected / np.linalg.norm(expected), atol=1e-6)
+
+
+def test_batch_without_changes_keeps_the_generation(tmp_path):
+    index = MmapVectorIndex(str(tmp_path), partitions=1, dimensions=4)
+    index.swap([], _chunks("a"), ["a"], _vectors(1))
+    with index.batch():
+        index.swap(["inexistente"], [], [], [])
+    assert index.snapshot().generation == 1
+
+
+def test_old_generation_keeps_its_ids_after_being_deleted(tmp_path):
+    index = MmapVectorIndex(str(tmp_path), partitions=1, dimensions=4)
+    index.swap([], _chunks("a"), ["a"], _vectors(1))
+    old = index.snapshot()
+    # Dos escrituras más borran el directorio de la primera generación
+    index.swap([], _chunks("b"), ["b"], _vectors(1, 1))
+    index.swap([], _chunks("c"), ["c"], _vectors(1, 2))
+    assert old.ids() == ["a"]
@@ -0,0 +1,29 @@
+import pytest
+
+from app.scheduling import TokenBucket
+
+
+def test_no_wait_within_budget():
+    bucket = TokenBucket(tokens_per_minute=600)
+    assert bucket.reserve(300) == 0.0
+    assert bucket.available() == pytest.approx(300, abs=1)
+
+
+def test_debt_waits_for_refill():
+    bucket = TokenBucket(tokens_per_minute=60)
+    assert bucket.reserve(60) == 0.0
+    # 1 token por segundo: 30 tokens de deuda son ~30 s de espera
+    assert bucket.reserve(30) == pytest.approx(30, abs=0.1)
+
+
+def test_large_calls_wait_at_most_one_minute():
+    bucket = TokenBucket(tokens_per_minute=60)
+    bucket.reserve(60)
+    assert bucket.reserve(10_000) == pytest.approx(60, abs=0.1)
+
+
+def test_refund_never_exceeds_capacity():
+    bucket = TokenBucket(tokens_per_minute=100)
+    bucket.reserve(40)
+    bucket.refund(1000)
+    assert bucket.available() == pytest.approx(100)